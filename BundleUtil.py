@@ -0,0 +1,320 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Single-file serving bundle: the config and variables of every pass, the
+pickled numericizers (with the Wubi table folded in for cmn) and the
+compact gazetteer of one deployment. A fixed header points to an index of
+sections at the end of the file. Arrays are page-aligned views of one
+read-only mapping, so only the pages that are used are ever read, and
+pickled sections are unpickled on first use.
+fofe_ner_wrapper takes the bundle path in place of the 1st-pass model.
+
+    +--------+-----------+-----------+-----+-------+
+    | header | section 0 | section 1 | ... | index |
+    +--------+-----------+-----------+-----+-------+
+"""
+
+import numpy, os, mmap, struct, time, cPickle, argparse, logging, threading
+from ServingUtil import compact_gazetteer, GazetteerArrays, LoadGazetteer, LayerLabels
+
+logger = logging.getLogger( __name__ )
+
+bundle_magic = 'FOFEBNDL'
+# 2: the numericizers of pass2 may be stored as label rows over those of pass1
+bundle_version = 2
+
+# magic, version, reserved, index offset, index length
+_header = struct.Struct( '<8sIIQQ' )
+_alignment = max( mmap.ALLOCATIONGRANULARITY, 4096 )
+
+# sections of the networks, in the order fofe_ner_wrapper loads them
+pass_names = [ 'pass1', 'pass2', 'cascade' ]
+
+
+def IsBundle( filename ):
+    """
+    Whether filename starts with the bundle magic, as opposed to e.g. the
+    basename of a TensorFlow checkpoint.
+    """
+    if not os.path.isfile( filename ):
+        return False
+    with open( filename, 'rb' ) as fp:
+        return fp.read( len(bundle_magic) ) == bundle_magic
+
+
+def _ReadIndex( fp, filename ):
+    """
+    Returns
+    -------
+        version : int
+        index : dict
+            name -> (kind, offset, length, dtype, shape) of every section
+    """
+    magic, version, _, offset, length = _header.unpack( fp.read( _header.size ) )
+    if magic != bundle_magic:
+        raise IOError( '%s is not a model bundle' % filename )
+    if version > bundle_version:
+        raise IOError( '%s is bundle version %d, only up to %d is supported' % \
+                       (filename, version, bundle_version) )
+    fp.seek( offset )
+    return version, cPickle.loads( fp.read( length ) )
+
+
+def SectionBytes( filename ):
+    """
+    Returns
+    -------
+        sizes : dict
+            kind ('array' or 'pickle') -> bytes of its sections in the
+            bundle, read from the index only
+    """
+    with open( filename, 'rb' ) as fp:
+        _, index = _ReadIndex( fp, filename )
+    sizes = { 'array': 0, 'pickle': 0 }
+    for kind, _, length, _, _ in index.values():
+        sizes[kind] += length
+    return sizes
+
+
+
+class bundle_writer( object ):
+    """
+    Sections are appended as they are added; the file only appears under
+    its name once Close has written the index, so a server watching it
+    never sees a partial bundle.
+    """
+    def __init__( self, filename ):
+        self.filename = filename
+        self.fp = open( filename + '.tmp', 'wb' )
+        self.fp.write( _header.pack( bundle_magic, bundle_version, 0, 0, 0 ) )
+        self.index = {}
+
+
+    def __Align( self ):
+        padding = -self.fp.tell() % _alignment
+        self.fp.write( '\0' * padding )
+        return self.fp.tell()
+
+
+    def AddArray( self, name, array ):
+        assert name not in self.index, '%s is added twice' % name
+        array = numpy.ascontiguousarray( array )
+        offset = self.__Align()
+        array.tofile( self.fp )
+        self.index[name] = ( 'array', offset, array.nbytes, array.dtype.str, array.shape )
+
+
+    def AddObject( self, name, obj ):
+        assert name not in self.index, '%s is added twice' % name
+        offset = self.fp.tell()
+        cPickle.dump( obj, self.fp, cPickle.HIGHEST_PROTOCOL )
+        self.index[name] = ( 'pickle', offset, self.fp.tell() - offset, None, None )
+
+
+    def Close( self ):
+        offset = self.fp.tell()
+        cPickle.dump( self.index, self.fp, cPickle.HIGHEST_PROTOCOL )
+        length = self.fp.tell() - offset
+        self.fp.seek( 0 )
+        self.fp.write( _header.pack( bundle_magic, bundle_version, 0, offset, length ) )
+        self.fp.close()
+        os.rename( self.filename + '.tmp', self.filename )
+
+
+
+class model_bundle( object ):
+    """
+    Read-only view of a bundle. Only the header and the index are read on
+    construction; the whole file is mapped once and array sections are
+    views of the mapping, so worker processes share its page-cache copy.
+    """
+    def __init__( self, filename ):
+        self.filename = filename
+        with open( filename, 'rb' ) as fp:
+            version, self.index = _ReadIndex( fp, filename )
+            self.mapping = mmap.mmap( fp.fileno(), 0, access = mmap.ACCESS_READ )
+        self.version = version
+
+        self.objects = {}
+        self.lock = threading.Lock()
+
+
+    def __contains__( self, name ):
+        return name in self.index
+
+
+    def Names( self, prefix = '' ):
+        return sorted( name for name in self.index if name.startswith( prefix ) )
+
+
+    def Array( self, name ):
+        kind, offset, length, dtype, shape = self.index[name]
+        assert kind == 'array', '%s is not an array' % name
+        dtype = numpy.dtype( dtype )
+        return numpy.frombuffer( self.mapping, dtype = dtype,
+                                 count = length // dtype.itemsize,
+                                 offset = offset ).reshape( shape )
+
+
+    def Object( self, name ):
+        with self.lock:
+            if name not in self.objects:
+                kind, offset, length, _, _ = self.index[name]
+                assert kind == 'pickle', '%s is not pickled' % name
+                self.objects[name] = cPickle.loads( self.mapping[offset: offset + length] )
+            return self.objects[name]
+
+
+    def Arrays( self, prefix ):
+        """
+        Returns
+        -------
+            arrays : dict
+                name without prefix -> array of every array section
+                under prefix, e.g. the variables of one pass
+        """
+        return dict( ( name[len(prefix):], self.Array( name ) ) \
+                     for name in self.Names( prefix ) \
+                        if self.index[name][0] == 'array' )
+
+
+    def Config( self, name ):
+        """
+        Returns
+        -------
+            config : dict
+                attributes of the mention_config of pass name
+        """
+        return self.Object( name + '/config' )
+
+
+    def Numericizers( self, name ):
+        """
+        Returns
+        -------
+            numericizer1, numericizer2
+                of pass name, see fofe_ner_wrapper.LoadVocabulary; those
+                of the 2nd pass may be the label rows of the 1st-pass ones
+        """
+        if name + '/labels1' in self:
+            shared = self.Numericizers( 'pass1' )
+            return tuple( LayerLabels( numericizer, self.Object( '%s/labels%d' % (name, i + 1) ) ) \
+                          for i, numericizer in enumerate( shared ) )
+        return self.Object( name + '/numericizer1' ), self.Object( name + '/numericizer2' )
+
+
+    def Gazetteer( self ):
+        """
+        Returns
+        -------
+            gazetteer : compact_gazetteer
+                None if the bundle has none
+        """
+        if 'gazetteer/n_label_type' not in self.index:
+            return None
+        return compact_gazetteer( self.Array( 'gazetteer/hash' ),
+                                  self.Array( 'gazetteer/mask' ),
+                                  self.Object( 'gazetteer/n_label_type' ) )
+
+
+
+########################################################################
+
+
+def Pack( args ):
+    """
+    Writes the models, vocabularies and gazetteer server.py would be
+    given on the command line to args.output.
+    """
+    from fofe_ner_wrapper import VocabularyLayers
+    from NumpyUtil import LoadCheckpoint
+
+    writer = bundle_writer( args.output )
+    sources = dict( (k, v) for k, v in vars( args ).items() if k != 'func' )
+    writer.AddObject( 'manifest', { 'created': time.time(), 'sources': sources } )
+
+    shared = None
+    for name, model in zip( pass_names, [ args.model1st, args.model2nd, args.cascade ] ):
+        if model is None:
+            continue
+        mention_net = LoadCheckpoint( model )
+        config = mention_net.config
+        writer.AddObject( name + '/config', dict( config.__dict__ ) )
+        for role, array in mention_net.ExportArrays().items():
+            writer.AddArray( name + '/' + role, array )
+        del mention_net
+
+        if name != 'cascade':
+            layers = VocabularyLayers(
+                args.vocab1, args.vocab2, config.char_alpha, args.wubi,
+                n_label_type = config.n_label_type if name == 'pass2' else None
+            )
+            numericizers = [ numericizer for numericizer, _ in layers ]
+            if name == 'pass1':
+                shared = numericizers
+            if name == 'pass2' and all( a is b for a, b in zip( numericizers, shared ) ):
+                # same index as the 1st pass, only the label rows are added
+                for i, (_, rows) in enumerate( layers ):
+                    writer.AddObject( '%s/labels%d' % (name, i + 1), rows )
+            else:
+                for i, (numericizer, rows) in enumerate( layers ):
+                    if rows is not None:
+                        numericizer = LayerLabels( numericizer, rows )
+                    writer.AddObject( '%s/numericizer%d' % (name, i + 1), numericizer )
+        logger.info( '%s packed from %s' % (name, model) )
+
+    if args.gazetteer is not None:
+        gazetteer = LoadGazetteer( args.gazetteer )
+        if isinstance( gazetteer, compact_gazetteer ):
+            hashes, mask = gazetteer.hash, gazetteer.mask
+        else:
+            hashes, mask = GazetteerArrays( gazetteer )
+        writer.AddArray( 'gazetteer/hash', hashes )
+        writer.AddArray( 'gazetteer/mask', mask )
+        writer.AddObject( 'gazetteer/n_label_type', len(gazetteer) )
+        logger.info( 'gazetteer packed from %s' % args.gazetteer )
+
+    writer.Close()
+    logger.info( '%s written, %d bytes' % (args.output, os.path.getsize( args.output )) )
+
+
+def Info( args ):
+    bundle = model_bundle( args.bundle )
+    print( '%s: version %d' % (args.bundle, bundle.version) )
+    for name in bundle.Names():
+        kind, offset, length, dtype, shape = bundle.index[name]
+        if kind == 'array':
+            print( '%-32s %10d %12d  %s %s' % (name, offset, length, dtype, str(shape)) )
+        else:
+            print( '%-32s %10d %12d  pickle' % (name, offset, length) )
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig( format = '%(asctime)s : %(levelname)s : %(message)s',
+                         level = logging.INFO )
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    pack = subparsers.add_parser( 'pack',
+        help = 'pack the models, vocabularies and gazetteer of one server.py deployment into a bundle' )
+    pack.add_argument( 'model1st', type = str, help = 'basename of model trained for 1st pass' )
+    pack.add_argument( 'vocab1', type = str,
+                       help = 'case-insensitive word-vector for {eng,spa} or word-vector for cmn' )
+    pack.add_argument( 'vocab2', type = str,
+                       help = 'case-sensitive word-vector for {eng,spa} or char-vector for cmn' )
+    pack.add_argument( 'output', type = str, help = 'the bundle to write' )
+    pack.add_argument( '--model2nd', type = str, default = None )
+    pack.add_argument( '--cascade', type = str, default = None )
+    pack.add_argument( '--gazetteer', type = str, default = None,
+                       help = 'pickled gazetteer, or the directory `ServingUtil.py gazetteer` converts it to' )
+    pack.add_argument( '--wubi', type = str, default = None )
+    pack.set_defaults( func = Pack )
+
+    info = subparsers.add_parser( 'info', help = 'list the sections of a bundle' )
+    info.add_argument( 'bundle', type = str )
+    info.set_defaults( func = Info )
+
+    args = parser.parse_args()
+    args.func( args )
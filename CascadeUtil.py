@@ -0,0 +1,259 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Two-stage cascade for the 1st pass: a small fofe_mention_net, e.g. on 
+case-insensitive FOFE only with one narrow layer, scores every span of a 
+mini-batch and only the spans it can't rule out reach the main network.
+The threshold is calibrated against the main network, so that the cascade 
+keeps a chosen fraction of the spans the main network labels as mentions.
+"""
+
+import numpy, os, time, json, codecs, cPickle, argparse, logging
+from MiniBatchUtil import MiniBatchSize, SliceMiniBatch
+from PredictionUtil import BatchDecode
+
+logger = logging.getLogger( __name__ )
+
+
+def CascadeFilter( cascade, mini_batch, threshold, n_label_type ):
+    """
+    Returns
+    -------
+        survivors : ndarray
+            rows whose probability of not being O is at least threshold
+        prob : ndarray
+            output of the cascade model
+    """
+    _, _, prob = cascade.eval( mini_batch )
+    survivors = numpy.flatnonzero( 1 - prob[:, n_label_type] >= threshold )
+    return survivors, prob
+
+
+def MergeCascade( survivors, cascade_prob, pi, pv, n_label_type ):
+    """
+    Returns
+    -------
+        pi, pv : ndarray
+            estimated label and class probabilities of every row; rows the
+            cascade rejected are O, with the cascade's probabilities
+    """
+    full_pi = numpy.empty( cascade_prob.shape[0], dtype = numpy.int64 )
+    full_pi.fill( n_label_type )
+    full_pv = cascade_prob.copy()
+    if survivors.shape[0] > 0:
+        full_pi[survivors] = pi
+        full_pv[survivors] = pv
+    return full_pi, full_pv
+
+
+########################################################################
+
+
+def LoadSentences( filename ):
+    """
+    One JSON object per line: {"sentence": [tokens], "mentions": [[begin,
+    end, label], ...]}, where end is exclusive and mentions are optional.
+
+    Returns
+    -------
+        raw : list
+            (sentence, boe, eoe, coe) as batch_constructor takes them
+    """
+    raw = []
+    with codecs.open( filename, 'rb', 'utf8' ) as fp:
+        for line in fp:
+            if len( line.strip() ) == 0:
+                continue
+            example = json.loads( line )
+            mentions = example.get( 'mentions', [] )
+            raw.append( ( example['sentence'],
+                          [ m[0] for m in mentions ],
+                          [ m[1] for m in mentions ],
+                          [ m[2] for m in mentions ] ) )
+    return raw
+
+
+def LoadConfig( basename ):
+    from fofe_mention_net import mention_config
+    config = mention_config()
+    with open( '%s.config' % basename, 'rb' ) as fp:
+        config.__dict__.update( cPickle.load( fp ).__dict__ )
+    return config
+
+
+def Features( raw, config, args ):
+    from fofe_ner_wrapper import LoadVocabulary
+    from gigaword2feature import batch_constructor
+
+    numericizer1, numericizer2 = LoadVocabulary( args.vocab1, args.vocab2,
+                                                 config.char_alpha, args.wubi )
+    return batch_constructor(
+        raw,
+        numericizer1,
+        numericizer2,
+        gazetteer = [set()] * config.n_label_type,
+        alpha = config.word_alpha,
+        window = config.n_window,
+        n_label_type = config.n_label_type,
+        language = config.language
+    )
+
+
+def Train( args ):
+    from fofe_mention_net import fofe_mention_net
+
+    # same window, label set and FOFE settings as the model it guards
+    config = LoadConfig( args.model1st )
+    config.feature_choice = args.feature_choice
+    config.layer_size = args.layer_size
+    config.word_embedding = args.word_embedding
+    config.hope_out = 0
+    config.is_2nd_pass = False
+    config.cascade_threshold = 0.
+
+    data = Features( LoadSentences( args.train ), config, args )
+    cascade = fofe_mention_net( config )
+
+    for n_epoch in xrange( args.max_iter ):
+        cost = [ cascade.train( mini_batch ) for mini_batch in \
+                 data.mini_batch( config.n_batch_size,
+                                  shuffle_needed = True,
+                                  overlap_rate = config.overlap_rate,
+                                  disjoint_rate = config.disjoint_rate,
+                                  feature_choice = config.feature_choice ) ]
+        logger.info( 'epoch %d, average cross-entropy %f' % (n_epoch, numpy.mean( cost )) )
+
+    cascade.tofile( args.cascade )
+    logger.info( 'cascade model saved to %s; run calibrate before serving it' % args.cascade )
+
+
+def Calibrate( args ):
+    """
+    Picks the threshold that keeps --recall of the spans the main 1st-pass
+    model labels as mentions, then reports what the cascade costs and saves.
+    """
+    from fofe_mention_net import fofe_mention_net
+    from fofe_ner_wrapper import LoadServingTables
+
+    config = LoadConfig( args.model1st )
+    n_label_type = config.n_label_type
+    main = fofe_mention_net( config, None, inference_only = True,
+                             tables = LoadServingTables( args.model1st ) )
+    main.fromfile( args.model1st )
+    cascade_config = LoadConfig( args.cascade )
+    cascade = fofe_mention_net( cascade_config, None, inference_only = True,
+                                tables = LoadServingTables( args.cascade ) )
+    cascade.fromfile( args.cascade )
+
+    raw = LoadSentences( args.dev )
+    data = Features( raw, config, args )
+    mini_batches = list( data.mini_batch_multi_thread( 2560, False, 1, 1, config.feature_choice ) )
+
+    # every span through both models
+    main_time, cascade_time, main_prob, cascade_prob = 0., 0., [], []
+    for mini_batch in mini_batches:
+        start = time.time()
+        _, pi, pv = main.eval( mini_batch )
+        main_time += time.time() - start
+        main_prob.append( (pi, pv) )
+
+        start = time.time()
+        _, _, pv = cascade.eval( mini_batch )
+        cascade_time += time.time() - start
+        cascade_prob.append( pv )
+
+    positive = numpy.concatenate( [ pi for pi, _ in main_prob ] ) != n_label_type
+    score = 1 - numpy.concatenate( cascade_prob )[:, n_label_type]
+    if positive.any():
+        ranked = numpy.sort( score[positive] )
+        threshold = float( ranked[ int( numpy.floor( (1 - args.recall) * ranked.shape[0] ) ) ] )
+    else:
+        threshold = 0.
+        logger.warning( 'the main model finds no mention in %s' % args.dev )
+
+    # the cascade as served: the main model only sees the survivors
+    survived, served_time, served = 0, 0., []
+    for mini_batch, pv in zip( mini_batches, cascade_prob ):
+        survivors = numpy.flatnonzero( 1 - pv[:, n_label_type] >= threshold )
+        survived += survivors.shape[0]
+        start = time.time()
+        if survivors.shape[0] > 0:
+            _, pi, spv = main.eval( SliceMiniBatch( mini_batch, survivors ) )
+        else:
+            pi, spv = None, None
+        served_time += time.time() - start
+        served.append( MergeCascade( survivors, pv, pi, spv, n_label_type ) )
+
+    def Decode( results ):
+        pi = numpy.concatenate( [ r[0] for r in results ] )
+        pv = numpy.concatenate( [ r[1] for r in results ] )
+        prob = numpy.zeros( (pi.shape[0], 2 + pv.shape[1]), dtype = numpy.float32 )
+        prob[:,1] = pi
+        prob[:,2:] = pv
+        decoded = BatchDecode( [ len(r[0]) for r in raw ], prob, config.n_window,
+                               config.threshold, config.algorithm, n_label_type,
+                               sentences = [ r[0] for r in raw ] )
+        return set( (i, b, e, c) for i, d in enumerate( decoded ) for b, e, c in zip(*d) )
+
+    expected, actual = Decode( main_prob ), Decode( served )
+    n_span = score.shape[0]
+
+    logger.info( 'threshold: %f for a span recall of %f' % (threshold, args.recall) )
+    logger.info( 'spans: %d, reaching the main model: %d (%.2f%%)' % \
+                 (n_span, survived, 100. * survived / max( n_span, 1 )) )
+    logger.info( 'mention recall after decoding: %d / %d (%.4f)' % \
+                 ( len(expected & actual), len(expected),
+                   float( len(expected & actual) ) / max( len(expected), 1 ) ) )
+    logger.info( 'mentions found only with the cascade: %d' % len(actual - expected) )
+    logger.info( 'network time: %.3fs without cascade, %.3fs with it (%.3fs cascade), speedup %.2fx' % \
+                 ( main_time, cascade_time + served_time, cascade_time,
+                   main_time / max( cascade_time + served_time, 1e-9 ) ) )
+
+    if not args.dry_run:
+        cascade_config.cascade_threshold = threshold
+        with open( args.cascade + '.config', 'wb' ) as fp:
+            cPickle.dump( cascade_config, fp )
+        logger.info( 'threshold saved to %s.config' % args.cascade )
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig( format = '%(asctime)s : %(levelname)s : %(message)s',
+                         level = logging.INFO )
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    def Common( subparser ):
+        subparser.add_argument( 'model1st', type = str, help = 'basename of the 1st-pass model' )
+        subparser.add_argument( 'vocab1', type = str, help = 'same as server.py' )
+        subparser.add_argument( 'vocab2', type = str, help = 'same as server.py' )
+        subparser.add_argument( 'cascade', type = str, help = 'basename of the cascade model' )
+        subparser.add_argument( '--wubi', type = str, default = None )
+
+    train = subparsers.add_parser( 'train', help = 'train a cascade model for a 1st-pass model' )
+    Common( train )
+    train.add_argument( 'train', type = str,
+                        help = 'JSON lines of {"sentence": [...], "mentions": [[begin, end, label]]}' )
+    train.add_argument( 'word_embedding', type = str,
+                        help = 'basename of the word2vec files, as in mention_config.word_embedding' )
+    train.add_argument( '--feature-choice', type = int, default = 1,
+                        help = 'features of the cascade model; 1 is case-insensitive FOFE with focus' )
+    train.add_argument( '--layer-size', type = str, default = '64' )
+    train.add_argument( '--max-iter', type = int, default = 16 )
+    train.set_defaults( func = Train )
+
+    calibrate = subparsers.add_parser( 'calibrate',
+        help = 'pick the threshold of a cascade model and report recall loss and speedup' )
+    Common( calibrate )
+    calibrate.add_argument( 'dev', type = str,
+                            help = 'JSON lines of {"sentence": [...]}; mentions are not needed' )
+    calibrate.add_argument( '--recall', type = float, default = 0.995,
+                            help = "fraction of the main model's mention spans the cascade must keep" )
+    calibrate.add_argument( '--dry-run', action = 'store_true', default = False,
+                            help = 'only report, leave the config as it is' )
+    calibrate.set_defaults( func = Calibrate )
+
+    args = parser.parse_args()
+    args.func( args )
+
@@ -0,0 +1,654 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Inference-time replacement of batch_constructor for the word-level features
+(feature bits 0 to 5): the left FOFE code of a span only depends on where
+its left context ends and the right code on where its right context starts,
+so a sentence of n words has n + 1 codes per side however many spans it
+has. They are laid out once per sentence and every span's row is gathered
+from them with vectorized indexing, instead of running the recurrence
+z_t = alpha * z_{t-1} + e_t over the context of each span again. The
+character, gazetteer and conv features (bits 6 to 9) still come from
+batch_constructor, run with the word bits masked out.
+"""
+
+import numpy, logging
+from PredictionUtil import DocumentSpanIndex
+from MiniBatchUtil import ConcatMiniBatch, sparse_indices, sparse_values
+
+logger = logging.getLogger( __name__ )
+
+
+# feature bits fofe_builder produces, see fofe_mention_net.DetermineLayerSize
+builder_bits = (1 << 6) - 1
+
+# char, initial, gazetteer and conv: dense_feature and conv_idx, which
+# fofe_document takes from batch_constructor
+constructor_bits = (1 << 10) - 1 - builder_bits
+
+
+def Supported( feature_choice ):
+    return feature_choice & ~(builder_bits | constructor_bits) == 0
+
+
+def _Expand( first, count ):
+    """
+    Returns
+    -------
+        owner : ndarray
+            i of every position first[i], ..., first[i] + count[i] - 1
+        within : ndarray
+            offset of every position from its first[i]
+        position : ndarray
+    """
+    owner = numpy.repeat( numpy.arange( count.shape[0] ), count )
+    within = numpy.arange( owner.shape[0] ) - \
+             numpy.repeat( numpy.cumsum( count ) - count, count )
+    return owner, within, first[owner] + within
+
+
+
+class _codes( object ):
+    """
+    Word indices of a document in one vocabulary, every sentence wrapped in
+    its begin and end word: [bos] w_0 ... w_{n-1} [eos].
+    """
+    def __init__( self, ids, boundary ):
+        bos, eos = boundary
+        self.head = 0 if bos is None else 1
+        self.tail = 0 if eos is None else 1
+        self.n_word = numpy.asarray( [ len(x) for x in ids ], dtype = numpy.int64 )
+
+        pieces = []
+        for x in ids:
+            if bos is not None:
+                pieces.append( [ bos ] )
+            pieces.append( x )
+            if eos is not None:
+                pieces.append( [ eos ] )
+        self.word = numpy.concatenate(
+            [ numpy.asarray( p, dtype = numpy.int64 ) for p in pieces ] + \
+            [ numpy.zeros( 0, dtype = numpy.int64 ) ]
+        )
+        length = self.n_word + self.head + self.tail
+        self.start = numpy.cumsum( length ) - length
+
+
+
+class fofe_builder( object ):
+    """
+    Builds the mini-batches batch_constructor.mini_batch_multi_thread yields
+    for inference, as long as the feature choice is Supported. Use
+    ProbeBuilder to set it up, which checks it against batch_constructor.
+    """
+    # fields of dense_feature and conv_idx in the mini-batch
+    constructor_fields = ( 18, 19 )
+
+    def __init__( self, numericizer1, numericizer2, alpha, window, n_label_type,
+                  boundary1 = (None, None), boundary2 = (None, None),
+                  focus_first = True, min_weight = 0., gazetteer = None,
+                  language = 'eng' ):
+        """
+        Parameters
+        ----------
+            numericizer1, numericizer2 : vocabulary
+                case-insensitive & case-sensitive
+            boundary1, boundary2 : tuple
+                index of the sentence-begin and sentence-end word in each
+                vocabulary, None where the codes have none
+            focus_first : bool
+                if True, l1/r1 & l3/r3 include the focus words and l2/r2 &
+                l4/r4 don't; the other way round otherwise
+            min_weight : float
+                context words weighing less are left out, which bounds the
+                size of a code; 0 keeps all, like batch_constructor
+            gazetteer, language
+                passed to batch_constructor for the constructor_bits;
+                no gazetteer means an empty one
+        """
+        self.numericizer = [ numericizer1, numericizer2 ]
+        self.boundary = [ boundary1, boundary2 ]
+        self.alpha = alpha
+        self.window = window
+        self.n_label_type = n_label_type
+        self.focus_first = focus_first
+        self.min_weight = min_weight
+        self.gazetteer = gazetteer if gazetteer is not None else [ set() ] * n_label_type
+        self.language = language
+
+        if min_weight > 0 and alpha < 1:
+            self.n_kept = int( numpy.floor( numpy.log( min_weight ) / numpy.log( alpha ) ) ) + 1
+        else:
+            self.n_kept = None
+        self.power = numpy.zeros( 0, dtype = numpy.float32 )
+
+
+    def __Power( self, n ):
+        if self.power.shape[0] < n:
+            self.power = (self.alpha ** numpy.arange( max( n, 128 ) )).astype( numpy.float32 )
+        return self.power
+
+
+    def __Left( self, codes, sentence, end ):
+        """
+        Code of the words before end: word j weighs alpha ** (end - 1 - j).
+        """
+        count = codes.head + end
+        if self.n_kept is not None:
+            count = numpy.minimum( count, self.n_kept )
+        owner, within, position = _Expand( codes.start[sentence] + codes.head + end - count, count )
+        power = self.__Power( int( count.max() ) if count.shape[0] > 0 else 0 )
+        indices = numpy.column_stack( ( owner, codes.word[position] ) )
+        return power[count[owner] - 1 - within], indices
+
+
+    def __Right( self, codes, sentence, begin ):
+        """
+        Code of the words from begin on: word j weighs alpha ** (j - begin).
+        """
+        count = codes.n_word[sentence] - begin + codes.tail
+        if self.n_kept is not None:
+            count = numpy.minimum( count, self.n_kept )
+        owner, within, position = _Expand( codes.start[sentence] + codes.head + begin, count )
+        power = self.__Power( int( count.max() ) if count.shape[0] > 0 else 0 )
+        indices = numpy.column_stack( ( owner, codes.word[position] ) )
+        return power[within], indices
+
+
+    def __Bow( self, codes, sentence, begin, end ):
+        owner, _, position = _Expand( codes.start[sentence] + codes.head + begin, end - begin )
+        return numpy.column_stack( ( owner, codes.word[position] ) )
+
+
+    def Codes( self, sentences ):
+        """
+        Returns
+        -------
+            codes : list
+                the word indices of sentences in each vocabulary
+        """
+        return [ _codes( [ n.sentence2indices( s ) for s in sentences ], b )
+                 for n, b in zip( self.numericizer, self.boundary ) ]
+
+
+    def Constructor( self, sentences ):
+        """
+        Returns
+        -------
+            data : batch_constructor
+                of sentences, for the features of the constructor_bits
+        """
+        from gigaword2feature import batch_constructor
+        return batch_constructor(
+            [ (s, [], [], []) for s in sentences ],
+            self.numericizer[0],
+            self.numericizer[1],
+            gazetteer = self.gazetteer,
+            alpha = self.alpha,
+            window = self.window,
+            n_label_type = self.n_label_type,
+            language = self.language
+        )
+
+
+    def MiniBatch( self, codes, sentence, begin, end, feature_choice ):
+        """
+        Parameters
+        ----------
+            codes : list
+                returned by Codes
+            sentence, begin, end : ndarray
+                one span per example
+
+        Returns
+        -------
+            mini_batch : tuple
+                laid out as fofe_mention_net.eval unpacks it; dense_feature
+                and conv_idx are zeros, see fofe_document
+        """
+        assert Supported( feature_choice )
+        n = sentence.shape[0]
+        no_values = numpy.zeros( 0, dtype = numpy.float32 )
+        no_indices = numpy.zeros( (0, 2), dtype = numpy.int64 )
+        result = [ no_values ] * 25
+        for i in sparse_indices:
+            result[i] = no_indices
+
+        # (bit, vocabulary, includes focus, left values, right values,
+        #  left indices, right indices)
+        pairs = [ (0, 0, self.focus_first, 0, 1, 2, 3),
+                  (1, 0, not self.focus_first, 4, 5, 6, 7),
+                  (3, 1, self.focus_first, 9, 10, 11, 12),
+                  (4, 1, not self.focus_first, 13, 14, 15, 16) ]
+        for bit, v, focus, lv, rv, li, ri in pairs:
+            if (1 << bit) & feature_choice > 0:
+                result[lv], result[li] = self.__Left( codes[v], sentence,
+                                                      end if focus else begin )
+                result[rv], result[ri] = self.__Right( codes[v], sentence,
+                                                       begin if focus else end )
+
+        for bit, v, field in [ (2, 0, 8), (5, 1, 17) ]:
+            if (1 << bit) & feature_choice > 0:
+                result[field] = self.__Bow( codes[v], sentence, begin, end )
+
+        # character, gazetteer and conv placeholders still need their shapes
+        result[18] = numpy.zeros( (n, 512 + self.n_label_type + 1), dtype = numpy.float32 )
+        result[19] = numpy.zeros( (n, 1), dtype = numpy.int32 )
+        result[24] = numpy.empty( n, dtype = numpy.int64 )
+        result[24].fill( self.n_label_type )
+        return tuple( result )
+
+
+    def document( self, sentences ):
+        """
+        Returns
+        -------
+            data : fofe_document
+                used in place of batch_constructor( [(s, [], [], []) for s
+                in sentences], ... )
+        """
+        return fofe_document( self, sentences )
+
+
+
+class fofe_document( object ):
+    def __init__( self, builder, sentences ):
+        self.builder = builder
+        self.sentences = sentences
+        self.codes = builder.Codes( sentences )
+        self.sentence, self.begin, self.end = DocumentSpanIndex(
+            [ len(s) for s in sentences ], builder.window
+        )
+
+    def __str__( self ):
+        return 'fofe_document: %d spans' % self.sentence.shape[0]
+
+    def mini_batch_multi_thread( self, n_batch_size, shuffle_needed,
+                                 overlap_rate, disjoint_rate, feature_choice ):
+        """
+        Same signature as batch_constructor's; there is no label, so all
+        spans are kept in order whatever the rates are.
+        """
+        assert not shuffle_needed
+        other = feature_choice & constructor_bits
+        if other == 0:
+            for first in xrange( 0, self.sentence.shape[0], n_batch_size ):
+                last = first + n_batch_size
+                yield self.builder.MiniBatch( self.codes,
+                                              self.sentence[first:last],
+                                              self.begin[first:last],
+                                              self.end[first:last],
+                                              feature_choice )
+            return
+
+        # batch_constructor lists the spans in the same order; its rows of
+        # dense_feature and conv_idx replace the placeholders
+        dense, conv = self.builder.constructor_fields
+        first = 0
+        for features in self.builder.Constructor( self.sentences ).\
+                mini_batch_multi_thread( n_batch_size, False, overlap_rate,
+                                         disjoint_rate, other ):
+            last = first + features[-1].shape[0]
+            assert last <= self.sentence.shape[0], 'batch_constructor has more spans'
+            mini_batch = list( self.builder.MiniBatch( self.codes,
+                                                       self.sentence[first:last],
+                                                       self.begin[first:last],
+                                                       self.end[first:last],
+                                                       feature_choice & builder_bits ) )
+            mini_batch[dense], mini_batch[conv] = features[18], features[19]
+            yield tuple( mini_batch )
+            first = last
+        assert first == self.sentence.shape[0], 'batch_constructor has fewer spans'
+
+
+
+class _projected_codes( object ):
+    """
+    FOFE codes of every sentence of a document multiplied by an embedding
+    table, computed with the recurrence itself, one word position at a time
+    for all sentences at once. State t of a sentence covers the first t
+    (left) or all but the first t (right) of [bos] w_0 ... w_{n-1} [eos].
+    """
+    def __init__( self, codes, embedding, alpha, n_kept ):
+        self.head = codes.head
+        length = codes.n_word + codes.head + codes.tail
+        self.offset = numpy.cumsum( length + 1 ) - (length + 1)
+        n_state = int( (length + 1).sum() )
+        n_max = int( length.max() ) if length.shape[0] > 0 else 0
+
+        self.left = numpy.zeros( (n_state, embedding.shape[1]), dtype = numpy.float64 )
+        self.right = numpy.zeros( (n_state, embedding.shape[1]), dtype = numpy.float64 )
+        self.bow = numpy.zeros( (n_state, embedding.shape[1]), dtype = numpy.float64 )
+
+        for t in xrange( n_max ):
+            active = numpy.flatnonzero( length > t )
+            state = self.offset[active] + t
+            projected = embedding[codes.word[codes.start[active] + t]]
+            self.left[state + 1] = alpha * self.left[state] + projected
+            self.bow[state + 1] = self.bow[state] + projected
+
+        for t in xrange( n_max - 1, -1, -1 ):
+            active = numpy.flatnonzero( length > t )
+            state = self.offset[active] + t
+            projected = embedding[codes.word[codes.start[active] + t]]
+            self.right[state] = alpha * self.right[state + 1] + projected
+
+        # drop what the words beyond n_kept contribute
+        if n_kept is not None:
+            within = numpy.arange( n_state ) - numpy.repeat( self.offset, length + 1 )
+            late = numpy.flatnonzero( within >= n_kept )
+            self.left[late] -= alpha ** n_kept * self.left[late - n_kept]
+            early = numpy.flatnonzero( within + n_kept <= numpy.repeat( length, length + 1 ) )
+            self.right[early] -= alpha ** n_kept * self.right[early + n_kept]
+
+
+
+class projected_builder( object ):
+    """
+    Builds the mini-batches fofe_mention_net.eval takes in projected mode:
+    the same features as fofe_builder, times the word embeddings. The codes
+    of a sentence are projected once, so a span costs a few row copies of 
+    the embedding width instead of one sparse row per context word.
+    """
+    constructor_fields = ( 10, 11 )
+
+    def __init__( self, builder, word_embedding_1, word_embedding_2 ):
+        """
+        Parameters
+        ----------
+            builder : fofe_builder
+                e.g. returned by ProbeBuilder
+            word_embedding_1, word_embedding_2 : ndarray
+                see fofe_mention_net.WordEmbedding
+        """
+        self.builder = builder
+        self.embedding = [ word_embedding_1, word_embedding_2 ]
+        self.window = builder.window
+
+
+    def Constructor( self, sentences ):
+        return self.builder.Constructor( sentences )
+
+
+    def Codes( self, sentences ):
+        return [ _projected_codes( c, e, self.builder.alpha, self.builder.n_kept )
+                 for c, e in zip( self.builder.Codes( sentences ), self.embedding ) ]
+
+
+    def MiniBatch( self, codes, sentence, begin, end, feature_choice ):
+        """
+        Returns
+        -------
+            mini_batch : tuple
+                in the projected layout of MiniBatchUtil
+        """
+        assert Supported( feature_choice )
+        n = sentence.shape[0]
+        result = [ None ] * 13
+
+        focus_first = self.builder.focus_first
+        pairs = [ (0, 0, focus_first, 0, 1), (1, 0, not focus_first, 2, 3),
+                  (3, 1, focus_first, 5, 6), (4, 1, not focus_first, 7, 8) ]
+        for bit, v, focus, l, r in pairs:
+            if (1 << bit) & feature_choice > 0:
+                c = codes[v]
+                first = c.offset[sentence] + c.head
+                result[l] = c.left[first + (end if focus else begin)].astype( numpy.float32 )
+                result[r] = c.right[first + (begin if focus else end)].astype( numpy.float32 )
+
+        for bit, v, field in [ (2, 0, 4), (5, 1, 9) ]:
+            if (1 << bit) & feature_choice > 0:
+                c = codes[v]
+                first = c.offset[sentence] + c.head
+                result[field] = (c.bow[first + end] - c.bow[first + begin]).astype( numpy.float32 )
+
+        for i in xrange( 10 ):
+            if result[i] is None:
+                result[i] = numpy.zeros( (n, 0), dtype = numpy.float32 )
+
+        result[10] = numpy.zeros( (n, 512 + self.builder.n_label_type + 1), dtype = numpy.float32 )
+        result[11] = numpy.zeros( (n, 1), dtype = numpy.int32 )
+        result[12] = numpy.empty( n, dtype = numpy.int64 )
+        result[12].fill( self.builder.n_label_type )
+        return tuple( result )
+
+
+    def document( self, sentences ):
+        return fofe_document( self, sentences )
+
+
+
+########################################################################
+
+
+def _Entries( mini_batch, i, v, n_column ):
+    """
+    Returns
+    -------
+        key, value : ndarray
+            flattened (row, column) and the summed value of each distinct
+            sparse coordinate of field i
+    """
+    indices = mini_batch[i]
+    values = numpy.ones( indices.shape[0] ) if v is None else mini_batch[v]
+    key, inverse = numpy.unique( indices[:,0] * n_column + indices[:,1],
+                                 return_inverse = True )
+    return key, numpy.bincount( inverse, weights = values, minlength = key.shape[0] )
+
+
+def SameMiniBatch( a, b, feature_choice, rtol = 1e-5, atol = 1e-6 ):
+    """
+    Whether two mini-batches carry the same features, regardless of the
+    order of the sparse coordinates.
+    """
+    if a[-1].shape[0] != b[-1].shape[0] or not (a[-1] == b[-1]).all():
+        return False
+
+    bits = [ 0, 0, 0, 0, 2, 3, 3, 4, 4, 5, 10, 10 ]
+    for i, v, bit in zip( sparse_indices, sparse_values, bits ):
+        if (1 << bit) & feature_choice == 0:
+            continue
+        n_column = max( [ int( mb[i][:,1].max() ) + 1 for mb in (a, b)
+                          if mb[i].shape[0] > 0 ] + [ 1 ] )
+        key_a, value_a = _Entries( a, i, v, n_column )
+        key_b, value_b = _Entries( b, i, v, n_column )
+        if key_a.shape != key_b.shape or not (key_a == key_b).all() or \
+                not numpy.allclose( value_a, value_b, rtol = rtol, atol = atol ):
+            return False
+
+    if feature_choice & constructor_bits > 0:
+        if a[18].shape != b[18].shape or a[19].shape != b[19].shape or \
+                not numpy.allclose( a[18], b[18], rtol = rtol, atol = atol ) or \
+                not (a[19] == b[19]).all():
+            return False
+    return True
+
+
+# covers capitalization, punctuation and sentence-long contexts
+probe_sentence = u'The European Commission said on Thursday it disagreed with ' \
+                 u'German advice to consumers to shun British lamb until ' \
+                 u'scientists determine whether mad cow disease can be ' \
+                 u'transmitted to sheep .'
+
+
+def ProbeBuilder( numericizer1, numericizer2, alpha, window, n_label_type,
+                  language, feature_choice, min_weight = 0., gazetteer = None ):
+    """
+    Works out how batch_constructor pads contexts and which pair of codes
+    includes the focus words, from its features of a probe sentence, and
+    returns a fofe_builder only if it gives the same features, including
+    those of the constructor_bits it still takes from batch_constructor.
+
+    Parameters
+    ----------
+        gazetteer
+            what the returned builder passes to batch_constructor; the
+            probe runs with an empty one
+
+    Returns
+    -------
+        builder : fofe_builder
+            None if the feature choice or language is not supported, or
+            the probe doesn't match
+    """
+    if not Supported( feature_choice ) or language not in [ 'eng', 'spa' ]:
+        logger.info( 'fofe_builder: not used for feature choice %d in %s' % \
+                     (feature_choice, language) )
+        return None
+
+    from gigaword2feature import batch_constructor
+
+    probe = probe_sentence.split()
+    try:
+        data = batch_constructor(
+            [ (probe, [], [], []) ],
+            numericizer1,
+            numericizer2,
+            gazetteer = [ set() ] * n_label_type,
+            alpha = alpha,
+            window = window,
+            n_label_type = n_label_type,
+            language = language
+        )
+        reference = ConcatMiniBatch( list( data.mini_batch_multi_thread(
+            2560, False, 1, 1, feature_choice ) ) )
+
+        # the contexts of the 1st span start with the begin word if there is
+        # one, those of the last span end with the end word
+        boundary = []
+        for v, fields in enumerate( [ (0, 1), (3, 4) ] ):
+            ids = set( numericizer1.sentence2indices( probe ) if v == 0 else \
+                       numericizer2.sentence2indices( probe ) )
+            bos, eos = set(), set()
+            for bit, (li, ri) in zip( fields, [ (2, 3), (6, 7) ] if v == 0 else \
+                                              [ (11, 12), (15, 16) ] ):
+                if (1 << bit) & feature_choice > 0:
+                    left, right = reference[li], reference[ri]
+                    bos |= set( left[left[:,0] == 0, 1].tolist() ) - ids
+                    eos |= set( right[right[:,0] == reference[-1].shape[0] - 1, 1].tolist() ) - ids
+            if len(bos) > 1 or len(eos) > 1:
+                logger.warning( 'fofe_builder: ambiguous boundary words %s %s' % \
+                                (str(bos), str(eos)) )
+                return None
+            boundary.append( ( bos.pop() if len(bos) > 0 else None,
+                               eos.pop() if len(eos) > 0 else None ) )
+
+        for focus_first in [ True, False ]:
+            builder = fofe_builder( numericizer1, numericizer2, alpha, window,
+                                    n_label_type, boundary[0], boundary[1],
+                                    focus_first, language = language )
+            features = ConcatMiniBatch( list( builder.document( [ probe ] ).\
+                mini_batch_multi_thread( 2560, False, 1, 1, feature_choice ) ) )
+            if SameMiniBatch( reference, features, feature_choice ):
+                logger.info( 'fofe_builder: boundary %s, focus first %s' % \
+                             (str(boundary), str(focus_first)) )
+                return fofe_builder( numericizer1, numericizer2, alpha, window,
+                                     n_label_type, boundary[0], boundary[1],
+                                     focus_first, min_weight, gazetteer, language )
+    except Exception:
+        logger.exception( 'fofe_builder: probe failed' )
+        return None
+
+    logger.warning( 'fofe_builder: features differ from batch_constructor, not used' )
+    return None
+
+
+
+# Unit Test
+if __name__ == '__main__':
+    # brute force: every span runs the recurrence over its own context
+    def Reference( ids, window, alpha, bos, eos, focus_first, n_label_type ):
+        rows = []
+        for s in ids:
+            n = len(s)
+            left = ( [] if bos is None else [ bos ] ) + list( s )
+            right = list( s ) + ( [] if eos is None else [ eos ] )
+            h = len(left) - n
+            for b in xrange( n ):
+                for e in xrange( b + 1, min( n, b + window ) + 1 ):
+                    row = {}
+                    for name, focus in [ ('1', focus_first), ('2', not focus_first) ]:
+                        z = {}
+                        for w in left[:h + (e if focus else b)]:
+                            z = dict( (k, alpha * x) for k, x in z.items() )
+                            z[w] = z.get( w, 0 ) + 1
+                        row['l' + name] = z
+                        z = {}
+                        for w in reversed( right[(b if focus else e):] ):
+                            z = dict( (k, alpha * x) for k, x in z.items() )
+                            z[w] = z.get( w, 0 ) + 1
+                        row['r' + name] = z
+                    row['bow'] = s[b:e]
+                    rows.append( row )
+        return rows
+
+    rng = numpy.random.RandomState( 0 )
+    n_label_type, window, alpha = 4, 7, 0.5
+
+    class fake_vocabulary( object ):
+        def sentence2indices( self, s ):
+            return [ hash(w) % 50 for w in s ]
+
+    sentences = [ [ str(w) for w in rng.randint( 0, 100, n ) ]
+                  for n in [ 1, 3, 12, 7, 20 ] ]
+    ids = [ fake_vocabulary().sentence2indices( s ) for s in sentences ]
+
+    for bos, eos, focus_first in [ (50, 51, True), (None, None, False), (50, None, True) ]:
+        builder = fofe_builder( fake_vocabulary(), fake_vocabulary(), alpha, window,
+                                n_label_type, (bos, eos), (bos, eos), focus_first )
+        expected = Reference( ids, window, alpha, bos, eos, focus_first, n_label_type )
+        mini_batch = ConcatMiniBatch( list( builder.document( sentences ).\
+                mini_batch_multi_thread( 17, False, 1, 1, builder_bits ) ) )
+        assert mini_batch[-1].shape[0] == len(expected)
+
+        for (vi, ii), name in zip( [ (0, 2), (1, 3), (4, 6), (5, 7),
+                                     (9, 11), (10, 12), (13, 15), (14, 16) ],
+                                   [ 'l1', 'r1', 'l2', 'r2' ] * 2 ):
+            got = [ {} for _ in expected ]
+            for (r, w), x in zip( mini_batch[ii].tolist(), mini_batch[vi].tolist() ):
+                got[r][w] = got[r].get( w, 0 ) + x
+            for g, e in zip( got, expected ):
+                assert sorted( g.keys() ) == sorted( e[name].keys() )
+                assert all( abs( g[k] - e[name][k] ) < 1e-6 for k in g )
+
+        for ii in [ 8, 17 ]:
+            got = [ [] for _ in expected ]
+            for r, w in mini_batch[ii].tolist():
+                got[r].append( w )
+            assert all( g == list( e['bow'] ) for g, e in zip( got, expected ) )
+
+        # order-insensitive comparison against itself, permuted
+        permuted = list( mini_batch )
+        order = rng.permutation( mini_batch[2].shape[0] )
+        permuted[0], permuted[2] = mini_batch[0][order], mini_batch[2][order]
+        assert SameMiniBatch( mini_batch, tuple( permuted ), builder_bits )
+        permuted[0] = permuted[0] * 1.01
+        assert not SameMiniBatch( mini_batch, tuple( permuted ), builder_bits )
+
+    # truncated codes keep the words weighing at least min_weight
+    builder = fofe_builder( fake_vocabulary(), fake_vocabulary(), alpha, window,
+                            n_label_type, (50, 51), (50, 51), True, min_weight = 0.01 )
+    mini_batch = ConcatMiniBatch( list( builder.document( sentences ).\
+            mini_batch_multi_thread( 2560, False, 1, 1, 1 ) ) )
+    assert mini_batch[0].min() >= 0.01 and mini_batch[0].shape[0] > 0
+    assert numpy.bincount( mini_batch[2][:,0] ).max() == 7
+
+    # projected codes equal the sparse ones times the embedding
+    embedding = rng.rand( 52, 6 ).astype( numpy.float32 )
+    for min_weight in [ 0., 0.01 ]:
+        builder = fofe_builder( fake_vocabulary(), fake_vocabulary(), alpha, window,
+                                n_label_type, (50, 51), (None, 51), False, min_weight )
+        projected = projected_builder( builder, embedding, embedding )
+        sparse = ConcatMiniBatch( list( builder.document( sentences ).\
+                mini_batch_multi_thread( 2560, False, 1, 1, builder_bits ) ) )
+        dense = ConcatMiniBatch( list( projected.document( sentences ).\
+                mini_batch_multi_thread( 11, False, 1, 1, builder_bits ) ) )
+        assert len(dense) == 13 and dense[-1].shape[0] == sparse[-1].shape[0]
+        for field, (vi, ii) in enumerate( [ (0, 2), (1, 3), (4, 6), (5, 7), (None, 8),
+                                            (9, 11), (10, 12), (13, 15), (14, 16), (None, 17) ] ):
+            expected = numpy.zeros( dense[field].shape )
+            values = numpy.ones( sparse[ii].shape[0] ) if vi is None else sparse[vi]
+            numpy.add.at( expected, sparse[ii][:,0], values.reshape( -1, 1 ) * embedding[sparse[ii][:,1]] )
+            assert numpy.abs( expected - dense[field] ).max() < 1e-5
+
+    print 'fofe_builder matches the brute-force recurrence'
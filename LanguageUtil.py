@@ -0,0 +1,274 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Several languages in one server process. The model given on the command
+line is loaded at start-up and serves its own language, as well as every
+language that has no model of its own. Each further language is a
+BundleUtil.py bundle registered with --language and loaded on its first
+request. With a memory budget, loading a model first evicts idle models,
+least recently used first. A model that is running a request is never
+evicted.
+"""
+
+import os, gc, copy, time, threading, logging
+from ReloadUtil import reloadable_annotator, ResidentMB
+from BundleUtil import IsBundle, SectionBytes
+
+logger = logging.getLogger( __name__ )
+
+# rough size of unpickled vocabularies and configs relative to their
+# pickles, which are mostly dicts of short strings
+_unpickled_ratio = 4
+
+
+def ParseLanguages( specs ):
+    """
+    Parameters
+    ----------
+        specs : list
+            'LANG=BUNDLE' strings, e.g. from --language
+
+    Returns
+    -------
+        bundles : dict
+            language -> bundle path
+    """
+    bundles = {}
+    for spec in specs:
+        language, _, filename = spec.partition( '=' )
+        if len(language) == 0 or len(filename) == 0:
+            raise ValueError( 'expecting LANG=BUNDLE, got %s' % spec )
+        if not IsBundle( filename ):
+            raise ValueError( '%s is not a model bundle, see `BundleUtil.py pack`' % filename )
+        if language in bundles:
+            raise ValueError( '%s is given twice' % language )
+        bundles[language] = filename
+    return bundles
+
+
+
+class _language_model( object ):
+    def __init__( self, language, args ):
+        self.language = language
+        self.args = args
+        self.annotator = None
+        self.n_active = 0
+        self.n_load = 0
+        self.last_used = 0.
+        # megabytes counted against the budget, see __Footprint
+        self.footprint = None
+
+
+    def Indexed( self ):
+        """
+        Returns
+        -------
+            megabytes : float
+                of the bundle once every page of its arrays is mapped in
+                and its pickled sections are unpickled; None if the model
+                is not a bundle
+        """
+        if not IsBundle( self.args.model1st ):
+            return None
+        sizes = SectionBytes( self.args.model1st )
+        return (sizes['array'] + _unpickled_ratio * sizes['pickle']) / float( 1 << 20 )
+
+
+    def Estimate( self ):
+        """
+        Megabytes the model is expected to take once loaded: as much as
+        the last time, or at first what its bundle index adds up to.
+        """
+        if self.footprint is not None:
+            return self.footprint
+        indexed = self.Indexed()
+        if indexed is not None:
+            return indexed
+        return os.path.getsize( self.args.model1st ) / float( 1 << 20 )
+
+
+
+class language_registry( object ):
+    """
+    Routes annotate to the model of the language; same stats, LoadNetwork,
+    Trigger and ReloadStats as ReloadUtil.reloadable_annotator.
+    """
+    def __init__( self, args, load_network = True ):
+        """
+        Parameters
+        ----------
+            args : argparse.Namespace
+                command-line arguments of server.py; args.language lists
+                the LANG=BUNDLE of the further languages and
+                args.model_budget_mb bounds the loaded models, 0 for no limit
+            load_network : bool
+                see fofe_ner_wrapper, for the model loaded at start-up
+        """
+        self.args = args
+        self.budget = args.model_budget_mb
+        self.lock = threading.Lock()
+        # one model is loaded at a time, which keeps the measured
+        # footprints apart and the peak within the budget
+        self.load_lock = threading.Lock()
+        self.n_eviction = 0
+
+        self.default = _language_model( None, args )
+        self.__Load( self.default, load_network )
+        self.default.language = self.default.annotator.current.wrapper.config1st.language
+
+        self.models = { self.default.language: self.default }
+        for language, filename in ParseLanguages( args.language ).items():
+            if language == self.default.language:
+                raise ValueError( '%s is already served by %s' % (language, args.model1st) )
+            # the bundle holds the vocabularies, gazetteer and other passes
+            extra = copy.copy( args )
+            extra.model1st = filename
+            self.models[language] = _language_model( language, extra )
+        logger.info( 'languages: %s, %s loaded' % \
+                     (', '.join( sorted( self.models.keys() ) ), self.default.language) )
+
+
+    def Serves( self, language ):
+        return language in self.models
+
+
+    def __Load( self, model, load_network = True ):
+        before = ResidentMB()
+        model.annotator = reloadable_annotator( model.args,
+                                                load_network = load_network,
+                                                poll = self.args.reload_poll,
+                                                max_mb = self.args.reload_max_mb )
+        model.footprint = self.__Footprint( model, ResidentMB() - before )
+        model.n_load += 1
+        logger.info( '%s loaded, %.0f MB' % (model.language or model.args.model1st, model.footprint) )
+
+
+    def __Footprint( self, model, growth ):
+        """
+        The growth of the resident size while a model is built misses the
+        pages of its arrays that are only mapped in by later requests, and
+        freed pages reused when a model is loaded again; the bundle index
+        covers both. The largest of these, and of earlier loads, is kept.
+        """
+        return max( growth, model.Indexed() or 0, model.footprint or 0 )
+
+
+    def __Evict( self, needed ):
+        """
+        Closes idle models, least recently used first, until needed more
+        megabytes fit in the budget.
+        """
+        if self.budget <= 0:
+            return
+
+        victims = []
+        with self.lock:
+            loaded = [ m for m in self.models.values() if m.annotator is not None ]
+            used = sum( m.footprint for m in loaded )
+            for model in sorted( loaded, key = lambda m: m.last_used ):
+                if used + needed <= self.budget:
+                    break
+                if model.n_active == 0:
+                    victims.append( (model, model.annotator) )
+                    model.annotator = None
+                    used -= model.footprint
+                    self.n_eviction += 1
+
+        for model, annotator in victims:
+            annotator.Close()
+            logger.info( '%s evicted, idle for %.0f seconds' % \
+                         (model.language, time.time() - model.last_used) )
+        if len(victims) > 0:
+            gc.collect()
+        if used + needed > self.budget:
+            logger.warning( '%.0f MB of models in use exceeds the budget of %.0f MB' % \
+                            (used + needed, self.budget) )
+
+
+    def __Acquire( self, model ):
+        with self.lock:
+            # pinned from here on, so it can't be evicted while it loads
+            model.n_active += 1
+            model.last_used = time.time()
+            annotator = model.annotator
+        if annotator is not None:
+            return annotator
+
+        try:
+            with self.load_lock:
+                if model.annotator is None:
+                    self.__Evict( model.Estimate() )
+                    self.__Load( model )
+                return model.annotator
+        except Exception:
+            self.__Release( model )
+            raise
+
+
+    def __Release( self, model ):
+        with self.lock:
+            model.n_active -= 1
+            model.last_used = time.time()
+
+
+    def annotate( self, sentences, isDevMode = False, language = None ):
+        """
+        Parameters
+        ----------
+            language : str
+                languages without a model of their own go to the one
+                loaded at start-up
+        """
+        model = self.models.get( language, self.default )
+        annotator = self.__Acquire( model )
+        try:
+            return annotator.annotate( sentences, isDevMode )
+        finally:
+            self.__Release( model )
+
+
+    def LoadNetwork( self ):
+        before = ResidentMB()
+        self.default.annotator.LoadNetwork()
+        self.default.footprint += max( ResidentMB() - before, 0 )
+
+
+    def stats( self ):
+        report = { 'languages': {} }
+        for language, model in self.models.items():
+            annotator = model.annotator
+            entry = { 'loaded': annotator is not None, 'loads': model.n_load,
+                      'active': model.n_active, 'footprint_mb': model.footprint,
+                      'idle_seconds': time.time() - model.last_used if model.last_used > 0 else None }
+            if annotator is not None:
+                entry.update( annotator.stats() )
+            report['languages'][language] = entry
+        report['memory'] = { 'budget_mb': self.budget,
+                             'resident_mb': ResidentMB(),
+                             'models_mb': sum( m.footprint for m in self.models.values() \
+                                               if m.annotator is not None ),
+                             'evictions': self.n_eviction }
+        return report
+
+
+    def Trigger( self, reason ):
+        """
+        Reloads every loaded model, see ReloadUtil.reloadable_annotator.
+
+        Returns
+        -------
+            started : bool
+                whether any reload was started
+        """
+        started = False
+        for model in self.models.values():
+            annotator = model.annotator
+            if annotator is not None:
+                started = annotator.Trigger( reason ) or started
+        return started
+
+
+    def ReloadStats( self ):
+        return dict( (language, model.annotator.ReloadStats()) \
+                     for language, model in self.models.items() \
+                        if model.annotator is not None )
@@ -0,0 +1,148 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+import numpy, logging
+
+logger = logging.getLogger( __name__ )
+
+
+# Positions in the mini-batch tuple that batch_constructor.mini_batch yields
+# and fofe_mention_net.{train,eval} unpack:
+#
+#   l1_values, r1_values, l1_indices, r1_indices,
+#   l2_values, r2_values, l2_indices, r2_indices,
+#   bow1i,
+#   l3_values, r3_values, l3_indices, r3_indices,
+#   l4_values, r4_values, l4_indices, r4_indices,
+#   bow2i,
+#   dense_feature,
+#   conv_idx,
+#   l5_values, l5_indices, r5_values, r5_indices,
+#   target
+
+# [nnz, 2] coordinate arrays whose 1st column is the row (example) index
+sparse_indices = [ 2, 3, 6, 7, 8, 11, 12, 15, 16, 17, 21, 23 ]
+# value arrays that go with each entry of sparse_indices (None for bow)
+sparse_values = [ 0, 1, 4, 5, None, 9, 10, 13, 14, None, 20, 22 ]
+# one row per example
+dense_rows = [ 18, 24 ]
+conv_position = 19
+n_field = 25
+
+# fofe_mention_net.eval takes this layout in projected mode, where the word
+# features arrive already multiplied by the embedding tables, one dense row
+# per example (FeatureUtil.projected_builder):
+#
+#   lwp1, rwp1, lwp2, rwp2, bowp1, lwp3, rwp3, lwp4, rwp4, bowp2,
+#   dense_feature,
+#   conv_idx,
+#   target
+projected_conv_position = 11
+n_projected_field = 13
+
+
+def Layout( mini_batch ):
+    """
+    Returns
+    -------
+        sparse_indices, sparse_values, dense_rows, conv_position
+            of the layout mini_batch is in
+    """
+    if len(mini_batch) == n_projected_field:
+        return [], [], [ i for i in xrange( n_projected_field ) \
+                         if i != projected_conv_position ], projected_conv_position
+    return sparse_indices, sparse_values, dense_rows, conv_position
+
+
+def MiniBatchSize( mini_batch ):
+    return mini_batch[-1].shape[0]
+
+
+def ConcatMiniBatch( mini_batches, conv_pad = 0 ):
+    """
+    Stacks several mini-batches into one, shifting the row index of every
+    sparse coordinate.
+
+    Parameters
+    ----------
+        mini_batches : list
+            mini-batch tuples
+        conv_pad : int
+            index used to right-pad conv_idx to the widest input
+
+    Returns
+    -------
+        mini_batch : tuple
+    """
+    if len(mini_batches) == 1:
+        return mini_batches[0]
+
+    size = numpy.asarray( [ MiniBatchSize(mb) for mb in mini_batches ] )
+    offset = numpy.cumsum( size ) - size
+
+    sparse_indices, sparse_values, dense_rows, conv_position = Layout( mini_batches[0] )
+    result = [ None ] * len(mini_batches[0])
+
+    for i in sparse_indices:
+        shifted = []
+        for mb, o in zip( mini_batches, offset ):
+            idx = mb[i].copy()
+            idx[:,0] += o
+            shifted.append( idx )
+        result[i] = numpy.concatenate( shifted, axis = 0 )
+
+    for i in sparse_values:
+        if i is not None:
+            result[i] = numpy.concatenate( [ mb[i] for mb in mini_batches ], axis = 0 )
+
+    for i in dense_rows:
+        result[i] = numpy.concatenate( [ mb[i] for mb in mini_batches ], axis = 0 )
+
+    width = max( mb[conv_position].shape[1] for mb in mini_batches )
+    conv = numpy.empty( (size.sum(), width), dtype = mini_batches[0][conv_position].dtype )
+    conv.fill( conv_pad )
+    for mb, o, n in zip( mini_batches, offset, size ):
+        conv[o: o + n, :mb[conv_position].shape[1]] = mb[conv_position]
+    result[conv_position] = conv
+
+    return tuple( result )
+
+
+
+def SliceMiniBatch( mini_batch, rows ):
+    """
+    Keeps the examples of a mini-batch at the given rows, renumbering the
+    row index of every sparse coordinate.
+
+    Parameters
+    ----------
+        mini_batch : tuple
+        rows : ndarray
+            increasing row indices
+
+    Returns
+    -------
+        mini_batch : tuple
+    """
+    rows = numpy.asarray( rows, dtype = numpy.int64 )
+    renumber = numpy.empty( MiniBatchSize( mini_batch ), dtype = numpy.int64 )
+    renumber.fill( -1 )
+    renumber[rows] = numpy.arange( rows.shape[0] )
+
+    sparse_indices, sparse_values, dense_rows, conv_position = Layout( mini_batch )
+    result = [ None ] * len(mini_batch)
+
+    for i, v in zip( sparse_indices, sparse_values ):
+        idx = mini_batch[i]
+        row = renumber[idx[:,0]]
+        keep = row >= 0
+        idx = idx[keep]
+        idx[:,0] = row[keep]
+        result[i] = idx
+        if v is not None:
+            result[v] = mini_batch[v][keep]
+
+    for i in dense_rows + [ conv_position ]:
+        result[i] = mini_batch[i][rows]
+
+    return tuple( result )
+
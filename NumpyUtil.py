@@ -0,0 +1,359 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Forward pass of fofe_mention_net in NumPy for CPU serving. A checkpoint is
+converted once into a bundle directory of raw arrays (ServingUtil.SaveTables
+layout plus the config as a plain dict), which is memory-mapped at load
+time; neither this module nor loading a bundle needs TensorFlow.
+"""
+
+import numpy, os, time, cPickle, argparse, logging
+from scipy.sparse import csr_matrix
+from ServingUtil import SaveTables, LoadTables
+from MiniBatchUtil import n_projected_field
+
+logger = logging.getLogger( __name__ )
+
+
+def SparseDense( indices, values, n_row, table ):
+    """
+    CSR x dense: row r of the result sums values * table[column] over the
+    coordinates of row r.
+
+    Parameters
+    ----------
+        indices : ndarray
+            [nnz, 2] (row, column) coordinates in any order
+        values : ndarray
+            None for ones, as for bag-of-words
+    """
+    if values is None:
+        values = numpy.ones( indices.shape[0], dtype = numpy.float32 )
+    sparse = csr_matrix( ( values, ( indices[:,0], indices[:,1] ) ),
+                         shape = ( n_row, table.shape[0] ), dtype = numpy.float32 )
+    return numpy.asarray( sparse.dot( table ), dtype = numpy.float32 )
+
+
+def CharConv( char_idx, embedding, kernel, bias ):
+    """
+    Same as tf.nn.conv2d( ..., 'VALID' ) of [height, n_char_embedding, 1,
+    depth] kernels over the embedded characters, tanh, then max over time.
+    The windows are laid out side by side, so the convolution is one matrix
+    product.
+    """
+    height, depth = kernel.shape[0], kernel.shape[3]
+    n_step = char_idx.shape[1] - height + 1
+    if n_step <= 0:
+        result = numpy.empty( (char_idx.shape[0], depth), dtype = numpy.float32 )
+        # the max over no step, as tf.reduce_max gives it
+        result.fill( -numpy.inf )
+        return result
+
+    cube = embedding[char_idx]
+    window = numpy.concatenate( [ cube[:, k: k + n_step, :] for k in xrange( height ) ], axis = 2 )
+    acc = numpy.dot( window.reshape( -1, window.shape[2] ), kernel.reshape( -1, depth ) )
+    acc = acc.reshape( char_idx.shape[0], n_step, depth )
+    return numpy.tanh( acc + bias ).max( axis = 1 )
+
+
+
+class engine_config( object ):
+    """
+    The attributes of a mention_config, without importing TensorFlow.
+    """
+    def __init__( self, fields ):
+        self.__dict__.update( fields )
+
+
+
+class numpy_mention_net( object ):
+    """
+    Takes the place of an inference-only fofe_mention_net: same eval,
+    including projected mini-batches and blending.
+    """
+    def __init__( self, config, arrays, blend = 0. ):
+        """
+        Parameters
+        ----------
+            config : dict
+                attributes of the mention_config
+            arrays : dict
+                role -> ndarray, see fofe_mention_net.ExportArrays
+            blend : float
+                see fofe_mention_net
+        """
+        self.config = engine_config( config )
+        assert self.config.n_pattern == 0, 'pattern attention is not supported'
+
+        # plain views of the mappings, numpy.memmap results are slow to wrap
+        self.arrays = dict( (k, numpy.asarray( v )) for k, v in arrays.items() )
+        self.blend = blend
+
+        count = lambda prefix: len( [ k for k in self.arrays if k.startswith( prefix ) ] )
+        self.kernels = [ self.arrays['kernel_%d' % i] for i in xrange( count( 'kernel_bias_' ) ) ]
+        self.kernel_bias = [ self.arrays['kernel_bias_%d' % i] for i in xrange( count( 'kernel_bias_' ) ) ]
+        self.W = [ self.arrays['W_%d' % i] for i in xrange( count( 'W_' ) ) ]
+        self.b = [ self.arrays['b_%d' % i] for i in xrange( count( 'b_' ) ) ]
+        self.U = self.arrays.get( 'U' )
+
+
+    def WordEmbedding( self ):
+        return [ self.arrays['word_embedding_1'], self.arrays['word_embedding_2'] ]
+
+
+    def Feature( self, mini_batch ):
+        """
+        Returns
+        -------
+            feature : ndarray
+                the concatenated projected features the hidden layers take
+        """
+        a = self.arrays
+        feature_choice = self.config.feature_choice
+        n = mini_batch[-1].shape[0]
+
+        if len(mini_batch) == n_projected_field:
+            projected = list( mini_batch[:10] )
+            dense_feature, conv_idx = mini_batch[10], mini_batch[11]
+            lbcp = rbcp = None
+        else:
+            l1_values, r1_values, l1_indices, r1_indices, \
+            l2_values, r2_values, l2_indices, r2_indices, \
+            bow1i, \
+            l3_values, r3_values, l3_indices, r3_indices, \
+            l4_values, r4_values, l4_indices, r4_indices, \
+            bow2i, \
+            dense_feature,\
+            conv_idx,\
+            l5_values, l5_indices, r5_values, r5_indices, \
+            target = mini_batch
+
+            sparse = [ (l1_indices, l1_values, 0, 1), (r1_indices, r1_values, 0, 1),
+                       (l2_indices, l2_values, 1, 1), (r2_indices, r2_values, 1, 1),
+                       (bow1i, None, 2, 1),
+                       (l3_indices, l3_values, 3, 2), (r3_indices, r3_values, 3, 2),
+                       (l4_indices, l4_values, 4, 2), (r4_indices, r4_values, 4, 2),
+                       (bow2i, None, 5, 2) ]
+            projected = [ SparseDense( i, v, n, a['word_embedding_%d' % e] ) \
+                                if (1 << bit) & feature_choice > 0 else None \
+                          for i, v, bit, e in sparse ]
+            if (1 << 10) & feature_choice > 0:
+                lbcp = SparseDense( l5_indices, l5_values, n, a['bigram_embedding'] )
+                rbcp = SparseDense( r5_indices, r5_values, n, a['bigram_embedding'] )
+
+        if not self.config.strictly_one_hot:
+            dense_feature = dense_feature.copy()
+            dense_feature[:,-1] = 0
+
+        feature_list = [ projected[0:2], projected[2:4], projected[4:5],
+                         projected[5:7], projected[7:9], projected[9:10] ]
+        used = []
+        for ith, f in enumerate( feature_list ):
+            if (1 << ith) & feature_choice > 0:
+                used.extend( f )
+
+        char = a['char_embedding']
+        if (1 << 6) & feature_choice > 0:
+            used.extend( [ numpy.dot( dense_feature[:,:128], char ),
+                           numpy.dot( dense_feature[:,128:256], char ) ] )
+        if (1 << 7) & feature_choice > 0:
+            used.extend( [ numpy.dot( dense_feature[:,256:384], char ),
+                           numpy.dot( dense_feature[:,384:512], char ) ] )
+        if (1 << 8) & feature_choice > 0:
+            used.append( numpy.dot( dense_feature[:,512:], a['ner_embedding'] ) )
+        if (1 << 9) & feature_choice > 0:
+            used.extend( [ CharConv( conv_idx, a['conv_embedding'], k, b ) \
+                           for k, b in zip( self.kernels, self.kernel_bias ) ] )
+        if (1 << 10) & feature_choice > 0:
+            assert lbcp is not None, 'char-bigram has no projected input'
+            used.extend( [ lbcp, rbcp ] )
+
+        return numpy.concatenate( used, axis = 1 )
+
+
+    def eval( self, mini_batch, prior = None ):
+        """
+        Returns
+        -------
+            c : None
+            pi : ndarray
+            pv : ndarray
+                as fofe_mention_net.eval in inference-only mode
+        """
+        layer_output = self.Feature( mini_batch )
+        if self.U is not None:
+            layer_output = numpy.dot( layer_output, self.U )
+
+        for i in xrange( len(self.W) ):
+            layer_output = numpy.dot( layer_output, self.W[i] ) + self.b[i]
+            if i < len(self.W) - 1:
+                layer_output = numpy.maximum( layer_output, 0 )
+
+        layer_output = layer_output - layer_output.max( axis = 1, keepdims = True )
+        pv = numpy.exp( layer_output )
+        pv /= pv.sum( axis = 1, keepdims = True )
+        if self.blend > 0:
+            pv = self.blend * prior + (1 - self.blend) * pv
+        pv = pv.astype( numpy.float32 )
+        return None, pv.argmax( axis = 1 ).astype( numpy.int32 ), pv
+
+
+
+def LoadEngineConfig( dirname ):
+    """
+    Returns
+    -------
+        config : dict
+            attributes of the mention_config of the bundle written by Convert
+    """
+    with open( os.path.join( dirname, 'config.pickle' ), 'rb' ) as fp:
+        return cPickle.load( fp )
+
+
+def LoadEngine( dirname, blend = 0. ):
+    """
+    Parameters
+    ----------
+        dirname : str
+            bundle written by Convert
+    """
+    config = LoadEngineConfig( dirname )
+    return numpy_mention_net( config, LoadTables( dirname ), blend = blend )
+
+
+
+########################################################################
+
+
+def LoadCheckpoint( model ):
+    """
+    Returns
+    -------
+        mention_net : fofe_mention_net
+            inference-only, serving <model>.tables if they were exported
+    """
+    from fofe_mention_net import mention_config, fofe_mention_net
+
+    config = mention_config()
+    with open( '%s.config' % model, 'rb' ) as fp:
+        config.__dict__.update( cPickle.load( fp ).__dict__ )
+
+    tables = LoadTables( model + '.tables' ) if os.path.isdir( model + '.tables' ) else None
+    mention_net = fofe_mention_net( config, None, inference_only = True, tables = tables )
+    mention_net.fromfile( model )
+    return mention_net
+
+
+def RandomMiniBatch( config, n, rng, width = 16 ):
+    """
+    Random features of n examples in the shapes config implies, for
+    parity checks and benchmarks.
+    """
+    def Sparse( n_column, per_row ):
+        row = numpy.repeat( numpy.arange( n ), per_row )
+        indices = numpy.column_stack( ( row, rng.randint( 0, n_column, row.shape[0] ) ) )
+        return rng.rand( row.shape[0] ).astype( numpy.float32 ), indices.astype( numpy.int64 )
+
+    word = lambda n_column: Sparse( n_column, 12 )
+    l1v, l1i = word( config.n_word1 ); r1v, r1i = word( config.n_word1 )
+    l2v, l2i = word( config.n_word1 ); r2v, r2i = word( config.n_word1 )
+    _, bow1i = Sparse( config.n_word1, 2 )
+    l3v, l3i = word( config.n_word2 ); r3v, r3i = word( config.n_word2 )
+    l4v, l4i = word( config.n_word2 ); r4v, r4i = word( config.n_word2 )
+    _, bow2i = Sparse( config.n_word2, 2 )
+    dense = rng.rand( n, 512 + config.n_label_type + 1 ).astype( numpy.float32 )
+    conv = rng.randint( 0, config.n_char, (n, width) ).astype( numpy.int32 )
+    l5v, l5i = Sparse( 96 * 96, 4 ); r5v, r5i = Sparse( 96 * 96, 4 )
+    target = numpy.empty( n, dtype = numpy.int64 )
+    target.fill( config.n_label_type )
+    return ( l1v, r1v, l1i, r1i, l2v, r2v, l2i, r2i, bow1i,
+             l3v, r3v, l3i, r3i, l4v, r4v, l4i, r4i, bow2i,
+             dense, conv, l5v, l5i, r5v, r5i, target )
+
+
+def Convert( args ):
+    """
+    Writes <model>.numpy. Embedding tables already exported to
+    <model>.tables are linked rather than copied.
+    """
+    mention_net = LoadCheckpoint( args.model )
+    dirname = args.model + '.numpy'
+
+    arrays = mention_net.ExportArrays()
+    SaveTables( dirname, dict( (role, array) for role, array in arrays.items() \
+                               if role not in mention_net.table_variable ) )
+
+    if len(mention_net.table_variable) > 0:
+        with open( os.path.join( dirname, 'tables.meta' ), 'rb' ) as fp:
+            meta = cPickle.load( fp )
+        for name in mention_net.table_variable:
+            link = os.path.join( dirname, name + '.bin' )
+            if os.path.lexists( link ):
+                os.remove( link )
+            os.symlink( os.path.abspath( os.path.join( args.model + '.tables', name + '.bin' ) ), link )
+            table = mention_net.tables[name]
+            meta[name] = ( table.dtype.str, table.shape )
+        with open( os.path.join( dirname, 'tables.meta' ), 'wb' ) as fp:
+            cPickle.dump( meta, fp, cPickle.HIGHEST_PROTOCOL )
+
+    with open( os.path.join( dirname, 'config.pickle' ), 'wb' ) as fp:
+        cPickle.dump( dict( mention_net.config.__dict__ ), fp, cPickle.HIGHEST_PROTOCOL )
+    logger.info( '%s converted to %s' % (args.model, dirname) )
+
+    # the bundle must reproduce the checkpoint
+    mini_batch = RandomMiniBatch( mention_net.config, 256, numpy.random.RandomState( 0 ) )
+    _, pi0, pv0 = mention_net.eval( mini_batch )
+    _, pi1, pv1 = LoadEngine( dirname ).eval( mini_batch )
+    logger.info( 'max difference %g, label agreement %f' % \
+                 ( numpy.abs( pv0 - pv1 ).max(), (pi0 == pi1).mean() ) )
+
+
+def Benchmark( args ):
+    rng = numpy.random.RandomState( 0 )
+
+    start = time.time()
+    engine = LoadEngine( args.model + '.numpy' )
+    logger.info( 'numpy engine loaded in %.3f seconds' % (time.time() - start) )
+
+    start = time.time()
+    mention_net = LoadCheckpoint( args.model )
+    logger.info( 'tensorflow engine loaded in %.3f seconds' % (time.time() - start) )
+
+    mini_batches = [ RandomMiniBatch( mention_net.config, args.batch_size, rng ) \
+                     for _ in xrange( args.n_batch ) ]
+
+    for name, net in [ ('tensorflow', mention_net), ('numpy', engine) ] * 2:
+        start = time.time()
+        pv = [ net.eval( mb )[2] for mb in mini_batches ]
+        elapsed = time.time() - start
+        logger.info( '%s: %.1f spans per second' % \
+                     ( name, args.n_batch * args.batch_size / elapsed ) )
+        if name == 'tensorflow':
+            expected = pv
+        else:
+            logger.info( 'max difference %g' % \
+                         max( numpy.abs( a - b ).max() for a, b in zip( expected, pv ) ) )
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig( format = '%(asctime)s : %(levelname)s : %(message)s',
+                         level = logging.INFO )
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    convert = subparsers.add_parser( 'convert',
+        help = 'write the variables and config of a model to <model>.numpy' )
+    convert.add_argument( 'model', type = str, help = 'basename of the model' )
+    convert.set_defaults( func = Convert )
+
+    benchmark = subparsers.add_parser( 'benchmark',
+        help = 'compare speed and output of <model>.numpy with the tensorflow model' )
+    benchmark.add_argument( 'model', type = str, help = 'basename of the model' )
+    benchmark.add_argument( '--batch-size', type = int, default = 2560 )
+    benchmark.add_argument( '--n-batch', type = int, default = 8 )
+    benchmark.set_defaults( func = Benchmark )
+
+    args = parser.parse_args()
+    args.func( args )
@@ -0,0 +1,448 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+import numpy, logging
+
+logger = logging.getLogger( __name__ )
+
+
+# the same label names gigaword2feature.PredictionParser puts in its table
+idx2ner4 = [ 'PER', 'LOC', 'ORG', 'MISC' ]
+idx2ner10 = [ 'PER_NAM', 'ORG_NAM', 'GPE_NAM', 'LOC_NAM', 'FAC_NAM',
+              'PER_NOM', 'ORG_NOM', 'GPE_NOM', 'LOC_NOM', 'FAC_NOM' ]
+
+# one record per candidate span; label is -1 where the estimate is O
+span_dtype = numpy.dtype( [ ('begin', numpy.int32),
+                            ('end', numpy.int32),
+                            ('label', numpy.int32),
+                            ('score', numpy.float32) ] )
+
+
+def LabelNames( n_label_type ):
+    if n_label_type == 4:
+        return idx2ner4
+    elif n_label_type == 10:
+        return idx2ner10
+    else:
+        return [ str(i) for i in xrange(n_label_type) ]
+
+
+def SpanCount( n_word, window ):
+    """
+    Number of candidate spans (rows in the probability array) batch_constructor
+    generates for a sentence of n_word words.
+    """
+    n_word = numpy.asarray( n_word, dtype = numpy.int64 )
+    full = numpy.maximum( n_word - window + 1, 0 )
+    short = n_word - full                # these starts see fewer than window words
+    return full * window + short * (short + 1) // 2
+
+
+def SpanIndex( n_word, window ):
+    """
+    Returns
+    -------
+        begin, end : ndarray
+            span boundaries (end exclusive) in the order batch_constructor
+            enumerates them: by begin, then by end
+    """
+    width = numpy.minimum( window, n_word - numpy.arange( n_word ) )
+    begin = numpy.repeat( numpy.arange( n_word, dtype = numpy.int32 ), width )
+    first = numpy.repeat( numpy.cumsum( width ) - width, width )
+    end = begin + 1 + (numpy.arange( begin.shape[0] ) - first).astype( numpy.int32 )
+    return begin, end
+
+
+def DocumentSpanIndex( n_word, window ):
+    """
+    SpanIndex of several sentences at once, e.g. of every row of the 
+    probability array of a document.
+
+    Parameters
+    ----------
+        n_word : list
+            length of each sentence
+
+    Returns
+    -------
+        sentence, begin, end : ndarray
+    """
+    n_word = numpy.asarray( n_word, dtype = numpy.int64 )
+    sentence_of_token = numpy.repeat( numpy.arange( n_word.shape[0] ), n_word )
+    position = numpy.arange( sentence_of_token.shape[0] ) - \
+               (numpy.cumsum( n_word ) - n_word)[sentence_of_token]
+    width = numpy.minimum( window, n_word[sentence_of_token] - position )
+
+    token = numpy.repeat( numpy.arange( width.shape[0] ), width )
+    first = numpy.repeat( numpy.cumsum( width ) - width, width )
+    sentence = sentence_of_token[token]
+    begin = position[token]
+    end = begin + 1 + numpy.arange( token.shape[0] ) - first
+    return sentence, begin, end
+
+
+
+class span_table( object ):
+    """
+    Score table of one sentence: a record of span_dtype for every candidate
+    span, i.e. O(n * window) instead of an n x n table, in the order 
+    batch_constructor enumerates them, so the record of [begin, end) is 
+    found by arithmetic. Indexing it with [begin][end - 1] still gives None 
+    or (label name, score), like the list of lists PredictionParser builds.
+    """
+    def __init__( self, records, n_word, window, label_names ):
+        """
+        Parameters
+        ----------
+            records : ndarray
+                SpanCount( n_word, window ) records of span_dtype
+            n_word : int
+            window : int
+            label_names : list
+        """
+        self.records = records
+        self.n_word = n_word
+        self.window = window
+        self.names = label_names
+        self.width = numpy.minimum( window, n_word - numpy.arange( n_word ) )
+        self.first = numpy.cumsum( self.width ) - self.width
+
+
+    def Index( self, begin, end ):
+        """
+        Returns
+        -------
+            index, valid : ndarray
+                record of each span; index is 0 where valid is False, i.e.
+                the span is not a candidate
+        """
+        begin = numpy.asarray( begin, dtype = numpy.int64 )
+        end = numpy.asarray( end, dtype = numpy.int64 )
+        valid = (begin >= 0) & (begin < self.n_word) & (end > begin)
+        safe = numpy.where( valid, begin, 0 )
+        valid &= end - safe <= self.width[safe]
+        index = numpy.where( valid, self.first[safe] + end - safe - 1, 0 )
+        return index, valid
+
+
+    def Lookup( self, begin, end ):
+        """
+        Returns
+        -------
+            label, score : ndarray
+                label is -1 where the span is O or not a candidate
+        """
+        index, valid = self.Index( begin, end )
+        found = self.records[index]
+        label = numpy.where( valid, found['label'], -1 )
+        return label, found['score']
+
+
+    def Estimates( self ):
+        """
+        Returns
+        -------
+            estimate : ndarray
+                records whose label is not O, ordered by begin, then end
+        """
+        return self.records[self.records['label'] >= 0]
+
+
+    def __len__( self ):
+        return self.n_word
+
+    def __getitem__( self, begin ):
+        row = [ None ] * self.n_word
+        start = self.first[begin]
+        for r in self.records[start: start + self.width[begin]].tolist():
+            if r[2] >= 0:
+                row[r[1] - 1] = ( self.names[r[2]], r[3] )
+        return row
+
+    def tolist( self ):
+        return [ self[b] for b in xrange( self.n_word ) ]
+
+
+
+def ArrayPredictionParser( sample_generator, prob, ner_max_length, n_label_type = 4 ):
+    """
+    Same contract as gigaword2feature.PredictionParser, but it walks the
+    probability array built in fofe_ner_wrapper.annotate directly instead
+    of a text dump of it.
+
+    Parameters
+    ----------
+        sample_generator : iterable
+            (sentence, boe, eoe, coe, ...) in the order the array was built
+        prob : ndarray
+            [n_span, 2 + n_label_type + 1], columns are actual label,
+            estimated label and the probability of each class
+        ner_max_length : int
+            window used by batch_constructor
+        n_label_type : int
+
+    Yields
+    ------
+        sentence, table, estimate, actual
+            table is a span_table and estimate its records that are not O
+    """
+    idx2ner = LabelNames( n_label_type )
+    offset = 0
+
+    for sample in sample_generator:
+        sentence = sample[0]
+        n = len(sentence)
+        begin, end = SpanIndex( n, ner_max_length )
+        rows = prob[offset: offset + begin.shape[0]]
+        assert rows.shape[0] == begin.shape[0], 'probability array is too short'
+        offset += begin.shape[0]
+
+        actual_label = rows[:,0].astype( numpy.int32 )
+        estimate_label = rows[:,1].astype( numpy.int32 )
+
+        records = numpy.empty( begin.shape[0], dtype = span_dtype )
+        records['begin'] = begin
+        records['end'] = end
+        records['label'] = numpy.where( estimate_label != n_label_type, estimate_label, -1 )
+        records['score'] = rows[numpy.arange( begin.shape[0] ), 2 + estimate_label]
+
+        table = span_table( records, n, ner_max_length, idx2ner )
+        estimate = table.Estimates()
+
+        labelled = numpy.flatnonzero( actual_label != n_label_type )
+        actual = zip( begin[labelled].tolist(),
+                      end[labelled].tolist(),
+                      actual_label[labelled].tolist() )
+
+        yield sentence, table, estimate, actual
+
+    assert offset == prob.shape[0], 'probability array is too long'
+
+
+
+def ArrayDecode( n_word, estimate, threshold, algorithm, sentence = None, table = None ):
+    """
+    Same decision rule as gigaword2feature.decode, on an estimate record array.
+    Other algorithms than these two are left to gigaword2feature.decode.
+
+    Parameters
+    ----------
+        n_word : int
+            length of the sentence
+        estimate : ndarray
+            records of span_dtype, e.g. span_table.Estimates()
+        threshold : float
+            spans whose probability is below it are discarded
+        algorithm : int
+            1 for highest-first, 2 for longest-first
+        sentence, table
+            as ArrayPredictionParser yields them, only passed on to
+            gigaword2feature.decode
+
+    Returns
+    -------
+        result : list
+            (begin, end, label) of the non-overlapping spans that are kept
+    """
+    candidate = estimate[estimate['score'] >= threshold]
+
+    # lexsort is stable and uses the last key as the primary one
+    if algorithm == 1:
+        order = numpy.lexsort( ( -candidate['score'], ) )
+    elif algorithm == 2:
+        order = numpy.lexsort( ( -candidate['score'],
+                                 candidate['begin'] - candidate['end'] ) )
+    else:
+        # the algorithm comes from training, so it is decoded the slow way
+        # rather than refused
+        from gigaword2feature import decode
+        if sentence is None:
+            sentence = [ u'' ] * n_word
+        return decode( sentence, estimate.tolist(), table, threshold, algorithm )
+
+    used = numpy.zeros( n_word, dtype = numpy.bool_ )
+    result = []
+    for b, e, c, _ in candidate[order].tolist():
+        if not used[b:e].any():
+            used[b:e] = True
+            result.append( (b, e, c) )
+    return result
+
+
+
+def BatchDecode( n_word, prob, window, threshold, algorithm, n_label_type = 4,
+                 sentences = None ):
+    """
+    ArrayDecode of every sentence of a document at once. Greedy selection is
+    run in rounds: a candidate whose priority is the highest among all 
+    remaining candidates it overlaps is kept, and whatever overlaps a kept 
+    candidate is dropped. That keeps exactly what the sequential greedy 
+    decoder keeps, in as many rounds as the longest chain of overlapping 
+    candidates with decreasing priority, which is short in practice.
+
+    Parameters
+    ----------
+        n_word : list
+            length of each sentence
+        prob : ndarray
+            probability array of the document, as ArrayPredictionParser reads it
+        window : int
+            window used by batch_constructor
+        threshold : float
+        algorithm : int
+            1 for highest-first, 2 for longest-first; any other is run
+            through ArrayDecode one sentence at a time
+        n_label_type : int
+        sentences : list
+            the words of each sentence, only needed by other algorithms
+
+    Returns
+    -------
+        result : list
+            (boe, eoe, coe) of each sentence, ordered by begin
+    """
+    if algorithm not in [ 1, 2 ]:
+        if sentences is None:
+            sentences = [ [ u'' ] * n for n in n_word ]
+        result = []
+        for sentence, table, estimate, _ in ArrayPredictionParser(
+                ( (s,) for s in sentences ), prob, window, n_label_type ):
+            decoded = sorted( ArrayDecode( len(sentence), estimate, threshold,
+                                           algorithm, sentence, table ) )
+            result.append( tuple( zip(*decoded) ) if len(decoded) > 0 else ( [], [], [] ) )
+        return result
+
+    n_word = numpy.asarray( n_word, dtype = numpy.int64 )
+    sentence, begin, end = DocumentSpanIndex( n_word, window )
+    assert sentence.shape[0] == prob.shape[0], 'probability array does not match'
+
+    label = prob[:,1].astype( numpy.int64 )
+    score = prob[numpy.arange( prob.shape[0] ), 2 + label]
+    candidate = numpy.flatnonzero( (label != n_label_type) & (score >= threshold) )
+    sentence, begin, end = sentence[candidate], begin[candidate], end[candidate]
+    label, score = label[candidate], score[candidate]
+    n_candidate = candidate.shape[0]
+
+    # same tie-breaking as ArrayDecode, since candidates are in sentence order
+    if algorithm == 1:
+        order = numpy.lexsort( ( -score, ) )
+    else:
+        order = numpy.lexsort( ( -score, begin - end ) )
+    rank = numpy.empty( n_candidate, dtype = numpy.int64 )
+    rank[order] = numpy.arange( n_candidate )
+
+    # one entry per (candidate, token it covers); tokens are numbered across
+    # the document, so sentences never interact
+    n_token = int( n_word.sum() )
+    length = end - begin
+    owner = numpy.repeat( numpy.arange( n_candidate ), length )
+    token = numpy.repeat( (numpy.cumsum( n_word ) - n_word)[sentence] + begin, length ) + \
+            numpy.arange( owner.shape[0] ) - numpy.repeat( numpy.cumsum( length ) - length, length )
+
+    kept = numpy.zeros( n_candidate, dtype = numpy.bool_ )
+    while owner.shape[0] > 0:
+        best = numpy.empty( n_token, dtype = numpy.int64 )
+        best.fill( n_candidate )
+        numpy.minimum.at( best, token, rank[owner] )
+
+        beaten = numpy.bincount( owner, weights = best[token] != rank[owner],
+                                 minlength = n_candidate ) > 0
+        alive = numpy.zeros( n_candidate, dtype = numpy.bool_ )
+        alive[owner] = True
+        winner = alive & ~beaten
+        kept |= winner
+
+        used = numpy.zeros( n_token, dtype = numpy.bool_ )
+        used[token[winner[owner]]] = True
+        dropped = numpy.bincount( owner, weights = used[token], minlength = n_candidate ) > 0
+        remain = ~dropped[owner]
+        owner, token = owner[remain], token[remain]
+
+    kept = numpy.flatnonzero( kept )
+    kept = kept[numpy.lexsort( ( begin[kept], sentence[kept] ) )]
+    count = numpy.bincount( sentence[kept], minlength = n_word.shape[0] )
+
+    result = []
+    b, e, c = begin[kept].tolist(), end[kept].tolist(), label[kept].tolist()
+    start = 0
+    for n in count.tolist():
+        if n > 0:
+            result.append( ( tuple( b[start: start + n] ),
+                             tuple( e[start: start + n] ),
+                             tuple( c[start: start + n] ) ) )
+        else:
+            result.append( ( [], [], [] ) )
+        start += n
+    return result
+
+
+
+def DumpPrediction( prob, fp, n_label_type ):
+    """
+    Writes the probability array in the text format PredictionParser reads.
+    Only meant for debugging.
+    """
+    numpy.savetxt(
+        fp,
+        prob,
+        fmt = '%d  %d' + '  %f' * (n_label_type + 1)
+    )
+
+
+
+# Unit Test
+if __name__ == '__main__':
+    logging.basicConfig( format = '%(asctime)s : %(levelname)s : %(message)s',
+                         level = logging.INFO )
+
+    from io import BytesIO
+    try:
+        from gigaword2feature import PredictionParser, decode
+    except ImportError:
+        decode = None
+        logger.warning( 'gigaword2feature is not available, ArrayDecode is not checked against it' )
+
+    rng = numpy.random.RandomState( 0 )
+    window = 7
+
+    for n_label_type in [ 4, 10 ]:
+        for _ in xrange( 20 ):
+            sentences = [ ( [ 'w' ] * rng.randint( 0, 40 ), ) for _ in xrange( 50 ) ]
+            n_word = [ len(s[0]) for s in sentences ]
+            n_row = int( SpanCount( n_word, window ).sum() )
+
+            prob = numpy.zeros( (n_row, n_label_type + 3), dtype = numpy.float32 )
+            # coarse probabilities, so that ties are frequent
+            p = rng.dirichlet( numpy.ones( n_label_type + 1 ) * 0.2, n_row )
+            prob[:,2:] = numpy.round( p, 1 )
+            prob[:,1] = numpy.argmax( prob[:,2:], axis = 1 )
+
+            if decode is not None:
+                memory = BytesIO()
+                DumpPrediction( prob, memory, n_label_type )
+                memory.seek( 0 )
+                parsed = list( PredictionParser( ( (s[0], [], [], []) for s in sentences ),
+                                                 memory, window, n_label_type = n_label_type ) )
+
+            for algorithm in [ 1, 2 ]:
+                expected = []
+                for i, (sent, table, estimate, actual) in enumerate( ArrayPredictionParser(
+                        iter(sentences), prob, window, n_label_type ) ):
+                    decoded = sorted( ArrayDecode( len(sent), estimate, 0.4, algorithm ) )
+                    if decode is not None:
+                        # the original decoder on the table parsed from the text dump
+                        sent, table, estimate, _ = parsed[i]
+                        assert decoded == sorted( decode( sent, estimate, table, 0.4, algorithm ) )
+                    expected.append( zip(*decoded) if len(decoded) > 0 else [ [], [], [] ] )
+                actual = BatchDecode( n_word, prob, window, 0.4, algorithm, n_label_type )
+                assert [ map( list, x ) for x in actual ] == [ map( list, x ) for x in expected ]
+
+                if decode is not None:
+                    reference = []
+                    for sent, table, estimate, _ in parsed:
+                        decoded = sorted( decode( sent, estimate, table, 0.4, algorithm ) )
+                        reference.append( zip(*decoded) if len(decoded) > 0 else [ [], [], [] ] )
+                    assert [ map( list, x ) for x in actual ] == [ map( list, x ) for x in reference ]
+
+    logger.info( 'BatchDecode agrees with ArrayDecode' )
+    if decode is not None:
+        logger.info( 'ArrayDecode and BatchDecode agree with gigaword2feature.decode' )
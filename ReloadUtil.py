@@ -0,0 +1,348 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Hot model reload. reloadable_annotator stands in for fofe_ner_wrapper in
+the front ends. On an admin request, or when one of the model files
+changes, a new wrapper is built in the background and warmed up on
+recently annotated sentences. It is then swapped in under a lock. Requests
+already running keep the old wrapper, which is closed once the last of
+them returns.
+
+Model files should be replaced by rename, as `BundleUtil.py pack` does,
+rather than overwritten in place: the old wrapper may still map them.
+"""
+
+import os, gc, time, resource, threading, collections, logging
+from fofe_ner_wrapper import fofe_ner_wrapper
+from BundleUtil import IsBundle
+
+logger = logging.getLogger( __name__ )
+
+
+def _Status( field ):
+    """
+    Returns
+    -------
+        value : float
+            the field of /proc/self/status in megabytes, e.g. VmRSS;
+            None where there is no /proc
+    """
+    try:
+        with open( '/proc/self/status' ) as fp:
+            for line in fp:
+                if line.startswith( field + ':' ):
+                    return int( line.split()[1] ) / 1024.
+    except IOError:
+        pass
+    return None
+
+
+def ResidentMB():
+    rss = _Status( 'VmRSS' )
+    if rss is None:
+        # the peak rather than the current size, but better than nothing
+        rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.
+    return rss
+
+
+def ResetPeak():
+    """
+    Resets the peak resident size reported as VmHWM (Linux 4.0 and later).
+
+    Returns
+    -------
+        done : bool
+    """
+    try:
+        with open( '/proc/self/clear_refs', 'w' ) as fp:
+            fp.write( '5' )
+        return True
+    except IOError:
+        return False
+
+
+def ModelFiles( args ):
+    """
+    Returns
+    -------
+        files : list
+            the files fofe_ner_wrapper reads for args, whose change
+            triggers a reload
+    """
+    if IsBundle( args.model1st ):
+        return [ args.model1st ]
+
+    files = [ args.vocab1, args.vocab2, args.gazetteer, args.wubi ]
+    for model in [ args.model1st, args.model2nd, args.cascade ]:
+        if model is not None:
+            # the checkpoint index is written last by tf.train.Saver
+            files.extend( [ model + '.config', model + '.index',
+                            os.path.join( model + '.tables', 'tables.meta' ),
+                            os.path.join( model + '.numpy', 'config.pickle' ) ] )
+    return [ f for f in files if f is not None and os.path.isfile( f ) ]
+
+
+def _Stamp( files ):
+    stamp = []
+    for f in files:
+        try:
+            stamp.append( (f, os.path.getsize( f ), os.path.getmtime( f )) )
+        except OSError:
+            stamp.append( (f, None, None) )
+    return stamp
+
+
+
+class _generation( object ):
+    """
+    One loaded wrapper and the requests running on it.
+    """
+    def __init__( self, wrapper, number, footprint ):
+        self.wrapper = wrapper
+        self.number = number
+        # growth of the resident size while it was built, in megabytes
+        self.footprint = footprint
+        self.n_active = 0
+        self.retired = False
+        self.drained = threading.Event()
+
+
+
+class reloadable_annotator( object ):
+    """
+    Same annotate, stats and LoadNetwork as fofe_ner_wrapper; the wrapper
+    behind them is rebuilt from args by Reload.
+    """
+    def __init__( self, args, load_network = True, poll = 0, max_mb = 0, n_warmup = 32 ):
+        """
+        Parameters
+        ----------
+            args : argparse.Namespace
+                command-line arguments of server.py
+            load_network : bool
+                see fofe_ner_wrapper; only the first wrapper is built
+                without its networks, later ones are complete
+            poll : float
+                seconds between checks of the model files; 0 for none
+            max_mb : float
+                a reload is refused if the resident size may exceed this
+                many megabytes while both wrappers are loaded; 0 for no limit
+            n_warmup : int
+                number of recently annotated sentences a new wrapper is
+                run on before it is swapped in
+        """
+        self.args = args
+        self.poll = poll
+        self.max_mb = max_mb
+
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        self.recent = collections.deque( maxlen = n_warmup )
+        self.n_reload = 0
+        self.report = None
+        self.watcher = None
+        self.closed = False
+
+        self.files = ModelFiles( args )
+        self.stamp = _Stamp( self.files )
+        self.current = self.__Build( 0, load_network )
+        if load_network:
+            self.__Watch()
+
+
+    def __Build( self, number, load_network = True ):
+        before = ResidentMB()
+        wrapper = fofe_ner_wrapper( self.args, load_network = load_network )
+        return _generation( wrapper, number, max( ResidentMB() - before, 0 ) )
+
+
+    def LoadNetwork( self ):
+        """
+        Completes the first wrapper, e.g. in a worker after fork, which
+        is also where the watcher thread has to be started.
+        """
+        before = ResidentMB()
+        self.current.wrapper.LoadNetwork()
+        self.current.footprint += max( ResidentMB() - before, 0 )
+        self.__Watch()
+
+
+    def __Acquire( self ):
+        with self.lock:
+            generation = self.current
+            generation.n_active += 1
+            return generation
+
+
+    def __Release( self, generation ):
+        with self.lock:
+            generation.n_active -= 1
+            if generation.retired and generation.n_active == 0:
+                generation.drained.set()
+
+
+    def annotate( self, sentences, isDevMode = False ):
+        generation = self.__Acquire()
+        try:
+            result = generation.wrapper.annotate( sentences, isDevMode )
+        finally:
+            self.__Release( generation )
+        self.recent.extend( sentences )
+        return result
+
+
+    def stats( self ):
+        generation = self.__Acquire()
+        try:
+            report = generation.wrapper.stats()
+        finally:
+            self.__Release( generation )
+        report['reload'] = self.ReloadStats()
+        return report
+
+
+    def ReloadStats( self ):
+        return {
+            'generation': self.current.number,
+            'in_progress': self.reload_lock.locked(),
+            'reloads': self.n_reload,
+            'resident_mb': ResidentMB(),
+            'last': self.report,
+        }
+
+
+    def Trigger( self, reason ):
+        """
+        Starts Reload in a background thread unless one is running.
+
+        Returns
+        -------
+            started : bool
+        """
+        if self.reload_lock.locked():
+            return False
+        thread = threading.Thread( target = self.Reload, args = ( reason, ), name = 'reload' )
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+    def Reload( self, reason ):
+        """
+        Builds, warms up and swaps in a new wrapper, then waits for the
+        requests on the old one to return and frees it. The old wrapper
+        keeps serving if anything fails.
+
+        Returns
+        -------
+            report : dict
+                also kept for ReloadStats; None if a reload was running
+                or the annotator is closed
+        """
+        if not self.reload_lock.acquire( False ):
+            return None
+        try:
+            if self.closed:
+                return None
+            old = self.current
+            report = { 'reason': reason, 'started': time.time(),
+                       'resident_mb_before': ResidentMB() }
+            report['peak_reset'] = ResetPeak()
+
+            # a change is tried once; a failed attempt isn't repeated
+            # until the files change again
+            stamp = _Stamp( self.files )
+            self.stamp = stamp
+
+            # both wrappers are resident until the old one is drained
+            expected = report['resident_mb_before'] + old.footprint
+            report['expected_peak_mb'] = expected
+            if self.max_mb > 0 and expected > self.max_mb:
+                report['status'] = 'refused'
+                report['error'] = 'expected peak %.0f MB exceeds the limit of %.0f MB' % \
+                                  (expected, self.max_mb)
+                logger.warning( 'reload refused: %s' % report['error'] )
+                return self.__Done( report )
+
+            try:
+                generation = self.__Build( old.number + 1 )
+                warmup = list( self.recent )
+                if len(warmup) > 0:
+                    generation.wrapper.annotate( warmup, True )
+                report['warmup_sentences'] = len(warmup)
+            except Exception as ex:
+                logger.exception( 'reload failed, keeping generation %d' % old.number )
+                report['status'] = 'failed'
+                report['error'] = str(ex)
+                return self.__Done( report )
+            report['resident_mb_loaded'] = ResidentMB()
+            report['loaded'] = time.time()
+
+            with self.lock:
+                self.current = generation
+                old.retired = True
+                if old.n_active == 0:
+                    old.drained.set()
+            logger.info( 'generation %d swapped in (%s), draining generation %d' % \
+                         (generation.number, reason, old.number) )
+
+            old.drained.wait()
+            old.wrapper.Close()
+            del old
+            gc.collect()
+
+            report['status'] = 'done'
+            report['generation'] = generation.number
+            report['drained'] = time.time()
+            report['resident_mb_after'] = ResidentMB()
+            self.n_reload += 1
+            return self.__Done( report )
+        finally:
+            self.reload_lock.release()
+
+
+    def Close( self ):
+        """
+        Frees the wrapper once the requests running on it return, after any
+        reload in progress; the annotator cannot be used afterwards.
+        """
+        self.closed = True
+        with self.reload_lock:
+            with self.lock:
+                generation = self.current
+                generation.retired = True
+                if generation.n_active == 0:
+                    generation.drained.set()
+            generation.drained.wait()
+            generation.wrapper.Close()
+
+
+    def __Done( self, report ):
+        report['peak_mb'] = _Status( 'VmHWM' )
+        self.report = report
+        logger.info( 'reload: %s' % str(report) )
+        return report
+
+
+    def __Watch( self ):
+        if self.poll <= 0 or self.watcher is not None:
+            return
+        self.watcher = threading.Thread( target = self.__Poll, name = 'model-watcher' )
+        self.watcher.daemon = True
+        self.watcher.start()
+
+
+    def __Poll( self ):
+        last = None
+        while not self.closed:
+            time.sleep( self.poll )
+            stamp = _Stamp( self.files )
+            if stamp == self.stamp:
+                last = None
+            elif stamp == last and not self.closed:
+                # unchanged for one interval, i.e. no longer being written
+                changed = [ f for f, s in zip( self.files, zip( stamp, self.stamp ) ) \
+                            if s[0] != s[1] ]
+                self.Trigger( 'changed: ' + ', '.join( changed ) )
+            else:
+                last = stamp
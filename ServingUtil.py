@@ -0,0 +1,480 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Serving-time model formats. Everything here is derived once from a trained
+model and afterwards loaded without parsing; large arrays are opened
+read-only with numpy.memmap, so that worker processes on one host share a
+single page-cache copy.
+"""
+
+import numpy, os, copy, cPickle, argparse, logging, hashlib, threading, struct, weakref, itertools
+
+logger = logging.getLogger( __name__ )
+
+
+########################################################################
+
+
+def SaveTables( dirname, tables ):
+    """
+    Parameters
+    ----------
+        dirname : str
+            one raw <name>.bin per table plus tables.meta are written here
+        tables : dict
+            name -> ndarray
+    """
+    if not os.path.isdir( dirname ):
+        os.makedirs( dirname )
+
+    meta = {}
+    for name, table in tables.items():
+        table = numpy.ascontiguousarray( table )
+        # raw file, so the data starts at offset 0 and is page-aligned
+        table.tofile( os.path.join( dirname, name + '.bin' ) )
+        meta[name] = ( table.dtype.str, table.shape )
+
+    with open( os.path.join( dirname, 'tables.meta' ), 'wb' ) as fp:
+        cPickle.dump( meta, fp, cPickle.HIGHEST_PROTOCOL )
+
+
+def LoadTables( dirname ):
+    """
+    Returns
+    -------
+        tables : dict
+            name -> read-only numpy.memmap
+    """
+    with open( os.path.join( dirname, 'tables.meta' ), 'rb' ) as fp:
+        meta = cPickle.load( fp )
+
+    tables = {}
+    for name, (dtype, shape) in meta.items():
+        tables[name] = numpy.memmap(
+            os.path.join( dirname, name + '.bin' ),
+            dtype = numpy.dtype( dtype ),
+            mode = 'r',
+            shape = tuple( shape )
+        )
+    logger.info( 'memory-mapped tables: %s' % ', '.join( sorted( tables.keys() ) ) )
+    return tables
+
+
+########################################################################
+
+
+# sidecar path -> object, so that one process never builds the same thing
+# twice while it is in use; weak, so that e.g. the vocabularies of a model
+# reloaded from changed wordlists are freed with the last wrapper using them
+_cached = weakref.WeakValueDictionary()
+_cached_lock = threading.Lock()
+
+
+def _Stamp( sources ):
+    return [ (os.path.abspath( f ), os.path.getsize( f ), os.path.getmtime( f )) \
+             for f in sources ]
+
+
+def CachedObject( build, sources, key ):
+    """
+    Returns build(), which is expected to parse sources, e.g. a vocabulary 
+    built from a wordlist. The result is pickled to a binary sidecar next 
+    to sources[0] and later runs unpickle it instead of parsing the text 
+    again, as long as none of sources has changed. Within one process, the
+    same object is returned to every caller while any of them holds it, so
+    it must be read-only.
+
+    Parameters
+    ----------
+        build : callable
+        sources : list
+            files build() reads
+        key : tuple
+            everything else that determines the result
+    """
+    stamp = _Stamp( sources )
+    digest = hashlib.md5( repr( (stamp, key) ) ).hexdigest()[:16]
+    sidecar = '%s.%s.cache' % (sources[0], digest)
+
+    with _cached_lock:
+        result = _cached.get( sidecar )
+        if result is not None:
+            return result
+
+        result = None
+        if os.path.exists( sidecar ):
+            try:
+                with open( sidecar, 'rb' ) as fp:
+                    result = cPickle.load( fp )
+                logger.info( '%s loaded from %s' % (str(key), sidecar) )
+            except Exception:
+                logger.exception( 'ignoring broken sidecar %s' % sidecar )
+                result = None
+
+        if result is None:
+            result = build()
+            try:
+                with open( sidecar + '.tmp', 'wb' ) as fp:
+                    cPickle.dump( result, fp, cPickle.HIGHEST_PROTOCOL )
+                os.rename( sidecar + '.tmp', sidecar )
+            except Exception:
+                # e.g. read-only model directory or an object that can't be pickled
+                logger.warning( 'sidecar %s not written' % sidecar )
+
+        try:
+            _cached[sidecar] = result
+        except TypeError:
+            # e.g. a tuple, which can't be weakly referenced; not shared
+            pass
+        return result
+
+
+########################################################################
+
+
+class _layered_dict( dict ):
+    """
+    Read-only union of a shared base dict and the entries of its own, none
+    of which is in the base. It pickles as a plain dict.
+    """
+    def __init__( self, base, extra ):
+        dict.__init__( self, extra )
+        self.base = base
+
+    def __missing__( self, key ):
+        return self.base[key]
+
+    def get( self, key, default = None ):
+        if dict.__contains__( self, key ):
+            return dict.__getitem__( self, key )
+        return self.base.get( key, default )
+
+    def __contains__( self, key ):
+        return key in self.base or dict.__contains__( self, key )
+
+    has_key = __contains__
+
+    def __len__( self ):
+        return len(self.base) + dict.__len__( self )
+
+    def __iter__( self ):
+        return itertools.chain( self.base, dict.__iter__( self ) )
+
+    iterkeys = __iter__
+
+    def iteritems( self ):
+        return itertools.chain( self.base.iteritems(), dict.iteritems( self ) )
+
+    def itervalues( self ):
+        return itertools.chain( self.base.itervalues(), dict.itervalues( self ) )
+
+    def keys( self ):
+        return list( self.iterkeys() )
+
+    def items( self ):
+        return list( self.iteritems() )
+
+    def values( self ):
+        return list( self.itervalues() )
+
+    def copy( self ):
+        return dict( self.iteritems() )
+
+    def __reduce__( self ):
+        return ( dict, ( self.items(), ) )
+
+
+
+class _layered_list( list ):
+    """
+    Read-only concatenation of a shared base list and the items of its own.
+    It pickles as a plain list.
+    """
+    def __init__( self, base, extra ):
+        list.__init__( self, extra )
+        self.base = base
+
+    def __len__( self ):
+        return len(self.base) + list.__len__( self )
+
+    def __iter__( self ):
+        return itertools.chain( self.base, list.__iter__( self ) )
+
+    def __getitem__( self, index ):
+        if isinstance( index, slice ):
+            return list( self )[index]
+        n = len(self.base)
+        if index < 0:
+            index += len(self)
+        if 0 <= index < n:
+            return self.base[index]
+        return list.__getitem__( self, index - n )
+
+    def __getslice__( self, begin, end ):
+        return self[slice( max( begin, 0 ), max( end, 0 ) )]
+
+    def __reduce__( self ):
+        return ( list, ( list( self ), ) )
+
+
+
+def _Same( a, b ):
+    if isinstance( a, numpy.ndarray ) or isinstance( b, numpy.ndarray ):
+        return isinstance( a, numpy.ndarray ) and isinstance( b, numpy.ndarray ) and \
+               a.dtype == b.dtype and numpy.array_equal( a, b )
+    try:
+        return type(a) is type(b) and bool( a == b )
+    except Exception:
+        return False
+
+
+class label_rows( object ):
+    """
+    What a numericizer built with n_label_type adds to the same numericizer
+    built without, e.g. the label types appended to the word index of the
+    2nd pass. A dict or list attribute that only gains entries keeps just
+    those; any other attribute that differs is kept whole. If the two can't
+    be compared attribute by attribute, the labelled numericizer is kept
+    whole instead.
+    """
+    def __init__( self, base, labelled ):
+        self.whole = None
+        self.extended = {}
+        self.replaced = {}
+        self.removed = []
+
+        if type(base) is not type(labelled) or \
+                not hasattr( base, '__dict__' ) or not hasattr( labelled, '__dict__' ):
+            self.whole = labelled
+            return
+
+        for name, value in vars( labelled ).items():
+            if name not in vars( base ):
+                self.replaced[name] = value
+                continue
+            shared = getattr( base, name )
+            if _Same( shared, value ):
+                continue
+            if type(shared) is dict and type(value) is dict and \
+                    all( k in value and _Same( v, value[k] ) for k, v in shared.iteritems() ):
+                self.extended[name] = dict( (k, v) for k, v in value.iteritems() \
+                                            if k not in shared )
+            elif type(shared) is list and type(value) is list and \
+                    len(value) >= len(shared) and _Same( value[:len(shared)], shared ):
+                self.extended[name] = value[len(shared):]
+            else:
+                self.replaced[name] = value
+        self.removed = [ name for name in vars( base ) if name not in vars( labelled ) ]
+
+
+
+def LayerLabels( base, rows ):
+    """
+    Parameters
+    ----------
+        base
+            numericizer built without n_label_type, e.g. that of the 1st pass
+        rows : label_rows
+            of base
+
+    Returns
+    -------
+        numericizer
+            equal to the labelled one rows was taken from, sharing
+            everything but the label rows with base, which must not change
+    """
+    if rows.whole is not None:
+        return rows.whole
+    layered = copy.copy( base )
+    for name in rows.removed:
+        delattr( layered, name )
+    for name, extra in rows.extended.items():
+        shared = getattr( base, name )
+        if isinstance( shared, dict ):
+            setattr( layered, name, _layered_dict( shared, extra ) )
+        else:
+            setattr( layered, name, _layered_list( shared, extra ) )
+    for name, value in rows.replaced.items():
+        setattr( layered, name, value )
+    return layered
+
+
+########################################################################
+
+
+def GazetteerHash( key ):
+    """
+    64-bit hash of a gazetteer entry (a phrase or a sequence of tokens).
+    """
+    if isinstance( key, (tuple, list) ):
+        key = u'\x00'.join( key )
+    if isinstance( key, unicode ):
+        key = key.encode( 'utf8' )
+    return struct.unpack( '<Q', hashlib.md5( key ).digest()[:8] )[0]
+
+
+class gazetteer_view( object ):
+    """
+    The entries of one label type; supports what the list of sets in 
+    gaz.pkl is used for, i.e. membership tests.
+    """
+    def __init__( self, gazetteer, label ):
+        self.gazetteer = gazetteer
+        self.bit = 1 << label
+
+    def __contains__( self, key ):
+        return self.gazetteer.Mask( key ) & self.bit != 0
+
+    def __len__( self ):
+        return int( numpy.count_nonzero( self.gazetteer.mask & self.bit ) )
+
+
+class compact_gazetteer( object ):
+    """
+    Drop-in replacement of the list of sets pickled in gaz.pkl: hashed 
+    entries in one sorted array, plus one bit per label type. Both arrays 
+    are memory-mapped.
+    """
+    def __init__( self, hash, mask, n_label_type ):
+        """
+        Parameters
+        ----------
+            hash, mask : ndarray
+                returned by GazetteerArrays, e.g. memory-mapped
+            n_label_type : int
+        """
+        self.n_label_type = n_label_type
+        self.hash = hash
+        self.mask = mask
+        self.views = [ gazetteer_view( self, i ) for i in xrange( self.n_label_type ) ]
+        # batch_constructor asks about one span for every label type in a row
+        self.last = ( None, 0 )
+        logger.info( 'compact gazetteer of %d entries loaded' % self.hash.shape[0] )
+
+    def Mask( self, key ):
+        last_key, last_mask = self.last
+        if key == last_key:
+            return last_mask
+
+        h = numpy.uint64( GazetteerHash( key ) )
+        idx = int( numpy.searchsorted( self.hash, h ) )
+        if idx < self.hash.shape[0] and self.hash[idx] == h:
+            mask = int( self.mask[idx] )
+        else:
+            mask = 0
+        self.last = ( key, mask )
+        return mask
+
+    def __getitem__( self, label ):
+        return self.views[label]
+
+    def __len__( self ):
+        return self.n_label_type
+
+    def __iter__( self ):
+        return iter( self.views )
+
+
+def GazetteerArrays( gazetteer ):
+    """
+    Parameters
+    ----------
+        gazetteer : list
+            one set of entries per label type, as pickled in gaz.pkl
+
+    Returns
+    -------
+        hash, mask : ndarray
+            sorted entry hashes and the label types of each
+    """
+    n_label_type = len( gazetteer )
+    assert n_label_type <= 32, 'one bit per label type in uint32'
+
+    masks = {}
+    for label, entries in enumerate( gazetteer ):
+        for key in entries:
+            h = GazetteerHash( key )
+            masks[h] = masks.get( h, 0 ) | (1 << label)
+
+    hashes = numpy.fromiter( masks.iterkeys(), dtype = numpy.uint64, count = len(masks) )
+    order = numpy.argsort( hashes )
+    mask = numpy.fromiter( masks.itervalues(), dtype = numpy.uint32, count = len(masks) )
+    return hashes[order], mask[order]
+
+
+def ConvertGazetteer( gazetteer, dirname ):
+    """
+    Parameters
+    ----------
+        gazetteer : list
+            one set of entries per label type, as pickled in gaz.pkl
+        dirname : str
+            where LoadGazetteer will find it
+    """
+    n_label_type = len( gazetteer )
+    hashes, mask = GazetteerArrays( gazetteer )
+    SaveTables( dirname, { 'hash' : hashes, 'mask' : mask } )
+    with open( os.path.join( dirname, 'gazetteer.meta' ), 'wb' ) as fp:
+        cPickle.dump( n_label_type, fp, cPickle.HIGHEST_PROTOCOL )
+
+
+def LoadGazetteer( filename ):
+    """
+    Returns the gazetteer at filename: a directory written by 
+    ConvertGazetteer, or the original pickle.
+    """
+    if os.path.isdir( filename ):
+        with open( os.path.join( filename, 'gazetteer.meta' ), 'rb' ) as fp:
+            n_label_type = cPickle.load( fp )
+        tables = LoadTables( filename )
+        return compact_gazetteer( tables['hash'], tables['mask'], n_label_type )
+    with open( filename, 'rb' ) as fp:
+        return cPickle.load( fp )
+
+
+########################################################################
+
+
+def ExportTables( args ):
+    from fofe_mention_net import mention_config, fofe_mention_net
+
+    config = mention_config()
+    with open( '%s.config' % args.model, 'rb' ) as fp:
+        config.__dict__.update( cPickle.load( fp ).__dict__ )
+
+    mention_net = fofe_mention_net( config, None, inference_only = True )
+    mention_net.fromfile( args.model )
+    SaveTables( args.model + '.tables', mention_net.ExportTables() )
+    logger.info( 'tables of %s exported' % args.model )
+
+
+
+def ExportGazetteer( args ):
+    with open( args.gazetteer, 'rb' ) as fp:
+        gazetteer = cPickle.load( fp )
+    dirname = os.path.splitext( args.gazetteer )[0] + '.gaz'
+    ConvertGazetteer( gazetteer, dirname )
+    logger.info( '%s converted to %s' % (args.gazetteer, dirname) )
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig( format = '%(asctime)s : %(levelname)s : %(message)s',
+                         level = logging.INFO )
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    tables = subparsers.add_parser( 'tables',
+        help = 'write the embedding tables of a model to <model>.tables for memory-mapping' )
+    tables.add_argument( 'model', type = str, help = 'basename of the model' )
+    tables.set_defaults( func = ExportTables )
+
+    gazetteer = subparsers.add_parser( 'gazetteer',
+        help = 'convert a pickled gazetteer, e.g. gaz.pkl, to a memory-mappable gaz.gaz' )
+    gazetteer.add_argument( 'gazetteer', type = str, help = 'the pickled gazetteer' )
+    gazetteer.set_defaults( func = ExportGazetteer )
+
+    args = parser.parse_args()
+    args.func( args )
+
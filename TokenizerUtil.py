@@ -0,0 +1,800 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+# -*- coding: utf-8 -*-
+
+import os, sys, re, time, json, logging, threading, argparse, numpy, requests
+
+logger = logging.getLogger( __name__ )
+
+
+class corenlp_backend( object ):
+    def __init__( self, url ):
+        self.url = url.rstrip( '/' )
+        self.session = None
+        self.pid = None
+        self.in_flight = 0
+        self.latency = 0.        # exponentially weighted, in seconds
+        self.n_call = 0
+        self.n_failure = 0
+        self.ejected_until = 0.
+
+    def Session( self, pool_size ):
+        # a forked worker must not reuse the connections of its parent
+        if self.pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter( pool_connections = 1,
+                                                     pool_maxsize = pool_size )
+            session.mount( 'http://', adapter )
+            session.mount( 'https://', adapter )
+            self.session, self.pid = session, os.getpid()
+        return self.session
+
+
+class corenlp_pool( object ):
+    """
+    Keep-alive client of several Stanford CoreNLP servers. Each call goes to
+    the healthy backend with the fewest calls in flight; a backend that can't
+    be reached, times out or becomes slow is ejected for a while, and its
+    calls fail over to the others. An error response is the document's
+    doing rather than the backend's, so it is raised without failover.
+    """
+    def __init__( self, endpoints, timeout = 15., slow = 5., cooldown = 10.,
+                  pool_size = 16, slow_size = 4096 ):
+        """
+        Parameters
+        ----------
+            endpoints : list
+                URLs like http://localhost:9000; a bare port means localhost
+            timeout : float
+                seconds allowed per call
+            slow : float
+                backends whose average latency exceeds it get ejected
+            slow_size : int
+                bytes of text a call may take slow seconds on; larger
+                calls are allowed proportionally longer
+            cooldown : float
+                seconds an ejected backend is left alone before a health check
+            pool_size : int
+                keep-alive connections per backend
+        """
+        self.backends = []
+        for endpoint in endpoints:
+            if endpoint.isdigit():
+                endpoint = 'http://localhost:' + endpoint
+            self.backends.append( corenlp_backend( endpoint ) )
+        assert len(self.backends) > 0, 'no CoreNLP endpoint is given'
+
+        self.timeout = timeout
+        self.slow = slow
+        self.slow_size = slow_size
+        self.cooldown = cooldown
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.n_pick = 0
+
+
+    def _Pick( self, tried ):
+        now = time.time()
+        with self.lock:
+            candidates = [ b for b in self.backends if b not in tried ]
+            healthy = [ b for b in candidates if b.ejected_until <= now ]
+            if len(healthy) > 0:
+                candidates = healthy
+            else:
+                # everything is ejected: health-check the one ejected first
+                candidates = sorted( candidates, key = lambda b: b.ejected_until )[:1]
+            if len(candidates) == 0:
+                return None
+            # round robin among the least loaded
+            least = min( b.in_flight for b in candidates )
+            candidates = [ b for b in candidates if b.in_flight == least ]
+            backend = candidates[self.n_pick % len(candidates)]
+            self.n_pick += 1
+            backend.in_flight += 1
+            return backend
+
+
+    def _Done( self, backend, elapsed, failed, size = 0 ):
+        """
+        Parameters
+        ----------
+            failed : bool
+                the backend couldn't be reached or timed out
+            size : int
+                bytes of text sent, which the latency is scaled by
+        """
+        with self.lock:
+            backend.in_flight -= 1
+            backend.n_call += 1
+            if failed:
+                backend.n_failure += 1
+                backend.ejected_until = time.time() + self.cooldown
+                logger.warning( 'CoreNLP backend %s ejected after a failure' % backend.url )
+            else:
+                elapsed /= max( 1., size / float(self.slow_size) )
+                if backend.latency == 0:
+                    backend.latency = elapsed
+                else:
+                    backend.latency = 0.8 * backend.latency + 0.2 * elapsed
+                if backend.latency > self.slow:
+                    backend.ejected_until = time.time() + self.cooldown
+                    backend.latency = 0
+                    logger.warning( 'CoreNLP backend %s ejected for being slow' % backend.url )
+                else:
+                    backend.ejected_until = 0
+
+
+    def _Rejected( self, backend ):
+        """
+        The backend answered with an error, which isn't held against it.
+        """
+        with self.lock:
+            backend.in_flight -= 1
+            backend.n_call += 1
+            backend.n_failure += 1
+
+
+    def annotate( self, text, properties ):
+        """
+        Same as pycorenlp.StanfordCoreNLP.annotate with JSON output.
+
+        Returns
+        -------
+            output : dict
+                the parsed CoreNLP response
+        """
+        if isinstance( text, unicode ):
+            text = text.encode( 'utf8' )
+
+        tried, error = set(), None
+        while True:
+            backend = self._Pick( tried )
+            if backend is None:
+                raise IOError( 'all CoreNLP backends failed: %s' % str(error) )
+            tried.add( backend )
+
+            start = time.time()
+            try:
+                response = backend.Session( self.pool_size ).post(
+                    backend.url,
+                    params = { 'properties': json.dumps( properties ) },
+                    data = text,
+                    timeout = self.timeout
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                self._Done( backend, time.time() - start, True )
+                error = ex
+                continue
+
+            try:
+                response.raise_for_status()
+                output = response.json()
+            except Exception:
+                self._Rejected( backend )
+                raise
+
+            self._Done( backend, time.time() - start, False, len(text) )
+            return output
+
+
+    def stats( self ):
+        now = time.time()
+        with self.lock:
+            return [ { 'url': b.url,
+                       'in_flight': b.in_flight,
+                       'latency_ms': b.latency * 1000,
+                       'calls': b.n_call,
+                       'failures': b.n_failure,
+                       'ejected': b.ejected_until > now } for b in self.backends ]
+
+
+
+########################################################################
+
+
+# abbreviations that keep their period; lowercase, without the period, and
+# none that is also a common sentence-final word (e.g. no, mar)
+_abbreviation = {
+    'eng' : set( [ 'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'mt', 'ft',
+                   'gen', 'gov', 'sen', 'rep', 'rev', 'sgt', 'col', 'capt', 'lt',
+                   'inc', 'corp', 'co', 'ltd', 'bros', 'dept', 'vs', 'etc',
+                   'vol', 'fig', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul',
+                   'aug', 'sep', 'sept', 'oct', 'nov', 'dec' ] ),
+    'spa' : set( [ 'sr', 'sra', 'srta', 'sres', 'dr', 'dra', 'lic', 'ing', 'prof',
+                   'av', 'avda', 'pág', 'págs', 'núm', 'tel', 'etc', 'vs',
+                   'ud', 'uds', 'vd', 'vds', 'dña', 'art', 'cía', 'ej', 'aprox',
+                   'ene', 'feb', 'abr', 'jun', 'jul', 'ago', 'sept', 'oct',
+                   'nov', 'dic' ] ),
+}
+
+# PTB escaping done by CoreNLP's default tokenize.options
+_escape = { u'(' : u'-LRB-', u')' : u'-RRB-', u'[' : u'-LSB-', u']' : u'-RSB-',
+            u'{' : u'-LCB-', u'}' : u'-RCB-', u'…' : u'...',
+            u'“' : u'``', u'”' : u"''", u'‘' : u'`', u'’' : u"'",
+            u'«' : u'``', u'»' : u"''" }
+
+_english_clitic = re.compile( ur"(?i)^(.+?)(n't|'s|'re|'ve|'ll|'d|'m)$" )
+
+# words PTB splits in two, lowercase -> length of the first part
+_english_split = { u'cannot' : 3, u'gonna' : 3, u'gotta' : 3, u'wanna' : 3,
+                   u'lemme' : 3, u'gimme' : 3 }
+
+# Spanish contractions, lowercase -> the two words CoreNLP splits them into
+_spanish_contraction = { u'del' : ( u'de', u'el' ), u'al' : ( u'a', u'el' ) }
+
+# pronouns attached to Spanish infinitives, gerunds and affirmative
+# imperatives, e.g. decirlo, diciéndoselo, dámelo; CoreNLP tries one, then two
+_spanish_one_pronoun = re.compile( ur'([mts]e|n?os|les?|l[oa]s?)$' )
+_spanish_two_pronouns = re.compile( ur'([mts]e|n?os|les?)(l[eoa]s?)$' )
+
+# infinitives that may carry pronouns; like the lexicon of CoreNLP's
+# SpanishVerbStripper, it keeps words such as suerte or Carlos whole
+_spanish_verb_file = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ),
+                                   'data', 'spanish-verbs.txt' )
+
+# irregular imperatives (accents removed) -> infinitive
+_spanish_irregular = { u'da' : u'dar', u'de' : u'dar', u'di' : u'decir', u'haz' : u'hacer',
+                       u'pon' : u'poner', u'ten' : u'tener', u'ven' : u'venir',
+                       u'sal' : u'salir', u'id' : u'ir', u'vamos' : u'ir', u'vaya' : u'ir',
+                       u'vea' : u'ver', u'sea' : u'ser', u'sepa' : u'saber',
+                       u'haga' : u'hacer', u'diga' : u'decir', u'ponga' : u'poner',
+                       u'tenga' : u'tener', u'venga' : u'venir', u'salga' : u'salir',
+                       u'traiga' : u'traer', u'oiga' : u'oir', u'caiga' : u'caer',
+                       u'valga' : u'valer' }
+
+# one-syllable imperatives, which take a single pronoun without an accent
+# (dame, hazlo); any other imperative with a pronoun is written with one
+_spanish_short_imperative = set( [ u'da', u'de', u'den', u'di', u'haz', u'pon',
+                                   u'ten', u'ven', u'sal' ] )
+
+_unaccented = dict( zip( u'áéíóúÁÉÍÓÚ', u'aeiouAEIOU' ) )
+
+_token = re.compile( ur"""
+      (?P<url>     (?:https?://|www\.)[^\s<>"]*[^\s<>".,;:!?'")\]}] )
+    | (?P<email>   [\w.+-]+@[\w-]+(?:\.[\w-]+)+ )
+    | (?P<number>  (?:(?<![\w.])[-+])?\d+(?:[.,:/]\d+)* )
+    | (?P<acronym> (?:[^\W\d_]\.){2,} )
+    | (?P<word>    [^\W_]+(?:[-'’][^\W_]+)*(?:\.(?!\.))? )
+    | (?P<ellipsis>\.\.\.+|… )
+    | (?P<repeat>  [!?]+|-{2,}|`{2}|'{2} )
+    | (?P<quote>   ["'`] )
+    | (?P<other>   \S )
+""", re.UNICODE | re.VERBOSE )
+
+_boundary = re.compile( ur'^(?:\.|[!?]+)$' )
+_boundary_follower = set( [ u'-RRB-', u'-RSB-', u'-RCB-', u"''", u"'", u'"' ] )
+_paragraph = re.compile( ur'\n\s*\n' )
+
+
+def _Unaccent( word ):
+    return u''.join( _unaccented.get( c, c ) for c in word )
+
+
+def _SpanishStems( stem ):
+    """
+    Yields stem and what it is before the spelling changes of the 
+    subjunctive (busqu-, pagu-, empiec-, conozc-, escoj-) and the stem 
+    changes of e.g. cierr-, vuelv-, jueg-, pid-, durm-.
+    """
+    spelled = [ stem ]
+    for changed, plain in [ (u'qu', u'c'), (u'gu', u'g'), (u'zc', u'c'), (u'c', u'z'), (u'j', u'g') ]:
+        if stem.endswith( changed ):
+            spelled.append( stem[:-len(changed)] + plain )
+    for s in spelled:
+        yield s
+        for changed, plain in [ (u'ie', u'e'), (u'ue', u'o'), (u'ue', u'u'), (u'i', u'e'), (u'u', u'o') ]:
+            k = s.rfind( changed )
+            if k >= 0:
+                yield s[:k] + plain + s[k + len(changed):]
+
+
+def _SpanishImperative( form ):
+    """
+    Yields the infinitives form (accents removed) may be the affirmative 
+    imperative of, for tú, usted, ustedes or nosotros.
+    """
+    forms = [ form ]
+    if form.endswith( u'n' ):
+        forms.append( form[:-1] )
+    if form.endswith( u'mos' ):
+        forms.append( form[:-3] )
+    for f in forms:
+        if f in _spanish_irregular:
+            yield _spanish_irregular[f]
+        if len(f) >= 3 and f[-1] in u'ae':
+            for stem in _SpanishStems( f[:-1] ):
+                for ending in [ u'ar', u'er', u'ir' ]:
+                    yield stem + ending
+
+
+def _SpanishGerund( form ):
+    """
+    Yields the infinitives form (accents removed) may be the gerund of.
+    """
+    if form.endswith( u'ando' ):
+        yield form[:-4] + u'ar'
+    elif form.endswith( u'iendo' ) or form.endswith( u'yendo' ):
+        # diciendo, durmiendo, leyendo, yendo, riendo
+        base = form[:-5]
+        for stem in _SpanishStems( base ):
+            yield stem + u'er'
+            yield stem + u'ir'
+        yield base + u'eir'
+
+
+def _SpanishEnclitic( original, verbs ):
+    """
+    Splits the pronouns off a Spanish verb the way CoreNLP's 
+    SpanishVerbStripper does: the verb loses its accents, and the s of 
+    nosotros dropped before nos or se is put back, e.g. Dámelo -> Da me lo,
+    vámonos -> vamos nos. Vosotros imperatives with os are kept whole, 
+    since most words of that shape are nouns (Dios, correos).
+
+    Parameters
+    ----------
+        original : unicode
+        verbs : set
+            infinitives without accents
+
+    Returns
+    -------
+        tokens : list
+            (word, originalText, begin, end) with offsets into original;
+            None if original is not a verb with pronouns
+    """
+    word = original.lower()
+    if not word.isalpha():
+        return None
+
+    for pattern in [ _spanish_one_pronoun, _spanish_two_pronouns ]:
+        match = pattern.search( word )
+        if match is None or match.start() < 2:
+            continue
+        k = match.start()
+        pronouns = match.groups()
+        stem = _Unaccent( word[:k] )
+        accented = stem != word[:k]
+        restored = u's' if stem.endswith( u'mo' ) and pronouns[0] in ( u'nos', u'se' ) else u''
+
+        if stem in verbs:
+            pass
+        elif stem.endswith( u'ndo' ):
+            # a gerund with pronouns is stressed on the ándo or iéndo
+            if not word[:k].endswith( (u'ándo', u'éndo') ) or \
+                    not any( v in verbs for v in _SpanishGerund( stem ) ):
+                continue
+        elif pronouns[0] == u'os':
+            if stem != u'id':
+                continue
+        elif accented or (len(pronouns) == 1 and stem in _spanish_short_imperative):
+            if not any( v in verbs for v in _SpanishImperative( stem + restored ) ):
+                continue
+        else:
+            continue
+
+        if original[:k].isupper():
+            restored = restored.upper()
+        tokens = [ ( _Unaccent( original[:k] ) + restored, original[:k], 0, k ) ]
+        for p in pronouns:
+            tokens.append( ( original[k: k + len(p)], original[k: k + len(p)], k, k + len(p) ) )
+            k += len(p)
+        return tokens
+    return None
+
+
+def _Utf16Offset( text ):
+    """
+    Returns a function mapping code-point offsets of text to the UTF-16 
+    offsets CoreNLP reports.
+    """
+    if sys.maxunicode <= 0xFFFF:
+        # narrow build: unicode is already UTF-16
+        return lambda i: i
+    astral = numpy.fromiter( ( ord(c) > 0xFFFF for c in text ), dtype = numpy.int64,
+                             count = len(text) )
+    if not astral.any():
+        return lambda i: i
+    before = numpy.concatenate( [ [ 0 ], numpy.cumsum( astral ) ] )
+    return lambda i: i + int( before[i] )
+
+
+class native_tokenizer( object ):
+    """
+    In-process stand-in for CoreNLP's tokenize,ssplit annotators on English 
+    and Spanish, i.e. PTB-style tokens and splits after sentence-final 
+    punctuation or a blank line. It answers annotate() with the subset of 
+    the CoreNLP JSON that server.tokenize reads. It is an approximation, so
+    measure it with `TokenizerUtil.py parity` on recorded traffic before 
+    switching a language to it.
+
+    Known divergences: Spanish verbs with enclitic pronouns (e.g. Dámelo)
+    are only split if their infinitive is in data/spanish-verbs.txt, a 
+    shorter verb lexicon than CoreNLP's, and vosotros imperatives with os
+    (e.g. sentaos) are kept whole.
+    """
+    def __init__( self, language ):
+        assert language in _abbreviation, '%s is not supported' % language
+        self.language = language
+        self.abbreviation = _abbreviation[language]
+        self.verbs = None
+        if language == 'spa':
+            with open( _spanish_verb_file, 'rb' ) as fp:
+                self.verbs = set( line.decode( 'utf8' ).strip() for line in fp )
+
+
+    def __Split( self, text ):
+        """
+        Yields (word, originalText, begin, end) with begin/end in code points.
+        """
+        for match in _token.finditer( text ):
+            kind, original = match.lastgroup, match.group()
+            begin, end = match.span()
+
+            if kind == 'word' and original.endswith( u'.' ):
+                if original[:-1].lower() not in self.abbreviation:
+                    # a plain word followed by a period
+                    original, end = original[:-1], end - 1
+                    for token in self.__Word( original, begin ):
+                        yield token
+                    yield u'.', u'.', end, end + 1
+                    continue
+                kind = 'acronym'
+
+            if kind == 'word':
+                for token in self.__Word( original, begin ):
+                    yield token
+            elif kind == 'ellipsis':
+                yield u'...', original, begin, end
+            elif kind == 'quote' or (kind == 'repeat' and original in (u"''", u'``')):
+                # opening quotes follow a space, an opening bracket or nothing
+                opening = begin == 0 or text[begin - 1].isspace() or text[begin - 1] in u'([{'
+                if original == u"''":
+                    word = u"''"
+                elif original in (u'"', u'``'):
+                    word = u'``' if opening else u"''"
+                else:
+                    word = u'`' if opening and original == u'`' else u"'"
+                yield word, original, begin, end
+            else:
+                yield _escape.get( original, original ), original, begin, end
+
+
+    def __Word( self, original, begin ):
+        end = begin + len(original)
+        if self.language == 'eng':
+            normalized = original.replace( u'’', u"'" )
+            k = _english_split.get( normalized.lower() )
+            if k is None:
+                match = _english_clitic.match( normalized )
+                if match is not None:
+                    k = len( match.group(1) )
+            if k is not None:
+                yield normalized[:k], original[:k], begin, begin + k
+                yield normalized[k:], original[k:], begin + k, end
+                return
+        elif self.language == 'spa':
+            words = _spanish_contraction.get( original.lower() )
+            if words is not None:
+                # the article takes the last letter; the case of the first
+                # letter carries over to the preposition
+                k = len(original) - 1
+                first = words[0].capitalize() if original[0].isupper() else words[0]
+                yield first, original[:k], begin, begin + k
+                yield words[1], original[k:], begin + k, end
+                return
+            tokens = _SpanishEnclitic( original, self.verbs )
+            if tokens is not None:
+                for word, text, b, e in tokens:
+                    yield word, text, begin + b, begin + e
+                return
+        yield original.replace( u'’', u"'" ), original, begin, end
+
+
+    def annotate( self, text, properties = None ):
+        """
+        Returns
+        -------
+            output : dict
+                {'sentences': [{'tokens': [{'word', 'originalText', 
+                'characterOffsetBegin', 'characterOffsetEnd'}]}]}
+        """
+        if not isinstance( text, unicode ):
+            text = text.decode( 'utf8' )
+        offset = _Utf16Offset( text )
+        breaks = [ m.start() for m in _paragraph.finditer( text ) ]
+
+        sentences, tokens, ended = [], [], False
+        b = 0
+        for word, original, begin, end in self.__Split( text ):
+            # a blank line between the previous token and this one
+            while b < len(breaks) and breaks[b] < begin:
+                b += 1
+                ended = True
+            if ended and not (word in _boundary_follower and len(tokens) > 0 \
+                              and _boundary.match( tokens[-1]['word'] ) \
+                              and tokens[-1]['characterOffsetEnd'] == offset( begin )):
+                if len(tokens) > 0:
+                    sentences.append( { 'tokens' : tokens } )
+                tokens, ended = [], False
+
+            tokens.append( { 'word' : word,
+                             'originalText' : original,
+                             'characterOffsetBegin' : offset( begin ),
+                             'characterOffsetEnd' : offset( end ) } )
+            if _boundary.match( word ):
+                ended = True
+
+        if len(tokens) > 0:
+            sentences.append( { 'tokens' : tokens } )
+
+        for i, sentence in enumerate( sentences ):
+            sentence['index'] = i
+            for j, token in enumerate( sentence['tokens'] ):
+                token['index'] = j + 1
+        return { 'sentences' : sentences }
+
+
+
+########################################################################
+
+
+def _Reduce( output ):
+    return [ [ ( t['word'], t['originalText'],
+                 t['characterOffsetBegin'], t['characterOffsetEnd'] ) \
+               for t in s['tokens'] ] for s in output['sentences'] ]
+
+
+def _Properties( language ):
+    properties = { 'annotators': 'tokenize,ssplit', 'outputFormat': 'json' }
+    if language == 'spa':
+        properties['tokenize.language'] = 'es'
+    return properties
+
+
+def Record( args ):
+    """
+    Sends every document of a corpus (one per line, \\n escaped as \\\\n) to
+    CoreNLP and saves the tokens as JSON lines, for Parity to compare against.
+    """
+    pool = corenlp_pool( args.endpoint.split( ',' ) )
+    properties = _Properties( args.language )
+    n_doc = 0
+    with open( args.corpus, 'rb' ) as corpus, open( args.recorded, 'wb' ) as fp:
+        for line in corpus:
+            text = line.decode( 'utf8' ).rstrip( u'\r\n' ).replace( u'\\n', u'\n' )
+            if len(text.strip()) == 0:
+                continue
+            output = pool.annotate( text, properties )
+            fp.write( json.dumps( { 'language' : args.language,
+                                    'text' : text,
+                                    'sentences' : _Reduce( output ) } ) + '\n' )
+            n_doc += 1
+    logger.info( '%d documents recorded' % n_doc )
+
+
+def Agreement( recorded, show = 0 ):
+    """
+    Runs native_tokenizer on what Record saved and reports how much of
+    the CoreNLP output it reproduces.
+
+    Parameters
+    ----------
+        recorded : str
+            JSON lines written by Record
+        show : int
+            number of mismatching documents to log
+
+    Returns
+    -------
+        agreement : float
+            fraction of the recorded tokens reproduced exactly
+    """
+    tokenizers = {}
+    n_doc = n_doc_same = n_sent = n_sent_same = n_token = n_token_same = 0
+    shown = 0
+
+    with open( recorded, 'rb' ) as fp:
+        for line in fp:
+            recorded = json.loads( line )
+            language = recorded['language']
+            if language not in tokenizers:
+                tokenizers[language] = native_tokenizer( language )
+            expected = [ [ tuple(t) for t in s ] for s in recorded['sentences'] ]
+            actual = _Reduce( tokenizers[language].annotate( recorded['text'] ) )
+
+            expected_tokens = set( t for s in expected for t in s )
+            actual_tokens = set( t for s in actual for t in s )
+            expected_sents = set( (s[0][2], s[-1][3]) for s in expected if len(s) > 0 )
+            actual_sents = set( (s[0][2], s[-1][3]) for s in actual if len(s) > 0 )
+
+            n_doc += 1
+            n_doc_same += int( expected == actual )
+            n_sent += len(expected_sents)
+            n_sent_same += len(expected_sents & actual_sents)
+            n_token += len(expected_tokens)
+            n_token_same += len(expected_tokens & actual_tokens)
+
+            if expected != actual and shown < show:
+                shown += 1
+                logger.info( u'mismatch in: %s\n  corenlp only: %s\n  native only:  %s' % \
+                             ( recorded['text'][:200],
+                               sorted( expected_tokens - actual_tokens )[:10],
+                               sorted( actual_tokens - expected_tokens )[:10] ) )
+
+    agreement = float(n_token_same) / max( n_token, 1 )
+    logger.info( 'documents identical: %d / %d' % (n_doc_same, n_doc) )
+    logger.info( 'sentences identical: %d / %d' % (n_sent_same, n_sent) )
+    logger.info( 'tokens identical:    %d / %d (%.4f)' % (n_token_same, n_token, agreement) )
+    return agreement
+
+
+def Parity( args ):
+    if Agreement( args.recorded, args.show ) < args.min_agreement:
+        sys.exit( 1 )
+
+
+
+# Unit Test
+def SelfTest( args ):
+    import BaseHTTPServer, SocketServer, urlparse, socket
+
+    def stub( delay, status ):
+        class handler( BaseHTTPServer.BaseHTTPRequestHandler ):
+            def do_POST( self ):
+                text = self.rfile.read( int( self.headers['Content-Length'] ) ).decode( 'utf8' )
+                properties = json.loads( urlparse.parse_qs(
+                        urlparse.urlparse( self.path ).query )['properties'][0] )
+                assert properties['annotators'] == 'tokenize,ssplit'
+                time.sleep( delay )
+                tokens, offset = [], 0
+                for w in text.split():
+                    offset = text.index( w, offset )
+                    tokens.append( { 'word': w, 'originalText': w,
+                                     'characterOffsetBegin': offset,
+                                     'characterOffsetEnd': offset + len(w) } )
+                    offset += len(w)
+                body = json.dumps( { 'sentences': [ { 'tokens': tokens } ] } )
+                self.send_response( status )
+                self.send_header( 'Content-Type', 'application/json' )
+                self.send_header( 'Content-Length', str(len(body)) )
+                self.end_headers()
+                self.wfile.write( body )
+            def log_message( self, *args ):
+                pass
+        class server( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+            daemon_threads = True
+        httpd = server( ('localhost', 0), handler )
+        httpd.protocol_version = 'HTTP/1.1'
+        thread = threading.Thread( target = httpd.serve_forever )
+        thread.daemon = True
+        thread.start()
+        return 'http://localhost:%d' % httpd.server_address[1]
+
+    # a port nothing listens on
+    closed = socket.socket()
+    closed.bind( ('localhost', 0) )
+    dead = 'http://localhost:%d' % closed.getsockname()[1]
+    closed.close()
+    good, slow, broken = stub( 0, 200 ), stub( 0.3, 200 ), stub( 0, 500 )
+    pool = corenlp_pool( [ dead, good, slow ], timeout = 1, slow = 0.2, cooldown = 60 )
+    properties = { 'annotators': 'tokenize,ssplit', 'outputFormat': 'json' }
+
+    for _ in xrange( 20 ):
+        output = pool.annotate( u'Barack Obama visited Toronto .', properties )
+        assert [ t['word'] for t in output['sentences'][0]['tokens'] ] == \
+               [ u'Barack', u'Obama', u'visited', u'Toronto', u'.' ]
+
+    report = { s['url']: s for s in pool.stats() }
+    assert report[dead]['ejected'] and report[dead]['failures'] == 1
+    assert report[slow]['ejected'] and report[slow]['calls'] == 1
+    assert report[good]['calls'] + report[slow]['calls'] == 20
+    assert not report[good]['ejected']
+
+    # an error response neither ejects the backend nor fails over
+    pool = corenlp_pool( [ broken, good ], timeout = 1, cooldown = 60 )
+    try:
+        pool.annotate( u'Barack Obama', properties )
+        assert False, 'the error response is not raised'
+    except requests.exceptions.HTTPError:
+        pass
+    report = { s['url']: s for s in pool.stats() }
+    assert report[broken]['failures'] == 1 and not report[broken]['ejected']
+    assert report[good]['calls'] == 0
+
+    # larger calls are allowed proportionally longer
+    pool = corenlp_pool( [ slow ], timeout = 1, slow = 0.2, slow_size = 16 )
+    pool.annotate( u'Barack Obama visited Toronto and Ottawa last week .', properties )
+    assert not pool.stats()[0]['ejected']
+
+    timeout = corenlp_pool( [ stub( 2, 200 ) ], timeout = 0.5 )
+    try:
+        timeout.annotate( u'too slow', properties )
+        assert False, 'timeout is not enforced'
+    except IOError:
+        pass
+
+    # PTB conventions CoreNLP follows on English and Spanish
+    eng = native_tokenizer( 'eng' )
+    output = eng.annotate( u'Mr. Smith doesn\'t live in the U.S. (yet). "Really?" he asked...\n\nNo.' )
+    assert [ [ t['word'] for t in s['tokens'] ] for s in output['sentences'] ] == \
+        [ [ u'Mr.', u'Smith', u'does', u"n't", u'live', u'in', u'the', u'U.S.',
+            u'-LRB-', u'yet', u'-RRB-', u'.' ],
+          [ u'``', u'Really', u'?', u"''" ],
+          [ u'he', u'asked', u'...' ],
+          [ u'No', u'.' ] ]
+    tokens = output['sentences'][0]['tokens']
+    assert [ (t['originalText'], t['characterOffsetBegin']) for t in tokens[2:4] ] == \
+        [ (u'does', 10), (u"n't", 14) ]
+
+    spa = native_tokenizer( 'spa' )
+    output = spa.annotate( u'¿Dónde vive la Sra. García? En Madrid, desde 1.990.' )
+    assert [ [ t['word'] for t in s['tokens'] ] for s in output['sentences'] ] == \
+        [ [ u'¿', u'Dónde', u'vive', u'la', u'Sra.', u'García', u'?' ],
+          [ u'En', u'Madrid', u',', u'desde', u'1.990', u'.' ] ]
+
+    output = eng.annotate( u'I cannot say, Gonna try.' )
+    assert [ t['word'] for t in output['sentences'][0]['tokens'] ] == \
+        [ u'I', u'can', u'not', u'say', u',', u'Gon', u'na', u'try', u'.' ]
+    output = spa.annotate( u'Del museo al parque.' )
+    assert [ (t['word'], t['originalText']) for t in output['sentences'][0]['tokens'] ] == \
+        [ (u'De', u'De'), (u'el', u'l'), (u'museo', u'museo'), (u'a', u'a'), (u'el', u'l'),
+          (u'parque', u'parque'), (u'.', u'.') ]
+
+    output = spa.annotate( u'Dámelo. Quiero decírselo a Carlos, vámonos con suerte.' )
+    assert [ [ (t['word'], t['originalText'], t['characterOffsetBegin'])
+               for t in s['tokens'] ] for s in output['sentences'] ] == \
+        [ [ (u'Da', u'Dá', 0), (u'me', u'me', 2), (u'lo', u'lo', 4), (u'.', u'.', 6) ],
+          [ (u'Quiero', u'Quiero', 8), (u'decir', u'decír', 15), (u'se', u'se', 20),
+            (u'lo', u'lo', 22), (u'a', u'a', 25), (u'Carlos', u'Carlos', 27), (u',', u',', 33),
+            (u'vamos', u'vámo', 35), (u'nos', u'nos', 39), (u'con', u'con', 43),
+            (u'suerte', u'suerte', 47), (u'.', u'.', 53) ] ]
+
+    # PTB tokens written out by hand in the format of Record, so this is a
+    # regression check rather than parity with CoreNLP, which only
+    # `TokenizerUtil.py parity` on recorded traffic measures
+    fixture = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ),
+                            'data', 'ptb-tokenize.jsonl' )
+    assert Agreement( fixture, show = 10 ) == 1.
+
+    # CoreNLP counts UTF-16 code units
+    output = eng.annotate( u'Call 555-1234 or -5, scores 3-2 in 1990-1995.' )
+    assert [ t['word'] for t in output['sentences'][0]['tokens'] ] == \
+        [ u'Call', u'555', u'-', u'1234', u'or', u'-5', u',', u'scores', u'3', u'-', u'2',
+          u'in', u'1990', u'-', u'1995', u'.' ]
+
+    output = eng.annotate( u'\U0001F600 Toronto' )
+    assert output['sentences'][0]['tokens'][-1]['characterOffsetBegin'] == 3
+
+    logger.info( 'all tests passed' )
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig( format = '%(asctime)s : %(levelname)s : %(message)s',
+                         level = logging.INFO )
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    test = subparsers.add_parser( 'test', help = 'run the self-test against stub servers' )
+    test.set_defaults( func = SelfTest )
+
+    record = subparsers.add_parser( 'record',
+        help = 'record the CoreNLP tokenization of a corpus for the parity check' )
+    record.add_argument( 'endpoint', type = str, help = 'CoreNLP port(s) or URL(s)' )
+    record.add_argument( 'language', type = str, choices = [ 'eng', 'spa' ] )
+    record.add_argument( 'corpus', type = str, help = 'one document per line' )
+    record.add_argument( 'recorded', type = str, help = 'output JSON lines' )
+    record.set_defaults( func = Record )
+
+    parity = subparsers.add_parser( 'parity',
+        help = 'compare native_tokenizer with recorded CoreNLP output' )
+    parity.add_argument( 'recorded', type = str, help = 'what record wrote' )
+    parity.add_argument( '--show', type = int, default = 10,
+                         help = 'number of mismatching documents to print' )
+    parity.add_argument( '--min-agreement', type = float, default = 0.99,
+                         help = 'exit with 1 if fewer tokens than this fraction agree' )
+    parity.set_defaults( func = Parity )
+
+    args = parser.parse_args()
+    args.func( args )
+
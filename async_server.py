@@ -0,0 +1,183 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Event-loop front end serving the same GET/POST / contract as server.py.
+Waiting on CoreNLP costs no thread, and the model runs on a bounded thread
+pool, so slow clients only hold a socket. Python 2 has no asyncio, hence
+Tornado coroutines; TensorFlow releases the GIL while it evaluates, so a
+thread pool rather than a process pool is enough for the model.
+"""
+
+import os, sys, json, time, urllib, logging
+import server
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen, httpclient, ioloop, iostream, locks, netutil, process, web, httpserver
+from LanguageUtil import language_registry
+from TokenizerUtil import corenlp_pool
+
+logger = logging.getLogger(__name__)
+
+
+class async_corenlp_pool(corenlp_pool):
+    """
+    corenlp_pool whose annotate() is a coroutine; backend selection,
+    ejection and failover are the same.
+    """
+    def __init__(self, endpoints, max_clients=64, **kwargs):
+        corenlp_pool.__init__(self, endpoints, **kwargs)
+        self.client = httpclient.AsyncHTTPClient(max_clients=max_clients)
+
+    @gen.coroutine
+    def annotate(self, text, properties):
+        if isinstance(text, unicode):
+            text = text.encode('utf8')
+
+        tried, error = set(), None
+        while True:
+            backend = self._Pick(tried)
+            if backend is None:
+                raise IOError('all CoreNLP backends failed: %s' % str(error))
+            tried.add(backend)
+
+            start = time.time()
+            try:
+                response = yield self.client.fetch(
+                    httpclient.HTTPRequest(
+                        backend.url + '/?' + urllib.urlencode({'properties': json.dumps(properties)}),
+                        method='POST',
+                        body=text,
+                        request_timeout=self.timeout
+                    )
+                )
+            except httpclient.HTTPError as ex:
+                if ex.code != 599:
+                    # an error response, see corenlp_pool.annotate
+                    self._Rejected(backend)
+                    raise
+                # 599 is Tornado's code for no response, e.g. a timeout
+                self._Done(backend, time.time() - start, True)
+                error = ex
+                continue
+            except (IOError, iostream.StreamClosedError) as ex:
+                self._Done(backend, time.time() - start, True)
+                error = ex
+                continue
+
+            try:
+                output = json.loads(response.body)
+            except ValueError:
+                self._Rejected(backend)
+                raise
+
+            self._Done(backend, time.time() - start, False, len(text))
+            raise gen.Return(output)
+
+
+class stats_handler(web.RequestHandler):
+    def initialize(self, corenlp):
+        self.corenlp = corenlp
+
+    def get(self):
+        self.write(dict(server.annotator.stats(), corenlp=self.corenlp.stats()))
+
+
+class reload_handler(web.RequestHandler):
+    """
+    Same as server.reload_model.
+    """
+    def post(self):
+        if self.request.remote_ip not in ('127.0.0.1', '::1'):
+            self.set_status(403)
+            self.write({'error': 'forbidden'})
+            return
+        started = server.annotator.Trigger('admin')
+        self.set_status(202 if started else 409)
+        self.write(dict(server.annotator.ReloadStats(), started=started))
+
+
+class annotate_handler(web.RequestHandler):
+    """
+    Same as server.home_page and server.annotate.
+    """
+    def initialize(self, page, corenlp, executor, slots):
+        self.page = page
+        self.corenlp = corenlp
+        self.executor = executor
+        self.slots = slots
+
+    def get(self):
+        self.write(self.page)
+
+    @gen.coroutine
+    def post(self):
+        mode = self.get_body_argument('mode')
+        text = self.get_body_argument('text').strip()
+        selected = self.get_body_argument('lang')
+
+        language, notes = server.resolve_language(selected, text)
+        if language is None:
+            self.write({'text': "Language not found", 'entities': [], 'notes': notes})
+            return
+
+        if language in server.native:
+            text_array, non_esc_array, _ = server.tokenize(text, language)
+        else:
+            request_text, properties = server.corenlp_request(text, language)
+            output = yield self.corenlp.annotate(request_text, properties)
+            text_array, non_esc_array, _ = server.read_tokens(output, language)
+
+        # requests beyond the pool size wait here rather than in the pool's queue
+        with (yield self.slots.acquire()):
+            result = yield self.executor.submit(server.annotate_tokens, mode,
+                                                text_array, non_esc_array, language, notes)
+        self.write(result)
+
+
+def make_app(args):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'templates', 'ner-home.html'), 'rb') as fp:
+        page = fp.read()
+
+    corenlp = async_corenlp_pool(args.coreNLP_port.split(','),
+                                 max_clients=args.max_clients,
+                                 timeout=args.corenlp_timeout,
+                                 slow=args.corenlp_slow)
+    executor = ThreadPoolExecutor(max_workers=args.executor_threads)
+    slots = locks.Semaphore(args.executor_threads)
+
+    return web.Application(
+        [(r'/', annotate_handler, {'page': page, 'corenlp': corenlp,
+                                   'executor': executor, 'slots': slots}),
+         (r'/stats', stats_handler, {'corenlp': corenlp}),
+         (r'/admin/reload', reload_handler)],
+        static_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    )
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s',
+                        level=logging.INFO)
+
+    parser = server.build_parser()
+    parser.add_argument('--executor-threads', type=int, default=4,
+                        help='threads running the model; further requests queue without a thread')
+    parser.add_argument('--max-clients', type=int, default=64,
+                        help='maximum concurrent CoreNLP calls per worker')
+    args = parser.parse_args()
+    server.setup(args)
+
+    sockets = netutil.bind_sockets(args.port)
+    if args.workers > 1:
+        # same sharing as server.serve_prefork: load once, fork, then build
+        # the TensorFlow session in each worker
+        server.annotator = language_registry(args, load_network=False)
+        process.fork_processes(args.workers)
+        server.annotator.LoadNetwork()
+    else:
+        server.annotator = language_registry(args)
+
+    http_server = httpserver.HTTPServer(make_app(args))
+    http_server.add_sockets(sockets)
+    logger.info('serving on port %d' % args.port)
+    ioloop.IOLoop.current().start()
@@ -112,9 +112,41 @@ class mention_config( object ):
         self.n_word_embedding1 = 256    # decided by self.word_embedding
         self.n_word_embedding2 = 256    # decided by self.word_embedding
         self.customized_threshold = None    # not used any more
+        self.cascade_threshold = 0.     # of a cascade model, decided by CascadeUtil.py calibrate
         assert len( self.kernel_height ) == len( self.kernel_depth )
 
 
+########################################################################
+
+
+def NewSession( graph, gpu_option = 0 ):
+    """
+    Parameters
+    ----------
+        graph : tf.Graph
+        gpu_option : float
+            fraction of GPU memory to take, or grow on demand if 0; 
+            None leaves the defaults
+    """
+    if gpu_option is not None:
+        if gpu_option > 0:
+            gpu_option = tf.GPUOptions( 
+                per_process_gpu_memory_fraction = gpu_option 
+            )
+        else:
+            gpu_option = tf.GPUOptions(
+                allow_growth = True
+            )
+        return tf.Session( 
+            config = tf.ConfigProto( 
+                gpu_options = gpu_option
+                # log_device_placement = True
+            ),
+            graph = graph )
+    else:
+         return tf.Session( graph = graph )
+
+
 ########################################################################
 
 class mention_net_base( object ):
@@ -214,6 +246,33 @@ class mention_net_base( object ):
 
 
 
+    def EmbedShape( self ):
+        """
+        Counterpart of LoadEmbed when the embeddings are restored from a 
+        checkpoint anyway: the sizes recorded in the config are used and 
+        no matrix is allocated.
+
+        Returns
+        -------
+            shape1, shape2 : tuple
+                shapes of the case-insensitive (word in Chinese) and 
+                case-sensitive (char in Chinese) embedding
+        """
+        self.n_word1 = self.config.n_word1
+        self.n_word2 = self.config.n_word2
+
+        if self.config.is_2nd_pass:
+            self.pad1 = self.n_word1 - self.config.n_label_type - 2 # case-insensitive
+            self.pad2 = self.n_word2 - self.config.n_label_type - 3 # case-sensitive
+        else:
+            self.pad1 = self.n_word1 - 2
+            self.pad2 = self.n_word2 - 3
+
+        return (self.n_word1, self.config.n_word_embedding1), \
+               (self.n_word2, self.config.n_word_embedding2)
+
+
+
     def DetermineLayerSize( self ):
         in1 = 0
         for ith, name in enumerate( [
@@ -271,11 +330,41 @@ class mention_net_base( object ):
 
 
 class fofe_mention_net( mention_net_base ):
-    def __init__( self, config = None, gpu_option = 0 ):
+    # embedding tables that can be served from ServingUtil.LoadTables
+    table_names = [ 'word_embedding_1', 'word_embedding_2', 'char_embedding',
+                    'conv_embedding', 'ner_embedding', 'bigram_embedding' ]
+
+    def __init__( self, config = None, gpu_option = 0, inference_only = False,
+                  tables = None, projected = False, session = None, scope = None,
+                  blend = 0. ):
         """
         Parameters
         ----------
             config : mention_config
+            inference_only : bool
+                build the forward graph only, i.e. no loss, dropout or 
+                optimizer, and leave the variables uninitialized; 
+                fromfile must be called before eval
+            tables : dict
+                name -> memory-mapped table, see ServingUtil.LoadTables;
+                only used in inference-only mode, where these tables are 
+                fed on every run instead of being copied into variables
+            projected : bool
+                only in inference-only mode: eval takes the word features
+                already multiplied by the word embeddings, as dense rows 
+                laid out as MiniBatchUtil describes; the checkpoint is the
+                same, see FeatureUtil.projected_builder
+            session : tf.Session
+                only in inference-only mode: build the network in the graph
+                of this session, e.g. one from NewSession shared by several
+                networks and their thread pools, instead of in its own
+            scope : str
+                name scope of the network in a shared graph; the checkpoint
+                is read as if there were none
+            blend : float
+                only in inference-only mode: if positive, eval takes the 
+                probabilities of an earlier pass as prior and returns 
+                blend * prior + (1 - blend) * its own, and their argmax
         """
 
         super(fofe_mention_net, self).__init__( 
@@ -287,27 +376,29 @@ class fofe_mention_net( mention_net_base ):
         if config is not None:
             self.config.__dict__.update( config.__dict__ )
 
-        self.graph = tf.Graph()
-
-        if gpu_option is not None:
-            if gpu_option > 0:
-                gpu_option = tf.GPUOptions( 
-                    per_process_gpu_memory_fraction = gpu_option 
-                )
-            else:
-                gpu_option = tf.GPUOptions(
-                    allow_growth = True
-                )
-            self.session = tf.Session( 
-                config = tf.ConfigProto( 
-                    gpu_options = gpu_option
-                    # log_device_placement = True
-                ),
-                graph = self.graph )
+        self.inference_only = inference_only
+        self.tables = tables if inference_only else None
+        self.projected = projected
+        self.blend = blend
+        assert inference_only or (session is None and blend == 0)
+        if projected:
+            # the pattern attention is not linear in the sparse codes, and 
+            # char-bigram has no projected input
+            assert inference_only and self.config.n_pattern == 0 and \
+                    (self.config.feature_choice & (1 << 10)) == 0
+        self.owns_session = session is None
+        if session is None:
+            self.graph = tf.Graph()
+            self.session = NewSession( self.graph, gpu_option )
         else:
-             self.session = tf.Session( graph = self.graph )
+            self.graph = session.graph
+            self.session = session
 
-        projection1, projection2 = self.LoadEmbed()
+        # the checkpoint overwrites the embeddings; don't build random ones
+        if inference_only:
+            projection1, projection2 = self.EmbedShape()
+        else:
+            projection1, projection2 = self.LoadEmbed()
 
         n_in, n_out = self.DetermineLayerSize()
         hope_in = n_in[0]
@@ -320,20 +411,34 @@ class fofe_mention_net( mention_net_base ):
         logger.info( 'n_in: ' + str(n_in) )
         logger.info( 'n_out: ' + str(n_out) )
 
-        with self.graph.as_default():
+        with self.graph.as_default(), tf.name_scope( scope ):
             self.__InitPlaceHolder()
             logger.info( 'placeholder defined' )
 
             self.__InitVariable( projection1, projection2, n_in, n_out, hope_in, hope_out )
             del projection1, projection2
+            self.__InitTable()
             logger.info( 'variable defined' )
 
             self.__InitConnection()
-            self.__InitOptimizer()
+            if not self.inference_only:
+                self.__InitOptimizer()
             logger.info( 'computational graph built\n' )
 
-            self.session.run( tf.global_variables_initializer() )
-            self.saver = tf.train.Saver()
+            # in inference-only mode, all values come from fromfile
+            if not self.inference_only:
+                self.session.run( tf.global_variables_initializer() )
+
+            # memory-mapped tables are not restored from the checkpoint,
+            # and variables in a shared graph are saved without their scope
+            served = set( v.op.name for v in self.table_variable.values() )
+            prefix = '' if scope is None else scope + '/'
+            self.saver = tf.train.Saver( 
+                var_list = dict( ( v.op.name[len(prefix):], v ) \
+                                 for v in tf.global_variables() \
+                                    if v.op.name.startswith( prefix ) and \
+                                       v.op.name not in served ) 
+            )
             
 
 
@@ -489,11 +594,32 @@ class fofe_mention_net( mention_net_base ):
 
         self.shape3 = tf.placeholder( tf.int64, [2], name = 'shape3' )
 
+        # lwp1, rwp1, lwp2, rwp2, bowp1, lwp3, rwp3, lwp4, rwp4, bowp2
+        if self.projected:
+            self.projected_fofe = [ 
+                tf.placeholder( 
+                    tf.float32, 
+                    [None, self.config.n_word_embedding1 if i < 5 else \
+                           self.config.n_word_embedding2],
+                    name = 'projected-%d' % i
+                ) for i in xrange( 10 ) 
+            ]
+
 
 
     def __InitVariable( self, projection1, projection2, n_in, n_out, hope_in, hope_out ):
-        self.word_embedding_1 = tf.Variable( projection1 )
-        self.word_embedding_2 = tf.Variable( projection2 )
+        """
+        projection1 and projection2 are the initial word embeddings, or 
+        only their shapes in inference-only mode.
+        """
+        if self.inference_only:
+            # don't embed the initial value as a constant in the graph;
+            # creation order is kept so that names match the checkpoint
+            self.word_embedding_1 = tf.Variable( tf.zeros( projection1 ) )
+            self.word_embedding_2 = tf.Variable( tf.zeros( projection2 ) )
+        else:
+            self.word_embedding_1 = tf.Variable( projection1 )
+            self.word_embedding_2 = tf.Variable( projection2 )
 
         self.W, self.b = [], []   # weights & bias of fully-connected layers
         self.param = []
@@ -722,6 +848,32 @@ class fofe_mention_net( mention_net_base ):
 
 
 
+    def __InitTable( self ):
+        """
+        Replaces the variables of the memory-mapped tables by placeholders. 
+        The variables themselves stay in the graph, uninitialized, so that 
+        the others keep their checkpoint names.
+        """
+        self.table_variable = {}
+        self.table_feed = {}
+        if self.tables is None:
+            return
+
+        for name in self.table_names:
+            if name in self.tables:
+                variable = getattr( self, name )
+                table = self.tables[name]
+                assert tuple( variable.get_shape().as_list() ) == table.shape, \
+                        '%s: %s vs %s' % (name, variable.get_shape(), table.shape)
+
+                placeholder = tf.placeholder( tf.float32, table.shape, name = name )
+                setattr( self, name, placeholder )
+                self.table_variable[name] = variable
+                # TF borrows aligned numpy buffers, so the pages are not copied
+                self.table_feed[placeholder] = table
+
+
+
     def __InitConnection( self ):
         feature_choice = self.config.feature_choice
 
@@ -867,6 +1019,11 @@ class fofe_mention_net( mention_net_base ):
 
         bowp2 = tf.sparse_tensor_dense_matmul( bow2, self.word_embedding_2 )
 
+        # the sparse products above are left out of the graph that runs
+        if self.projected:
+            lwp1, rwp1, lwp2, rwp2, bowp1, \
+            lwp3, rwp3, lwp4, rwp4, bowp2 = self.projected_fofe
+
         # dense features after projection
         lcp = tf.matmul( self.lc_fofe, self.char_embedding )
         rcp = tf.matmul( self.rc_fofe, self.char_embedding )
@@ -901,6 +1058,8 @@ class fofe_mention_net( mention_net_base ):
         if self.config.hope_out > 0:
             hope = tf.matmul( feature, self.U )
             layer_output = [ hope ] 
+        elif self.inference_only:
+            layer_output = [ feature ]
         else:
             layer_output = [ tf.nn.dropout( feature, self.keep_prob ) ]
 
@@ -908,24 +1067,34 @@ class fofe_mention_net( mention_net_base ):
             layer_output.append( tf.matmul( layer_output[-1], self.W[i] ) + self.b[i] )
             if i < len(self.W) - 1:
                 layer_output[-1] = tf.nn.relu( layer_output[-1] )
-                layer_output[-1] = tf.nn.dropout( layer_output[-1], self.keep_prob )
+                if not self.inference_only:
+                    layer_output[-1] = tf.nn.dropout( layer_output[-1], self.keep_prob )
 
-        self.xent = tf.reduce_mean( 
-            tf.nn.sparse_softmax_cross_entropy_with_logits( 
-                logits = layer_output[-1], 
-                labels = self.label 
-            ) 
-        )
+        if self.inference_only:
+            self.xent = None
+        else:
+            self.xent = tf.reduce_mean( 
+                tf.nn.sparse_softmax_cross_entropy_with_logits( 
+                    logits = layer_output[-1], 
+                    labels = self.label 
+                ) 
+            )
 
-        if self.config.l1 > 0:
-            for param in self.param:
-                self.xent = self.xent + self.config.l1 * tf.reduce_sum( tf.abs( param ) )
+            if self.config.l1 > 0:
+                for param in self.param:
+                    self.xent = self.xent + self.config.l1 * tf.reduce_sum( tf.abs( param ) )
 
-        if self.config.l2 > 0:
-            for param in  self.param:
-                self.xent = self.xent + self.config.l2 * tf.nn.l2_loss( param )
+            if self.config.l2 > 0:
+                for param in  self.param:
+                    self.xent = self.xent + self.config.l2 * tf.nn.l2_loss( param )
 
         self.predicted_values = tf.nn.softmax( layer_output[-1] )
+        if self.blend > 0:
+            self.prior = tf.placeholder( 
+                tf.float32, [None, self.config.n_label_type + 1], name = 'prior' 
+            )
+            self.predicted_values = self.blend * self.prior + \
+                                    (1 - self.blend) * self.predicted_values
         _, top_indices = tf.nn.top_k( self.predicted_values )
         self.predicted_indices = tf.reshape( top_indices, [-1] )
 
@@ -1122,17 +1291,24 @@ class fofe_mention_net( mention_net_base ):
 
 
 
-    def eval( self, mini_batch ):
+    def eval( self, mini_batch, prior = None ):
         """
         Parameters
         ----------
             mini_batch : tuple
+            prior : numpy.ndarray
+                class probabilities of each example from an earlier pass, 
+                only taken if blend is positive
 
         Returns:
             c : float
+                None in inference-only mode
             pi : numpy.ndarray
             pv : numpy.ndarray
         """
+        if self.projected:
+            return self.__EvalProjected( mini_batch, prior )
+
         l1_values, r1_values, l1_indices, r1_indices, \
         l2_values, r2_values, l2_indices, r2_indices, \
         bow1i, \
@@ -1147,50 +1323,174 @@ class fofe_mention_net( mention_net_base ):
         if not self.config.strictly_one_hot:
             dense_feature[:,-1] = 0
 
-        c, pi, pv = self.session.run( 
-            [ self.xent, self.predicted_indices, self.predicted_values ], 
-            feed_dict = {   
-                self.lw1_values: l1_values,
-                self.lw1_indices: l1_indices,
-                self.rw1_values: r1_values,
-                self.rw1_indices: r1_indices,
-                self.lw2_values: l2_values,
-                self.lw2_indices: l2_indices,
-                self.rw2_values: r2_values,
-                self.rw2_indices: r2_indices,
-                self.bow1_indices: bow1i,
-                self.bow1_values: numpy.ones( bow1i.shape[0], dtype = numpy.float32 ),
-                self.lw3_values: l3_values,
-                self.lw3_indices: l3_indices,
-                self.rw3_values: r3_values,
-                self.rw3_indices: r3_indices,
-                self.lw4_values: l4_values,
-                self.lw4_indices: l4_indices,
-                self.rw4_values: r4_values,
-                self.rw4_indices: r4_indices,
-                self.bow2_indices: bow2i,
-                self.bow2_values: numpy.ones( bow2i.shape[0], dtype = numpy.float32 ),
-                self.shape1: (target.shape[0], self.n_word1),
-                self.shape2: (target.shape[0], self.n_word2),
-                self.lc_fofe: dense_feature[:,:128],
-                self.rc_fofe: dense_feature[:,128:256],
-                self.li_fofe: dense_feature[:,256:384],
-                self.ri_fofe: dense_feature[:,384:512],
-                self.ner_cls_match: dense_feature[:,512:],
-                self.char_idx: conv_idx,
-                self.lbc_values : l5_values,
-                self.lbc_indices : l5_indices,
-                self.rbc_values : r5_values,
-                self.rbc_indices : r5_indices,
-                self.shape3 : (target.shape[0], 96 * 96),
-                self.label: target,
-                self.keep_prob: 1 
-            } 
-        ) 
+        feed_dict = {   
+            self.lw1_values: l1_values,
+            self.lw1_indices: l1_indices,
+            self.rw1_values: r1_values,
+            self.rw1_indices: r1_indices,
+            self.lw2_values: l2_values,
+            self.lw2_indices: l2_indices,
+            self.rw2_values: r2_values,
+            self.rw2_indices: r2_indices,
+            self.bow1_indices: bow1i,
+            self.bow1_values: numpy.ones( bow1i.shape[0], dtype = numpy.float32 ),
+            self.lw3_values: l3_values,
+            self.lw3_indices: l3_indices,
+            self.rw3_values: r3_values,
+            self.rw3_indices: r3_indices,
+            self.lw4_values: l4_values,
+            self.lw4_indices: l4_indices,
+            self.rw4_values: r4_values,
+            self.rw4_indices: r4_indices,
+            self.bow2_indices: bow2i,
+            self.bow2_values: numpy.ones( bow2i.shape[0], dtype = numpy.float32 ),
+            self.shape1: (target.shape[0], self.n_word1),
+            self.shape2: (target.shape[0], self.n_word2),
+            self.lc_fofe: dense_feature[:,:128],
+            self.rc_fofe: dense_feature[:,128:256],
+            self.li_fofe: dense_feature[:,256:384],
+            self.ri_fofe: dense_feature[:,384:512],
+            self.ner_cls_match: dense_feature[:,512:],
+            self.char_idx: conv_idx,
+            self.lbc_values : l5_values,
+            self.lbc_indices : l5_indices,
+            self.rbc_values : r5_values,
+            self.rbc_indices : r5_indices,
+            self.shape3 : (target.shape[0], 96 * 96)
+        }
+
+        feed_dict.update( self.table_feed )
+        if self.blend > 0:
+            feed_dict[self.prior] = prior
+
+        # no loss in inference-only mode, hence neither label nor keep-prob
+        if self.inference_only:
+            pi, pv = self.session.run( 
+                [ self.predicted_indices, self.predicted_values ], 
+                feed_dict = feed_dict
+            )
+            c = None
+        else:
+            feed_dict[self.label] = target
+            feed_dict[self.keep_prob] = 1
+            c, pi, pv = self.session.run( 
+                [ self.xent, self.predicted_indices, self.predicted_values ], 
+                feed_dict = feed_dict
+            ) 
 
         return c, pi, pv
 
 
+    def __EvalProjected( self, mini_batch, prior ):
+        projected = mini_batch[:10]
+        dense_feature, conv_idx, target = mini_batch[10:]
+
+        if not self.config.strictly_one_hot:
+            dense_feature[:,-1] = 0
+
+        feed_dict = {
+            self.lc_fofe: dense_feature[:,:128],
+            self.rc_fofe: dense_feature[:,128:256],
+            self.li_fofe: dense_feature[:,256:384],
+            self.ri_fofe: dense_feature[:,384:512],
+            self.ner_cls_match: dense_feature[:,512:],
+            self.char_idx: conv_idx
+        }
+        # unused features may come without columns
+        for placeholder, value, bit in zip( self.projected_fofe, projected,
+                                            [ 0, 0, 1, 1, 2, 3, 3, 4, 4, 5 ] ):
+            if (1 << bit) & self.config.feature_choice > 0:
+                feed_dict[placeholder] = value
+
+        feed_dict.update( self.table_feed )
+        if self.blend > 0:
+            feed_dict[self.prior] = prior
+
+        pi, pv = self.session.run( 
+            [ self.predicted_indices, self.predicted_values ], 
+            feed_dict = feed_dict
+        )
+        return None, pi, pv
+
+
+    def WordEmbedding( self ):
+        """
+        Returns
+        -------
+            word_embedding_1, word_embedding_2 : ndarray
+                memory-mapped if the tables are served, otherwise read from
+                the session, i.e. call it after fromfile
+        """
+        return [ self.tables[name] if name in self.table_variable else \
+                 self.session.run( getattr( self, name ) ) \
+                 for name in [ 'word_embedding_1', 'word_embedding_2' ] ]
+
+
+    def ExportTables( self ):
+        """
+        Returns
+        -------
+            tables : dict
+                name -> ndarray of the current embedding tables, 
+                see ServingUtil.SaveTables
+        """
+        assert self.tables is None, 'tables are already memory-mapped'
+        return dict( zip( self.table_names,
+                          self.session.run( [ getattr( self, name ) \
+                                              for name in self.table_names ] ) ) )
+
+
+    def Variables( self ):
+        """
+        Returns
+        -------
+            variables : dict
+                role -> variable of everything the checkpoint holds, e.g.
+                'W_0' or 'kernel_bias_1'; the roles are the array names of
+                NumpyUtil and BundleUtil
+        """
+        variables = dict( ( name, self.table_variable.get( name, getattr( self, name ) ) ) \
+                          for name in self.table_names )
+        roles = [ ('kernel', self.kernels), ('kernel_bias', self.kernel_bias),
+                  ('W', self.W), ('b', self.b) ]
+        if self.config.n_pattern > 0:
+            roles += [ ('pattern1', self.pattern1), ('pattern1_bias', self.pattern1_bias),
+                       ('pattern2', self.pattern2), ('pattern2_bias', self.pattern2_bias) ]
+        for role, variable_list in roles:
+            for i, variable in enumerate( variable_list ):
+                variables['%s_%d' % (role, i)] = variable
+        if self.config.hope_out > 0:
+            variables['U'] = self.U
+        return variables
+
+
+    def ExportArrays( self ):
+        """
+        Returns
+        -------
+            arrays : dict
+                role -> ndarray of every variable, see Variables; served
+                tables are returned as they are mapped
+        """
+        variables = [ (role, variable) for role, variable in self.Variables().items() \
+                      if role not in self.table_variable ]
+        arrays = dict( zip( [ role for role, _ in variables ],
+                            self.session.run( [ variable for _, variable in variables ] ) ) )
+        for name in self.table_variable:
+            arrays[name] = self.tables[name]
+        return arrays
+
+
+    def FromArrays( self, arrays ):
+        """
+        Same as fromfile, but from what ExportArrays returned,
+        e.g. the arrays of a BundleUtil.model_bundle.
+        """
+        for role, variable in self.Variables().items():
+            if role not in self.table_variable:
+                variable.load( arrays[role], self.session )
+
+
     def tofile( self, filename ):
         """
         Parameters
@@ -1212,7 +1512,8 @@ class fofe_mention_net( mention_net_base ):
 
 
     def __del__( self ):
-        self.session.close()
+        if self.owns_session:
+            self.session.close()
 
 
 
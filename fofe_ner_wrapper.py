@@ -1,46 +1,409 @@
 #!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
 
-import logging, cPickle, os
-from fofe_mention_net import *
-from io import BytesIO
+import logging, cPickle, os, threading, time, Queue, collections, itertools
+from gigaword2feature import batch_constructor, vocabulary, chinese_word_vocab
+from PredictionUtil import *
+from MiniBatchUtil import *
+from ServingUtil import LoadTables, CachedObject, LoadGazetteer, label_rows, LayerLabels
+from CascadeUtil import CascadeFilter, MergeCascade
+from FeatureUtil import ProbeBuilder, projected_builder
+from NumpyUtil import numpy_mention_net, engine_config, LoadEngine, LoadEngineConfig
+from BundleUtil import IsBundle, model_bundle
 
 logger = logging.getLogger( __name__ )
 
+
+def LoadServingTables( model ):
+    """
+    Memory-maps <model>.tables if it was exported by `ServingUtil.py tables`.
+    """
+    if os.path.isdir( model + '.tables' ):
+        return LoadTables( model + '.tables' )
+    else:
+        return None
+
+
+
+def VocabularyLayers( vocab1, vocab2, char_alpha, wubi, n_label_type = None ):
+    """
+    Builds the two numericizers of one pass without label types, and what
+    label types add to them. Each is parsed from its wordlist (and Wubi 
+    table) only on the first run; afterwards it comes from a binary 
+    sidecar, see ServingUtil.CachedObject. The numericizers without label
+    types are the same objects in both passes.
+
+    Parameters
+    ----------
+        see LoadVocabulary
+
+    Returns
+    -------
+        layers : list
+            (numericizer, rows) of numericizer1 and numericizer2, where
+            rows is a ServingUtil.label_rows, or None without n_label_type
+    """
+    if wubi is None:
+        builds = [
+            ( lambda **extra: vocabulary( vocab1, char_alpha, False, **extra ),
+              [ vocab1 ], ( 'vocabulary', char_alpha, False ) ),
+            ( lambda **extra: vocabulary( vocab2, char_alpha, True, **extra ),
+              [ vocab2 ], ( 'vocabulary', char_alpha, True ) )
+        ]
+    else:
+        def build( **extra ):
+            numericizer = chinese_word_vocab( vocab1, **extra )
+            numericizer.loadWubiKeyStroke( wubi )
+            return numericizer
+        builds = [
+            ( build, [ vocab1, wubi ], ( 'chinese_word_vocab', ) ),
+            ( lambda **extra: chinese_word_vocab( vocab2, **extra ),
+              [ vocab2 ], ( 'chinese_word_vocab', ) )
+        ]
+
+    def layer( build, sources, key ):
+        numericizer = CachedObject( build, sources, key + ( None, ) )
+        if n_label_type is None:
+            return numericizer, None
+        rows = CachedObject( 
+            lambda: label_rows( numericizer, build( n_label_type = n_label_type ) ),
+            sources,
+            ( 'label_rows', ) + key + ( n_label_type, )
+        )
+        return numericizer, rows
+
+    return [ layer( *b ) for b in builds ]
+
+
+
+def LoadVocabulary( vocab1, vocab2, char_alpha, wubi, n_label_type = None ):
+    """
+    Builds the two numericizers of one pass. In the 2nd pass they share
+    the index of the 1st pass, with the label types layered on top, see
+    VocabularyLayers.
+
+    Parameters
+    ----------
+        vocab1, vocab2 : str
+            case-insensitive & case-sensitive wordlists for {eng,spa};
+            word & char wordlists for cmn
+        char_alpha : float
+        wubi : str
+            Wubi keystroke table, only given for cmn
+        n_label_type : int
+            only given in the 2nd pass, where label types are appended
+
+    Returns
+    -------
+        numericizer1, numericizer2
+    """
+    return tuple( numericizer if rows is None else LayerLabels( numericizer, rows ) \
+                  for numericizer, rows in VocabularyLayers( vocab1, vocab2, char_alpha,
+                                                             wubi, n_label_type ) )
+
+
+class sentence_cache( object ):
+    """
+    Thread-safe LRU cache of annotated sentences, bounded by the number of 
+    entries and/or an estimate of their size in bytes.
+    """
+    def __init__( self, max_entry = 0, max_byte = 0 ):
+        """
+        Parameters
+        ----------
+            max_entry : int
+                0 for no limit on the number of entries
+            max_byte : int
+                0 for no limit on the estimated size
+        """
+        self.max_entry = max_entry
+        self.max_byte = max_byte
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.n_byte = 0
+        self.n_hit = 0
+        self.n_miss = 0
+        self.n_eviction = 0
+
+
+    @staticmethod
+    def Size( key, value ):
+        """
+        Rough footprint of one entry: the tokens, the decoded spans and
+        the span tables.
+        """
+        return 256 + sum( 40 + 2 * len(w) for w in key[-1] ) + \
+               sum( 512 + t.records.nbytes for t in value[1] )
+
+
+    def get( self, key ):
+        with self.lock:
+            value = self.entries.pop( key, None )
+            if value is None:
+                self.n_miss += 1
+                return None
+            self.entries[key] = value
+            self.n_hit += 1
+            return value[0]
+
+
+    def put( self, key, value ):
+        size = self.Size( key, value )
+        with self.lock:
+            old = self.entries.pop( key, None )
+            if old is not None:
+                self.n_byte -= old[1]
+            self.entries[key] = ( value, size )
+            self.n_byte += size
+
+            while len(self.entries) > 1 and \
+                    ( (self.max_entry > 0 and len(self.entries) > self.max_entry) or \
+                      (self.max_byte > 0 and self.n_byte > self.max_byte) ):
+                _, (_, evicted) = self.entries.popitem( last = False )
+                self.n_byte -= evicted
+                self.n_eviction += 1
+
+
+    def stats( self ):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.n_byte,
+                'hits': self.n_hit,
+                'misses': self.n_miss,
+                'evictions': self.n_eviction,
+            }
+
+
+class eval_scheduler( object ):
+    """
+    Collects mini-batches submitted by concurrent annotate calls within a short
+    wait window and runs them through one fofe_mention_net.eval call.
+    """
+    def __init__( self, mention_net, max_batch = 2560, wait = 0.005, name = 'eval' ):
+        """
+        Parameters
+        ----------
+            mention_net : fofe_mention_net
+            max_batch : int
+                number of span rows a merged batch is filled up to
+            wait : float
+                seconds the first queued mini-batch may wait for company
+        """
+        self.mention_net = mention_net
+        self.max_batch = max_batch
+        self.wait = wait
+        self.name = name
+
+        # conv_idx of different widths cannot be padded without knowing the
+        # padding index batch_constructor uses, so such inputs are not merged
+        self.pad_conv = (mention_net.config.feature_choice & (1 << 9)) == 0
+
+        self.queue = Queue.Queue()
+        self.carry = None
+        self.closing = False
+
+        self.lock = threading.Lock()
+        self.n_batch = 0
+        self.n_request = 0
+        self.n_row = 0
+        self.waited = collections.deque( maxlen = 4096 )
+        self.depth = collections.deque( maxlen = 4096 )
+
+        self.worker = threading.Thread( target = self.__Loop, name = name )
+        self.worker.daemon = True
+        self.worker.start()
+
+
+    def submit( self, mini_batch, prior = None ):
+        """
+        Parameters
+        ----------
+            prior : ndarray
+                see fofe_mention_net.eval
+
+        Returns
+        -------
+            request : list
+                handle to pass to result()
+        """
+        request = [ mini_batch, threading.Event(), time.time(), None, None, prior ]
+        self.queue.put( request )
+        return request
+
+
+    def result( self, request ):
+        """
+        Blocks until the request is evaluated and returns what
+        fofe_mention_net.eval would have returned for it.
+        """
+        request[1].wait()
+        if request[4] is not None:
+            raise request[4]
+        return request[3]
+
+
+    def eval( self, mini_batch, prior = None ):
+        return self.result( self.submit( mini_batch, prior ) )
+
+
+    def close( self ):
+        """
+        Stops the worker once the mini-batches already submitted are 
+        evaluated, so that it no longer holds the network.
+        """
+        self.queue.put( None )
+        self.worker.join()
+
+
+    def stats( self ):
+        with self.lock:
+            waited = numpy.asarray( self.waited, dtype = numpy.float64 ) * 1000
+            depth = numpy.asarray( self.depth, dtype = numpy.float64 )
+            n_batch = max( self.n_batch, 1 )
+            report = {
+                'batches': self.n_batch,
+                'requests': self.n_request,
+                'rows': self.n_row,
+                'fill_ratio': float(self.n_row) / (n_batch * self.max_batch),
+                'requests_per_batch': float(self.n_request) / n_batch,
+                'queue_depth': self.queue.qsize(),
+            }
+        if waited.shape[0] > 0:
+            report['wait_ms_p50'] = float( numpy.percentile( waited, 50 ) )
+            report['wait_ms_p99'] = float( numpy.percentile( waited, 99 ) )
+            report['queue_depth_max'] = float( depth.max() )
+        return report
+
+
+    def __Collect( self ):
+        if self.carry is not None:
+            first, self.carry = self.carry, None
+        else:
+            first = self.queue.get()
+            if first is None:
+                self.closing = True
+                return [], 0
+        pending, n_row = [ first ], MiniBatchSize( first[0] )
+        deadline = first[2] + self.wait
+
+        while n_row < self.max_batch:
+            remain = deadline - time.time()
+            try:
+                if remain > 0:
+                    request = self.queue.get( timeout = remain )
+                else:
+                    request = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is None:
+                self.closing = True
+                break
+            size = MiniBatchSize( request[0] )
+            if n_row + size > self.max_batch:
+                self.carry = request
+                break
+            pending.append( request )
+            n_row += size
+
+        return pending, n_row
+
+
+    def __Loop( self ):
+        while not (self.closing and self.carry is None):
+            pending, n_row = self.__Collect()
+            if len(pending) == 0:
+                continue
+            start = time.time()
+
+            if self.pad_conv:
+                groups = [ pending ]
+            else:
+                groups = collections.OrderedDict()
+                for request in pending:
+                    width = request[0][Layout( request[0] )[3]].shape[1]
+                    groups.setdefault( width, [] ).append( request )
+                groups = groups.values()
+
+            for group in groups:
+                try:
+                    prior = None
+                    if group[0][5] is not None:
+                        prior = numpy.concatenate( [ request[5] for request in group ] )
+                    c, pi, pv = self.mention_net.eval(
+                        ConcatMiniBatch( [ request[0] for request in group ] ),
+                        prior
+                    )
+                    offset = 0
+                    for request in group:
+                        size = MiniBatchSize( request[0] )
+                        request[3] = ( c, pi[offset: offset + size], pv[offset: offset + size] )
+                        offset += size
+                except Exception as ex:
+                    logger.exception( '%s: merged evaluation failed' % self.name )
+                    for request in group:
+                        request[4] = ex
+                for request in group:
+                    request[0], request[5] = None, None
+                    request[1].set()
+
+            with self.lock:
+                self.n_batch += len(groups)
+                self.n_request += len(pending)
+                self.n_row += n_row
+                self.depth.append( self.queue.qsize() )
+                for request in pending:
+                    self.waited.append( start - request[2] )
+
+            logger.debug( '%s: %d requests, %d rows, fill %.2f, queue depth %d' % \
+                          ( self.name, len(pending), n_row,
+                            float(n_row) / self.max_batch, self.queue.qsize() ) )
+
+
 class fofe_ner_wrapper( object ):
-    def __init__( self, args ):
+    def __init__( self, args, load_network = True ):
+        """
+        Parameters
+        ----------
+            args : argparse.Namespace
+                command-line arguments of server.py
+            load_network : bool
+                if False, only configs, memory-mapped tables, vocabularies 
+                and gazetteer are loaded; LoadNetwork must be called before
+                annotate, e.g. in each worker after fork because the 
+                TensorFlow runtime does not survive it
+        """
+        # <model>.numpy bundles run without TensorFlow, see NumpyUtil.py;
+        # fofe_mention_net, and with it TensorFlow, is then never imported
+        self.numpy_engine = args.numpy_engine
+
+        # a BundleUtil.py bundle given as the 1st-pass model holds every
+        # pass, the vocabularies and the gazetteer; their options are ignored
+        self.bundle = None
+        model1st, model2nd, cascade = args.model1st, args.model2nd, args.cascade
+        if IsBundle( args.model1st ):
+            self.bundle = model_bundle( args.model1st )
+            model1st = 'pass1'
+            model2nd = 'pass2' if 'pass2/config' in self.bundle else None
+            cascade = 'cascade' if 'cascade/config' in self.bundle else None
+            logger.info( 'model bundle %s opened' % args.model1st )
+
         #####################
         # load 1st-pass model
-        model1st = args.model1st
-        config1 = mention_config()
-        print('%s.config' % model1st)
-        with open( '%s.config' % model1st, 'rb' ) as fp:
-            # I write this in such ugly way for backward compatibility
-            config1.__dict__.update( cPickle.load( fp ).__dict__ )
-            
-        mention_net_1st = fofe_mention_net( config1, None )
-        mention_net_1st.fromfile( model1st )
+        config1 = self.__Config( model1st )
+        self.model1st = model1st
+        self.tables1st = self.__Tables( model1st )
 
         vocab1 = args.vocab1
         vocab2 = args.vocab2
 
-        if args.wubi is None:
-            numericizer1_1st = vocabulary( 
-                vocab1,
-                config1.char_alpha, 
-                False 
-            )
-            numericizer2_1st = vocabulary( 
-                vocab2,
-                config1.char_alpha, 
-                True 
+        if self.bundle is None:
+            numericizer1_1st, numericizer2_1st = LoadVocabulary( 
+                vocab1, vocab2, config1.char_alpha, args.wubi 
             )
         else:
-            numericizer1_1st = chinese_word_vocab( vocab1 )
-            numericizer2_1st = chinese_word_vocab( vocab2 )
-            numericizer1_1st.loadWubiKeyStroke( args.wubi )
+            numericizer1_1st, numericizer2_1st = self.bundle.Numericizers( model1st )
         logger.info( '1st pass vocabulary loaded\n' )
 
-        self.mention_net_1st = mention_net_1st
         self.config1st = config1
         self.numericizer1_1st = numericizer1_1st
         self.numericizer2_1st = numericizer2_1st
@@ -48,42 +411,22 @@ class fofe_ner_wrapper( object ):
         #####################
         # load 2nd-pass model
 
-        if args.model2nd is not None:
+        if model2nd is not None:
             # model2nd = os.path.join( this_dir, 'model', '2nd-pass-train-dev' )
-            model2nd = args.model2nd
-            config2 = mention_config()
-            with open( '%s.config' % model2nd, 'rb' ) as fp:
-                config2.__dict__.update( cPickle.load(fp).__dict__ )
-            mention_net_2nd = fofe_mention_net( config2, None )
-            mention_net_2nd.fromfile( model2nd )
-
-            if args.wubi is None:
-                numericizer1_2nd = vocabulary( 
-                    vocab1,
-                    config2.char_alpha, 
-                    False,
-                    n_label_type = config2.n_label_type 
-                )
-                numericizer2_2nd = vocabulary( 
-                    vocab2,
-                    config2.char_alpha, 
-                    True,
+            config2 = self.__Config( model2nd )
+            self.model2nd = model2nd
+            self.tables2nd = self.__Tables( model2nd )
+
+            if self.bundle is None:
+                numericizer1_2nd, numericizer2_2nd = LoadVocabulary( 
+                    vocab1, vocab2, config2.char_alpha, args.wubi,
                     n_label_type = config2.n_label_type 
                 )
             else:
-                numericizer1_2nd = chinese_word_vocab( 
-                    vocab1,
-                    n_label_type = config2.n_label_type
-                )
-                numericizer2_2nd = chinese_word_vocab( 
-                    vocab2,
-                    n_label_type = config2.n_label_type
-                )
-                numericizer1_2nd.loadWubiKeyStroke( args.wubi )
+                numericizer1_2nd, numericizer2_2nd = self.bundle.Numericizers( model2nd )
             logger.info( '2nd pass vocabulary loaded\n' )
 
             self.has2nd = True
-            self.mention_net_2nd = mention_net_2nd
             self.config2nd = config2
             self.numericizer1_2nd = numericizer1_2nd
             self.numericizer2_2nd = numericizer2_2nd 
@@ -93,78 +436,419 @@ class fofe_ner_wrapper( object ):
         else:
             self.has2nd = False
 
-        if args.gazetteer is None:
+        ###########################################
+        # load cascade model, see CascadeUtil.py
+
+        self.model_cascade = cascade
+        if cascade is not None:
+            config_cascade = self.__Config( cascade )
+            self.config_cascade = config_cascade
+            self.tables_cascade = self.__Tables( cascade )
+            self.cascade_threshold = config_cascade.cascade_threshold \
+                    if args.cascade_threshold is None else args.cascade_threshold
+            assert self.config1st.n_label_type == config_cascade.n_label_type
+            logger.info( 'cascade threshold: %f' % self.cascade_threshold )
+        self.n_span_cascade = 0
+        self.n_survivor_cascade = 0
+
+        if self.bundle is not None:
+            self.gazetteer = self.bundle.Gazetteer()
+        elif args.gazetteer is not None:
+            logger.info( 'Loading compressed gazetteer' )
+            self.gazetteer = LoadGazetteer( args.gazetteer )
+        else:
+            self.gazetteer = None
+        if self.gazetteer is None:
             self.gazetteer = [set()] * self.config1st.n_label_type
+
+        # None, or replaces batch_constructor in the 1st pass, see FeatureUtil.py
+        self.builder1st = None
+        if args.fofe_builder:
+            self.builder1st = ProbeBuilder( 
+                numericizer1_1st, numericizer2_1st,
+                config1.word_alpha, config1.n_window, config1.n_label_type,
+                config1.language, config1.feature_choice,
+                min_weight = args.fofe_min_weight,
+                gazetteer = self.gazetteer
+            )
+
+        # the 1st pass takes pre-projected word features, see projected_builder;
+        # a cascade would need its own projection of the same mini-batch
+        self.projected1st = args.projected and self.builder1st is not None and \
+                            config1.n_pattern == 0 and cascade is None
+        if args.projected and not self.projected1st:
+            logger.warning( '--projected needs --fofe-builder to be usable and no pattern or cascade' )
+
+        # basename of the optional text dump of the probability arrays;
+        # each call writes its own files, numbered in the process
+        self.dump_prediction = args.dump_prediction
+        self.n_dump = itertools.count()
+        self.batch_wait = args.batch_wait
+
+        # None, or (low, high): only sentences with a 1st-pass candidate or 
+        # a span whose top probability is in [low, high] get a 2nd pass
+        self.uncertain_band = args.uncertain_band
+        self.n_sentence_2nd = 0
+        self.n_rerun_2nd = 0
+
+        # decoded results of repeated sentences are reused
+        self.model_id = ( os.path.abspath( args.model1st ),
+                          None if args.model2nd is None else os.path.abspath( args.model2nd ),
+                          None if args.uncertain_band is None else tuple( args.uncertain_band ),
+                          None if cascade is None else \
+                                (args.cascade and os.path.abspath( args.cascade ), 
+                                 self.cascade_threshold),
+                          None if self.builder1st is None else self.builder1st.min_weight )
+        if args.cache_size > 0 or args.cache_mb > 0:
+            self.cache = sentence_cache( args.cache_size, args.cache_mb * (1 << 20) )
         else:
-            logger.info( 'Loading compressed gazetteer' )
-            with open( args.gazetteer, 'rb' ) as fp:
-                self.gazetteer = cPickle.load( fp )
+            self.cache = None
 
+        # all passes in one graph and session, the 2nd pass blending in it
+        self.fused = args.fused
 
-    def annotate( self, sentences, isDevMode = False ):
-        # TODO ##
-        # make decoding-algorithm and decoding-threshold as dev-option
+        self.mention_net_1st, self.mention_net_2nd, self.mention_net_cascade = None, None, None
+        self.projected_builder1st = None
+        self.scheduler_1st, self.scheduler_2nd = None, None
+        if load_network:
+            self.LoadNetwork()
 
-        tbl_dev_1st = []
-        raw1st = [ (s, [], [], []) for s in sentences ]
-        data1st = batch_constructor( 
-            raw1st,
-            self.numericizer1_1st,
-            self.numericizer2_1st,
-            gazetteer = self.gazetteer,
-            alpha = self.config1st.word_alpha,
-            window = self.config1st.n_window,
-            n_label_type = self.config1st.n_label_type,
-            language = self.config1st.language
+
+    def __Config( self, model ):
+        """
+        Parameters
+        ----------
+            model : str
+                basename of a model, or the name of a pass in the bundle
+        """
+        if self.numpy_engine:
+            if self.bundle is None:
+                return engine_config( LoadEngineConfig( model + '.numpy' ) )
+            return engine_config( self.bundle.Config( model ) )
+
+        from fofe_mention_net import mention_config
+        config = mention_config()
+        if self.bundle is None:
+            with open( '%s.config' % model, 'rb' ) as fp:
+                # I write this in such ugly way for backward compatibility
+                config.__dict__.update( cPickle.load( fp ).__dict__ )
+        else:
+            config.__dict__.update( self.bundle.Config( model ) )
+        return config
+
+
+    def __Tables( self, model ):
+        if self.numpy_engine:
+            # the engine maps its own
+            return None
+        if self.bundle is None:
+            return LoadServingTables( model )
+        from fofe_mention_net import fofe_mention_net
+        arrays = self.bundle.Arrays( model + '/' )
+        return dict( (name, arrays[name]) for name in fofe_mention_net.table_names )
+
+
+    def __Network( self, model, config, tables, session, scope, **kwargs ):
+        if self.numpy_engine:
+            if self.bundle is None:
+                return LoadEngine( model + '.numpy', blend = kwargs.get( 'blend', 0. ) )
+            return numpy_mention_net( self.bundle.Config( model ), 
+                                      self.bundle.Arrays( model + '/' ),
+                                      blend = kwargs.get( 'blend', 0. ) )
+
+        from fofe_mention_net import fofe_mention_net
+        mention_net = fofe_mention_net( 
+            config, None, 
+            inference_only = True,
+            tables = tables,
+            session = session,
+            scope = scope if self.fused else None,
+            **kwargs
         )
-        logger.info( 'data1st: ' + str(data1st) )
+        if self.bundle is None:
+            mention_net.fromfile( model )
+        else:
+            mention_net.FromArrays( self.bundle.Arrays( model + '/' ) )
+        return mention_net
+
+
+    def LoadNetwork( self ):
+        """
+        Builds the TensorFlow graph and session of each pass, or one graph
+        and session of all of them if fused, or loads their NumPy bundles.
+        """
+        session = None
+        if self.fused and not self.numpy_engine:
+            import tensorflow as tf
+            from fofe_mention_net import NewSession
+            session = NewSession( tf.Graph() )
+
+        self.mention_net_1st = self.__Network( 
+            self.model1st, self.config1st, self.tables1st, session, 'pass1',
+            projected = self.projected1st
+        )
+        logger.info( '1st pass model loaded' )
+
+        self.projected_builder1st = None
+        if self.projected1st:
+            self.projected_builder1st = projected_builder( 
+                self.builder1st, 
+                *self.mention_net_1st.WordEmbedding() 
+            )
+
+        if self.has2nd:
+            self.mention_net_2nd = self.__Network( 
+                self.model2nd, self.config2nd, self.tables2nd, session, 'pass2',
+                blend = 0.6 if self.fused else 0.
+            )
+            logger.info( '2nd pass model loaded' )
+
+        if self.model_cascade is not None:
+            self.mention_net_cascade = self.__Network( 
+                self.model_cascade, self.config_cascade, self.tables_cascade,
+                session, 'cascade'
+            )
+            logger.info( 'cascade model loaded' )
+
+        # merge mini-batches of concurrent requests if a wait window is given
+        if self.batch_wait > 0:
+            self.scheduler_1st = eval_scheduler( 
+                self.mention_net_1st, 
+                wait = self.batch_wait / 1000.,
+                name = '1st-pass' 
+            )
+            if self.has2nd:
+                self.scheduler_2nd = eval_scheduler( 
+                    self.mention_net_2nd, 
+                    wait = self.batch_wait / 1000.,
+                    name = '2nd-pass' 
+                )
 
-        prob1st = []
-        for example in data1st.mini_batch_multi_thread( 
-                            2560, False, 1, 1, self.config1st.feature_choice ):
-            _, pi, pv = self.mention_net_1st.eval( example )
-            prob1st.append(
+
+    def Close( self ):
+        """
+        Stops the schedulers and closes the TensorFlow sessions, so that the
+        networks can be freed; the wrapper cannot annotate afterwards.
+        """
+        for scheduler in [ self.scheduler_1st, self.scheduler_2nd ]:
+            if scheduler is not None:
+                scheduler.close()
+        for mention_net in [ self.mention_net_1st, self.mention_net_2nd, self.mention_net_cascade ]:
+            # a fused session is closed once per network, which is harmless
+            if mention_net is not None and not self.numpy_engine:
+                mention_net.session.close()
+        self.scheduler_1st, self.scheduler_2nd = None, None
+        self.mention_net_1st, self.mention_net_2nd, self.mention_net_cascade = None, None, None
+        self.projected_builder1st = None
+
+
+    def __Probability( self, data, mention_net, scheduler, feature_choice, 
+                       cascade = None, prior = None ):
+        """
+        Parameters
+        ----------
+            cascade : fofe_mention_net
+                if given, only the spans it doesn't reject reach mention_net
+            prior : ndarray
+                class probabilities of every span from the 1st pass, which
+                mention_net blends in if it was built so
+
+        Returns
+        -------
+            prob : ndarray
+                one row per span: actual label, estimated label and
+                the probability of each class
+        """
+        n_label_type = self.config1st.n_label_type
+        examples, results = [], []
+        offset = 0
+        for example in data.mini_batch_multi_thread( 
+                            2560, False, 1, 1, feature_choice ):
+            prior_rows = None
+            if prior is not None:
+                prior_rows = prior[offset: offset + MiniBatchSize( example )]
+                offset += MiniBatchSize( example )
+
+            survivors, cascade_prob = None, None
+            evaluated = example
+            if cascade is not None:
+                survivors, cascade_prob = CascadeFilter( 
+                    cascade, example, self.cascade_threshold, n_label_type 
+                )
+                self.n_span_cascade += MiniBatchSize( example )
+                self.n_survivor_cascade += survivors.shape[0]
+                if survivors.shape[0] < MiniBatchSize( example ):
+                    evaluated = SliceMiniBatch( example, survivors )
+
+            if survivors is not None and survivors.shape[0] == 0:
+                results.append( None )
+            elif scheduler is None:
+                results.append( mention_net.eval( evaluated, prior_rows ) )
+            else:
+                results.append( scheduler.submit( evaluated, prior_rows ) )
+            examples.append( (example[-1], survivors, cascade_prob) )
+
+        prob = []
+        for (target, survivors, cascade_prob), result in zip( examples, results ):
+            if scheduler is not None and result is not None:
+                result = scheduler.result( result )
+            _, pi, pv = result if result is not None else (None, None, None)
+            if cascade_prob is not None:
+                pi, pv = MergeCascade( survivors, cascade_prob, pi, pv, n_label_type )
+            prob.append(
                 numpy.concatenate(
-                    ( example[-1].astype(numpy.float32).reshape(-1, 1),
+                    ( target.astype(numpy.float32).reshape(-1, 1),
                       pi.astype(numpy.float32).reshape(-1, 1),
                       pv ),
                     axis = 1
                 )
             )
-        prob1st = numpy.concatenate( prob1st, axis = 0 )
+        return numpy.concatenate( prob, axis = 0 )
+
+
+    def stats( self ):
+        report = {}
+        if self.cache is not None:
+            report['cache'] = self.cache.stats()
+        if self.scheduler_1st is not None:
+            report['scheduler_1st'] = self.scheduler_1st.stats()
+        if self.scheduler_2nd is not None:
+            report['scheduler_2nd'] = self.scheduler_2nd.stats()
+        if self.model_cascade is not None:
+            report['cascade'] = { 'spans': self.n_span_cascade,
+                                  'survivors': self.n_survivor_cascade }
+        if self.has2nd:
+            report['second_pass'] = { 'sentences': self.n_sentence_2nd,
+                                      'rerun': self.n_rerun_2nd }
+        return report
+
+
+    def annotate( self, sentences, isDevMode = False ):
+        """
+        Parameters
+        ----------
+            sentences : list
+                list of tokenized sentences
+            isDevMode : bool
+                if True, the score table of each pass is returned as well
+
+        Returns
+        -------
+            result : list
+                (sentence, boe, eoe, coe) of each sentence
+            tables : list
+                only in dev mode, one list of tables per pass; they may be
+                shared with the sentence cache and must not be modified
+        """
+        if self.cache is None:
+            return self.__Annotate( sentences, isDevMode )
+
+        keys = [ (self.model_id, self.config1st.language, tuple(s)) for s in sentences ]
+        entries = [ self.cache.get( k ) for k in keys ]
+
+        # only cache misses go to the network, each distinct sentence once
+        missing = collections.OrderedDict()
+        for s, k, e in zip( sentences, keys, entries ):
+            if e is None:
+                missing[k] = s
+        if len(missing) > 0:
+            result, tables = self.__Annotate( missing.values(), True )
+            for i, k in enumerate( missing.keys() ):
+                missing[k] = ( result[i][1:], tuple( t[i] for t in tables ) )
+                self.cache.put( k, missing[k] )
+
+        result, tables = [], [ [] for _ in xrange( 2 if self.has2nd else 1 ) ]
+        for s, k, e in zip( sentences, keys, entries ):
+            (boe, eoe, coe), table = missing[k] if e is None else e
+            result.append( (s, boe, eoe, coe) )
+            for t, tbl in zip( tables, table ):
+                t.append( tbl )
+
+        if isDevMode:
+            return result, tables
+        else:
+            return result
+
+
+    def __Rerun( self, sentences, raw2nd, prob1st ):
+        """
+        Returns
+        -------
+            rerun : ndarray
+                whether each sentence goes through the 2nd pass
+        """
+        if self.uncertain_band is None:
+            return numpy.ones( len(sentences), dtype = numpy.bool_ )
+
+        low, high = self.uncertain_band
+        sentence, _, _ = DocumentSpanIndex( [ len(s) for s in sentences ],
+                                            self.config1st.n_window )
+        top = prob1st[:,2:].max( axis = 1 )
+        flagged = (prob1st[:,1] != self.config1st.n_label_type) | \
+                  ((top >= low) & (top <= high))
+        rerun = numpy.bincount( sentence, weights = flagged,
+                                minlength = len(sentences) ) > 0
+        # decoded sentences are already flagged, but that depends on the threshold
+        rerun |= numpy.asarray( [ len(r[1]) > 0 for r in raw2nd ], dtype = numpy.bool_ )
+        return rerun
+
+
+    def __Annotate( self, sentences, isDevMode = False ):
+        # TODO ##
+        # make decoding-algorithm and decoding-threshold as dev-option
+
+        raw1st = [ (s, [], [], []) for s in sentences ]
+        if self.projected_builder1st is not None:
+            data1st = self.projected_builder1st.document( sentences )
+        elif self.builder1st is None:
+            data1st = batch_constructor( 
+                raw1st,
+                self.numericizer1_1st,
+                self.numericizer2_1st,
+                gazetteer = self.gazetteer,
+                alpha = self.config1st.word_alpha,
+                window = self.config1st.n_window,
+                n_label_type = self.config1st.n_label_type,
+                language = self.config1st.language
+            )
+        else:
+            data1st = self.builder1st.document( sentences )
+        logger.info( 'data1st: ' + str(data1st) )
 
-        memory1st = BytesIO()
-        numpy.savetxt( 
-            memory1st, 
-            prob1st, 
-            fmt = '%d  %d' + '  %f' * (self.config1st.n_label_type + 1) 
+        prob1st = self.__Probability( 
+            data1st, 
+            self.mention_net_1st, 
+            self.scheduler_1st,
+            self.config1st.feature_choice,
+            cascade = self.mention_net_cascade
         )
-        memory1st.seek(0)
+
+        dump = None
+        if self.dump_prediction is not None:
+            # next() of a count is atomic, so concurrent calls never share one
+            dump = '%s.%d.%d' % (self.dump_prediction, os.getpid(), next( self.n_dump ))
+            DumpPrediction( prob1st, dump + '.1st', self.config1st.n_label_type )
         logger.info( '1st-pass probability computed' )
 
-        raw2nd = []
-        for sent, table, estimate, actual in PredictionParser(
+        decoded = BatchDecode(
+            [ len(s) for s in sentences ],
+            prob1st,
+            self.config1st.n_window,
+            self.config1st.threshold,
+            self.config1st.algorithm,
+            n_label_type = self.config1st.n_label_type,
+            sentences = sentences
+        )
+        raw2nd = [ (sent, boe, eoe, coe) for sent, (boe, eoe, coe) in zip( sentences, decoded ) ]
+
+        # tables are only for visualization
+        if isDevMode:
+            tbl_dev_1st = [ table for _, table, _, _ in ArrayPredictionParser(
                 iter(raw1st),
-                memory1st,
+                prob1st,
                 self.config1st.n_window,
                 n_label_type = self.config1st.n_label_type
-            ):
-            estimate = sorted(
-                decode( 
-                    sent, 
-                    estimate, 
-                    table, 
-                    self.config1st.threshold,
-                    self.config1st.algorithm
-                )
-            )
-
-            if len(estimate) > 0:
-                boe, eoe, coe = zip(*estimate)
-            else:
-                boe, eoe, coe = [], [], []
-            tbl_dev_1st.append( table )
-            raw2nd.append( (sent, boe, eoe, coe) )
+            ) ]
         logger.info( 'result1st: %s' % str(raw2nd) )
 
         if not self.has2nd:
@@ -174,68 +858,66 @@ class fofe_ner_wrapper( object ):
                 return raw2nd
 
 
-        tbl_dev_2nd = []
-        data2nd = batch_constructor( 
-            raw2nd,
-            self.numericizer1_2nd,
-            self.numericizer2_2nd,
-            gazetteer = [set()] * self.config2nd.n_label_type,
-            alpha = self.config2nd.word_alpha,
-            window = self.config2nd.n_window,
-            is2ndPass = True,
-            n_label_type = self.config2nd.n_label_type,
-            language = self.config2nd.language
-        )
-        logger.info( 'data2nd: ' + str(data2nd) )
+        rerun = self.__Rerun( sentences, raw2nd, prob1st )
+        rows = numpy.repeat( rerun, SpanCount( [ len(s) for s in sentences ],
+                                               self.config1st.n_window ) )
+        sentences2nd = [ s for s, r in zip( sentences, rerun ) if r ]
+        self.n_sentence_2nd += len(sentences)
+        self.n_rerun_2nd += len(sentences2nd)
 
-        prob2nd = []
-        for example in data2nd.mini_batch_multi_thread( 
-                            2560, False, 1, 1, self.config2nd.feature_choice ):
-            _, pi, pv = self.mention_net_2nd.eval( example )
-            prob2nd.append(
-                numpy.concatenate(
-                    ( example[-1].astype(numpy.float32).reshape(-1, 1),
-                      pi.astype(numpy.float32).reshape(-1, 1),
-                      pv ),
-                    axis = 1
-                )
+        # sentences that are not rerun keep their 1st-pass probability
+        prob2nd = prob1st.copy()
+        result = list( raw2nd )
+
+        if len(sentences2nd) > 0:
+            data2nd = batch_constructor( 
+                [ r for r, k in zip( raw2nd, rerun ) if k ],
+                self.numericizer1_2nd,
+                self.numericizer2_2nd,
+                gazetteer = [set()] * self.config2nd.n_label_type,
+                alpha = self.config2nd.word_alpha,
+                window = self.config2nd.n_window,
+                is2ndPass = True,
+                n_label_type = self.config2nd.n_label_type,
+                language = self.config2nd.language
             )
-        prob2nd = numpy.concatenate( prob2nd, axis = 0 )
-        prob2nd[:,2:] = 0.6 * prob1st[:,2:] + 0.4 * prob2nd[:,2:]
-        prob2nd[:,1] = numpy.argmax( prob2nd[:,2:], axis = 1 ).astype( numpy.float32 )
-
-        memory2nd = BytesIO()
-        numpy.savetxt( 
-            memory2nd, 
-            prob2nd, 
-            fmt = '%d  %d' + '  %f' * (self.config2nd.n_label_type + 1) 
-        )
-        memory2nd.seek(0)
-        logger.info( '2nd-pass probability computed' )
+            logger.info( 'data2nd: ' + str(data2nd) )
 
-        result = []
-        for sent, table, estimate, actual in PredictionParser(
-                iter(raw2nd),
-                memory2nd,
+            rerun2nd = self.__Probability( 
+                data2nd, 
+                self.mention_net_2nd, 
+                self.scheduler_2nd,
+                self.config2nd.feature_choice,
+                prior = prob1st[rows,2:] if self.fused else None
+            )
+            if not self.fused:
+                rerun2nd[:,2:] = 0.6 * prob1st[rows,2:] + 0.4 * rerun2nd[:,2:]
+                rerun2nd[:,1] = numpy.argmax( rerun2nd[:,2:], axis = 1 ).astype( numpy.float32 )
+            prob2nd[rows] = rerun2nd
+
+            decoded = BatchDecode(
+                [ len(s) for s in sentences2nd ],
+                rerun2nd,
                 self.config2nd.n_window,
+                0.4,
+                1, # highest first
                 n_label_type = self.config2nd.n_label_type
-            ):
-            estimate = sorted(
-                decode( 
-                    sent, 
-                    estimate, 
-                    table, 
-                    0.4,
-                    1 # highest first
-                )
             )
+            for i, (boe, eoe, coe) in zip( numpy.flatnonzero( rerun ), decoded ):
+                result[i] = ( sentences[i], boe, eoe, coe )
 
-            if len(estimate) > 0:
-                boe, eoe, coe = zip(*estimate)
-            else:
-                boe, eoe, coe = [], [], []
-            tbl_dev_2nd.append( table )
-            result.append( (sent, boe, eoe, coe) )
+        if dump is not None:
+            DumpPrediction( prob2nd, dump + '.2nd', self.config2nd.n_label_type )
+        logger.info( '2nd-pass probability computed for %d of %d sentences' % \
+                     (len(sentences2nd), len(sentences)) )
+
+        if isDevMode:
+            tbl_dev_2nd = [ table for _, table, _, _ in ArrayPredictionParser(
+                iter(raw2nd),
+                prob2nd,
+                self.config2nd.n_window,
+                n_label_type = self.config2nd.n_label_type
+            ) ]
         logger.info( 'result2nd: %s' % str(result) )
 
         if isDevMode:
@@ -258,6 +940,19 @@ if __name__ == '__main__':
             self.vocab2 = '%s/model/gw128-case-sensitive.wordlist' % this_dir
             self.KBP = True
             self.gazetteer = None
+            self.wubi = None
+            self.dump_prediction = None
+            self.batch_wait = 0
+            self.cache_size = 0
+            self.cache_mb = 0
+            self.uncertain_band = None
+            self.cascade = None
+            self.cascade_threshold = None
+            self.fofe_builder = False
+            self.fofe_min_weight = 0
+            self.projected = False
+            self.fused = False
+            self.numpy_engine = False
 
     annotator = fofe_ner_wrapper( test_args() )
 
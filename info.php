@@ -4,15 +4,9 @@ if( $_POST['lang']) {
 
     $lang = $_POST['lang'];
 
-    // English
+    // one instance serves every language, see `server.sh all`
     $url = 'image.eecs.yorku.ca:20541';
 
-    if ($lang == "Spanish"){
-        $url = 'image.eecs.yorku.ca:20542';
-    } elseif ($lang == "Chinese"){
-        $url = 'image.eecs.yorku.ca:20543';
-    }
-
     $fields = array(
         'mode' => $_POST['mode'],
         'text' => $_POST['text'],
@@ -16,5 +16,5 @@ sed -e "s/url: '\/'/url: 'info.php'/g" static/js/ner-core.js > ~/www/static/js/n
 GivePerm ~/www
 INFO "permission granted"
 
-INFO "start to trilingual instances"
-parallel -j3 -env ${THIS_DIR}/server.sh ::: eng cmn spa
\ No newline at end of file
+INFO "start the trilingual instance"
+${THIS_DIR}/server.sh all
\ No newline at end of file
@@ -1,14 +1,14 @@
 #!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
 # -*- coding: utf-8 -*-
 
-import os, time, sys, argparse, logging, pandas, pprint, urllib
-from flask import Flask, render_template, request, jsonify
+import os, time, sys, argparse, logging, numpy, pandas, pprint, urllib, json, bisect, socket, signal
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from subprocess import call
 from subprocess import Popen
 from pandas import DataFrame
-from fofe_ner_wrapper import fofe_ner_wrapper
+from LanguageUtil import language_registry
 from langdetect import detect
-from pycorenlp import StanfordCoreNLP
+from TokenizerUtil import corenlp_pool, native_tokenizer
 from hanziconv import HanziConv
 
 reload(sys)
@@ -19,6 +19,43 @@ logger = logging.getLogger(__name__)
 cls2ner = ['PER', 'LOC', 'ORG', 'MISC']
 app = Flask(__name__)
 
+def word_offsets(words, offset):
+    """
+    :return: the character offset of each word in u' '.join(words) shifted
+             by offset, plus one past the end (the last is exclusive)
+    :rtype: numpy.ndarray
+    """
+    acc_len = numpy.empty(len(words) + 1, dtype=numpy.int64)
+    acc_len[0] = offset
+    acc_len[1:] = numpy.cumsum([len(w) + 1 for w in words], dtype=numpy.int64) + offset
+    return acc_len
+
+
+def span_entities(table, boe, eoe, acc_len, n_entities):
+    """
+    Looks the spans up in a score table, all at once.
+    :param table: PredictionUtil.span_table of the sentence
+    :param boe: beginning of each entity (index)
+    :param eoe: end of each entity (index, exclusive)
+    :param acc_len: word_offsets() of the sentence
+    :param n_entities: number of the first entity
+    :return: [['T<number>', entity name, [[first, last]], score]] of the spans
+             that have an estimate
+    :rtype: list
+    """
+    boe = numpy.asarray(boe, dtype=numpy.int64)
+    eoe = numpy.asarray(eoe, dtype=numpy.int64)
+    label, score = table.Lookup(boe, eoe)
+    keep = label >= 0
+    boe, eoe, label, score = boe[keep], eoe[keep], label[keep], score[keep]
+
+    first = acc_len[boe].tolist()
+    last = (acc_len[eoe] - 1).tolist()
+    score = score.tolist()
+    return [['T%d' % (n_entities + k), table.names[c], [[f, l]], "{0:.2f}".format(p)]
+            for k, (c, f, l, p) in enumerate(zip(label.tolist(), first, last, score))]
+
+
 def inference_to_json(inference, score_matrix, non_escaped):
     """
     Converts the inference information into a JSON convertible data structure.
@@ -26,8 +63,8 @@ def inference_to_json(inference, score_matrix, non_escaped):
                          entity names), (...)]
     :type inference: array, [(string, array of indices, array of indices,
                              array of strings), (...)]
-    :param score_matrix: matrix containing either None or a tuple
-                         (enitty name, score)
+    :param score_matrix: the score table (PredictionUtil.span_table) of
+                         each sentence
     :type score_matrix: array
     :param non_escaped: an array of arrays containing the non-escaped version
                         of the sentences
@@ -35,38 +72,23 @@ def inference_to_json(inference, score_matrix, non_escaped):
     :return: Returns the infomation in inference as a dictionary
     :rtype: dict
     """
-    text, entities_new, offset, n_entities, comments, m = '', [], 0, 0, [], 0
+    text, entities_new, offset, comments = u'', [], 0, []
 
-    for sent, boe, eoe, coe in inference:
-        acc_len = [offset]
+    for m, (sent, boe, eoe, coe) in enumerate(inference):
         # non-escaped sentence
         out_sent = non_escaped[m]
-        s = score_matrix[m]
-
-        for w in out_sent:
-            acc_len.append(acc_len[-1] + len(w) + 1)  # last exclusive
-
+        acc_len = word_offsets(out_sent, offset)
         text += u' '.join(out_sent) + u'\n'
 
-        for i in range(len(boe)):
-            word_slice = [acc_len[boe[i]], acc_len[eoe[i]] - 1]
-            ent_score = s[boe[i]][eoe[i] - 1]
-            if ent_score is not None:
-                entities_new.append(['T%d' % n_entities,
-                                     ent_score[0],
-                                     [word_slice],
-                                     "{0:.2f}".format(ent_score[1])  # score
-                                     ])
-                n_entities += 1
+        entities_new.extend(span_entities(score_matrix[m], boe, eoe, acc_len, len(entities_new)))
 
         # for the next sentence in the text
-        offset = acc_len[-1]
-        m += 1
+        offset = int(acc_len[-1])
 
     return {'text': text, 'entities': entities_new, 'comments': comments}
 
 #===============================================================================
-# FUNCTIONS FOR DEVELOPER MODE (not clean) - To remove later
+# FUNCTIONS FOR DEVELOPER MODE
 #===============================================================================
 
 def inference_to_json_dev_demo(inference, score_matrix):
@@ -74,135 +96,73 @@ def inference_to_json_dev_demo(inference, score_matrix):
     Converts the inference information into a JSON convertible data structure.
     Same as inference_to_json() but does not convert to non-escaped.
     """
-    text, entities, offset, n_entities = '', [], 0, 0
-    comments = []
-
-    n_entities = 0
-    entities_new = []
-    scores = []  # (slice, score)
-    m = 0
-    for sent, boe, eoe, coe in inference:
-        # boe - beginning of entity (index)
-        # eoe - end of entity (index)
-        # coe - entity name
-        acc_len = [offset]  # slice
-
-        for w in sent:
-            acc_len.append(acc_len[-1] + len(w) + 1)  # last exclusive
-
-        s = score_matrix[m]
-        logger.info("matrix: " + str(s))
-
-        text += u' '.join(sent) + u'\n'
+    return inference_to_json(inference, score_matrix, [sent for sent, _, _, _ in inference])
 
-        for i in range(len(boe)):
-            word_slice = [acc_len[boe[i]], acc_len[eoe[i]] - 1]
-            logger.info("word slice: " + str(text[word_slice[0]:word_slice[1]]))
-            ent_score = s[boe[i]][eoe[i] - 1]
-            if ent_score is not None:
-                logger.info("ent score : " + str(ent_score))
-                entities_new.append(['T%d' % n_entities,
-                                     ent_score[0],
-                                     [word_slice],
-                                     # ent_score[1]
-                                     "{0:.2f}".format(ent_score[1])  # score
-                                     ])
-                scores.append([word_slice, "{0:.2f}".format(ent_score[1])])
-                n_entities += 1
 
-
-        # for the next sentence in the text
-        offset = acc_len[-1]
-
-        m += 1
-
-    return {'text': text, 'entities': entities_new, 'comments': comments}
-
-
-
-def inference_to_json_dev(inference, score_matrix):
+def inference_to_json_dev(inference, score_matrix, exclude=None):
     """
     Converts the inference information into a JSON convertible data structure.
     Returns all of the mentions detected without filtering by confidence.
+    :param exclude: if given, (boe, eoe) of each sentence; these spans are left
+                    out but still numbered, i.e. the hidden entities of
+                    dev mode
     """
-    text, entities, offset, n_entities = '', [], 0, 0
-    comments = []
-
-    n_entities = 0
-    entities_new = []
-    m = 0
-    for sent, boe, eoe, coe in inference:
-        # boe - beginning of entity (index)
-        # eoe - end of entity (index)
-        # coe - entity name
-        acc_len = [offset]  # slice
-        for w in sent:
-            acc_len.append(acc_len[-1] + len(w) + 1)  # last exclusive
+    text, entities_new, offset, n_entities, comments = u'', [], 0, 0, []
 
+    for m, (sent, boe, eoe, coe) in enumerate(inference):
+        acc_len = word_offsets(sent, offset)
         text += u' '.join(sent) + u'\n'
-        offset = acc_len[-1]
-
-        # indices that contain a non-None value
-        s = score_matrix[m]
-        for i in range(len(s)):
-            for j in range(len(s[i])):
-                ent_score = s[i][j]  # tuple
-                if ent_score is not None:
-                    word_slice = [acc_len[i], acc_len[j + 1] - 1]
-                    entities_new.append(['T%d' % n_entities,
-                                         ent_score[0],
-                                         [word_slice],
-                                         # ent_score[1]
-                                         "{0:.2f}".format(ent_score[1])  # score
-                                         ])
-                    n_entities += 1
-        m += 1
+        offset = int(acc_len[-1])
+
+        # spans that hold an estimate, by begin, then end
+        table = score_matrix[m]
+        estimate = table.Estimates()
+        begin, end = estimate['begin'].astype(numpy.int64), estimate['end'].astype(numpy.int64)
+        entities = span_entities(table, begin, end, acc_len, n_entities)
+        n_entities += len(entities)
+
+        if exclude is not None and len(exclude[m][0]) > 0:
+            # spans are keyed by begin * n + end
+            n = len(sent) + 1
+            shown = numpy.asarray(exclude[m][0], dtype=numpy.int64) * n + \
+                    numpy.asarray(exclude[m][1], dtype=numpy.int64)
+            hidden = ~numpy.in1d(begin * n + end, shown)
+            entities = [e for e, h in zip(entities, hidden.tolist()) if h]
+        entities_new.extend(entities)
 
     return {'text': text, 'entities': entities_new, 'comments': comments}
 
 #===============================================================================
+# LANGUAGE SELECTION & TOKENIZATION
+#===============================================================================
 
-@app.route('/', methods=['GET'])
-def home_page():
-    """
-    Renders the home page.
-    """
-    print(render_template(u"ner-home.html"))
-    return render_template(u"ner-home.html")
-
-
-@app.route('/', methods=['POST'])
-def annotate():
+def resolve_language(selected, text):
     """
-    Responds to the ajax request fired when user submits the text to be detected.
-    Returns a JSON object: {'text': text, 'entities': entity info,
-                             'lang': language of the text, 'notes': error notes}
+    Maps the language chosen in the UI (or 'Automatic') to the model language.
+    :param selected: 'English', 'Spanish', 'Chinese' or 'Automatic'; 'eng',
+                     'spa' and 'cmn' are accepted as well
+    :param text: the text, only used by the language detector
+    :return: (language, notes); language is None if it is not supported
+    :rtype: tuple
     """
-
-    mode = request.form['mode']
-    text = request.form['text'].strip()
-    selected = request.form['lang']
     notes = ""
 
     language = "eng"
-    if selected == "Spanish":
+    if selected in ["Spanish", "spa"]:
         language = "spa"
 
-    elif selected == "Chinese":
+    elif selected in ["Chinese", "cmn"]:
         language = "cmn"
 
     #-------------------------- Language detector ------------------------------
     elif selected == "Automatic":
         lang_detect = detect(text)
-        if lang_detect not in ['en', 'es']: #Chinese (later): 'zh-cn', 'zh-tw'
-            return jsonify({'text': "Language not found", 'entities': [],
-                            'notes': "Language not supported."})
+        # Chinese only where a cmn model is registered with --language
+        chinese = lang_detect in ['zh-cn', 'zh-tw'] and annotator.Serves('cmn')
+        if lang_detect not in ['en', 'es'] and not chinese:
+            return None, "Language not supported."
 
-        english = (lang_detect == 'en') and (language == "eng")
-        spanish = (lang_detect == 'es') and (language == "spa")
-        chinese = (lang_detect[0:2] == "zh") and (language == "cmn")
-
-        selected = "Chinese"
+        selected, language = "Chinese", "cmn"
         if lang_detect == "en":
                 selected, language = "English", "eng"
         elif lang_detect == "es":
@@ -210,12 +170,31 @@ def annotate():
 
         notes = "Language detected: " + selected + "." 
 
-    # =====================================================================================
-    # Stanford CoreNLP
-    # =====================================================================================
+    return language, notes
 
-    nlp = StanfordCoreNLP('http://localhost:' + args.coreNLP_port)
 
+def tokenize(text, language):
+    """
+    Splits and tokenizes the text with Stanford CoreNLP, or in-process if
+    --native-tokenizer names the language.
+    :return: (text_array, non_esc_array, begin) where text_array holds the
+             tokens fed to the annotator, non_esc_array the non-escaped tokens
+             and begin the character offset of each sentence in the text
+    :rtype: tuple
+    """
+    if language in native:
+        output = native[language].annotate(text)
+    else:
+        text, properties = corenlp_request(text, language)
+        output = corenlp.annotate(text, properties)
+    return read_tokens(output, language)
+
+
+def corenlp_request(text, language):
+    """
+    :return: (text, properties) to send to CoreNLP for the language
+    :rtype: tuple
+    """
     properties = {'annotators': 'tokenize,ssplit',
                   'outputFormat': 'json'}
 
@@ -230,10 +209,16 @@ def annotate():
     elif language == 'spa':
         properties['tokenize.language'] = 'es'
 
-    output = nlp.annotate(text, properties=properties)
+    return text, properties
 
+
+def read_tokens(output, language):
+    """
+    Builds the return value of tokenize() from the CoreNLP JSON output.
+    """
     text_array = []
     non_esc_array = []
+    begin = []
     sentences = output['sentences']
     for sent in sentences:
         new = []
@@ -257,16 +242,80 @@ def annotate():
                 non_esc.append(word['originalText'])
         text_array.append(new)
         non_esc_array.append(non_esc)
+        begin.append(tokens[0]['characterOffsetBegin'] if len(tokens) > 0 else 0)
 
-    # =====================================================================================
+    return text_array, non_esc_array, begin
 
+#===============================================================================
+
+@app.route('/', methods=['GET'])
+def home_page():
+    """
+    Renders the home page.
+    """
+    print(render_template(u"ner-home.html"))
+    return render_template(u"ner-home.html")
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """
+    Reports the serving counters of the annotator, e.g. the queue depth, batch
+    fill ratio and added wait time of the micro-batching scheduler, and the
+    state of every CoreNLP backend.
+    """
+    return jsonify(dict(annotator.stats(), corenlp=corenlp.stats()))
+
+
+@app.route('/admin/reload', methods=['POST'])
+def reload_model():
+    """
+    Rebuilds the annotator from the model files in the background and swaps
+    it in once it is warmed up, see ReloadUtil. Only accepted from localhost;
+    the progress is reported by /stats.
+    """
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        return jsonify({'error': 'forbidden'}), 403
+    started = annotator.Trigger('admin')
+    return jsonify(dict(annotator.ReloadStats(), started=started)), 202 if started else 409
+
+
+@app.route('/', methods=['POST'])
+def annotate():
+    """
+    Responds to the ajax request fired when user submits the text to be detected.
+    Returns a JSON object: {'text': text, 'entities': entity info,
+                             'lang': language of the text, 'notes': error notes}
+    """
+
+    mode = request.form['mode']
+    text = request.form['text'].strip()
+    selected = request.form['lang']
+
+    language, notes = resolve_language(selected, text)
+    if language is None:
+        return jsonify({'text': "Language not found", 'entities': [],
+                        'notes': notes})
+
+    text_array, non_esc_array, _ = tokenize(text, language)
+
+    return jsonify(annotate_tokens(mode, text_array, non_esc_array, language, notes))
+
+
+def annotate_tokens(mode, text_array, non_esc_array, language, notes):
+    """
+    The part of annotate() after tokenization, i.e. everything that runs
+    the model.
+    :return: the JSON object annotate() responds with
+    :rtype: dict
+    """
     text = text_array
     logger.info('text after split & tokenize: %s' % str(text))
 
     # DEMO MODE
     if mode == 'demo':
         # retrieve the MIDs from the csv file
-        inference, score = annotator.annotate(text, isDevMode=True)
+        inference, score = annotator.annotate(text, isDevMode=True, language=language)
 
         logger.info("inference: " + str(inference))
 
@@ -286,7 +335,7 @@ def annotate():
 
     # DEVELOPER MODE
     elif mode == 'dev':
-        inference, score = annotator.annotate(text, isDevMode=True)
+        inference, score = annotator.annotate(text, isDevMode=True, language=language)
 
         if language == 'cmn':
             for i in xrange(len(text_array)):
@@ -297,66 +346,34 @@ def annotate():
 
         # contains the first pass info for sentences -  {"0": {text: ..., entities: ..., comments: ...}, "1": {...}}
         first_pass_shown = {}
-        shown_contains = []
         first_pass_hidden = {}
-        
-        # First pass shown
-        for i in range(len(inference)):
-            inf = [inference[i]]
-            matrix = [score[0][i]]
-            fp = inference_to_json_dev_demo(inf, matrix)
-            first_pass_shown[str(i)] = fp
-            shown_contains.append(fp['entities'])
 
-        # First pass hidden
+        # shown: the decoded mentions; hidden: every other span with an estimate
         for i in range(len(inference)):
             inf = [inference[i]]
             matrix = [score[0][i]]
-            fp = inference_to_json_dev(inf, matrix)
-
-            if not all(x in first_pass_shown[str(i)]['entities'] for x in fp['entities']):
-                shown = first_pass_shown[str(i)]['entities']
-                hidden = fp['entities']
-                inter = []
-                for entity in hidden:
-                    if entity not in shown:
-                        inter.append(entity)
-                fp['entities'] = inter
-            first_pass_hidden[str(i)] = fp
-
-        for i in range(len(first_pass_shown)):
-            shown = first_pass_shown[str(i)]['entities']
-            hid = first_pass_hidden[str(i)]['entities']
-            print("first pass hidden: " + str(first_pass_hidden[str(i)]['entities']))
-            for entity in shown:
-                for hidden in hid:
-                    if entity[1:] == hidden[1:]:
-                        first_pass_hidden[str(i)]['entities'].remove(hidden)
-
-        for i in range(len(first_pass_hidden)):
-            [first_pass_hidden[str(i)]['entities'].remove(x) for x in first_pass_hidden[str(i)]['entities'] if len(x) == 0]
+            first_pass_shown[str(i)] = inference_to_json_dev_demo(inf, matrix)
+            first_pass_hidden[str(i)] = inference_to_json_dev(inf, matrix, [inference[i][1:3]])
 
         # Second pass
         second_pass = "N/A"
         if len(score) > 1:
-            second_pass_shown = {}
-            second_pass_hidden = {}
+            second_pass = {}
             for i in range(len(inference)):
                 inf = [inference[i]]
                 matrix = [score[1][i]]
-                fp = inference_to_json(inf, matrix)
-                second_pass[str(i)] = fp
+                second_pass[str(i)] = inference_to_json_dev_demo(inf, matrix)
 
             # TODO: show inference step by step
-            for j, i in enumerate(inference):
+            for j, i in enumerate(inference if logger.isEnabledFor(logging.DEBUG) else []):
                 n = len(i[0])
                 pandas.set_option('display.width', 256)
                 pandas.set_option('max_rows', n + 1)
                 pandas.set_option('max_columns', n + 1)
 
                 for s in score:
-                    logger.info('\n%s' % str(DataFrame(
-                        data=s[j],
+                    logger.debug('\n%s' % str(DataFrame(
+                        data=s[j].tolist(),
                         index=range(n),
                         columns=range(1, n + 1)
                     )))
@@ -370,38 +387,279 @@ def annotate():
             'entities': []
         }
 
-    return jsonify(result)
+    return result
 
 
-if __name__ == '__main__':
-    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s',
-                        level=logging.INFO)
+@app.route('/api/v1/annotate', methods=['POST'])
+def annotate_batch():
+    """
+    Annotates an array of documents and streams one NDJSON line per document
+    (or per sentence) as soon as the chunk it belongs to is done.
+    Expects a JSON object: {'documents': [text or {'id': ..., 'text': ...}],
+                            'lang': 'English', 'Spanish', 'Chinese',
+                                    'Automatic' or eng/spa/cmn,
+                            'granularity': 'document' or 'sentence'}
+    Each line is {'id': ..., 'lang': ..., 'text': ..., 'entities': ...}
+    (plus 'sentence' for sentence granularity) or {'id': ..., 'error': ...}.
+    """
+    payload = request.get_json(force=True, silent=True)
+    if payload is None or not isinstance(payload.get('documents'), list):
+        return jsonify({'error': "expecting a JSON object with a 'documents' array"}), 400
+
+    selected = payload.get('lang', 'Automatic')
+    by_sentence = payload.get('granularity', 'document') == 'sentence'
+
+    # a malformed document only fails its own line
+    documents = []
+    for i, doc in enumerate(payload['documents']):
+        doc_id, text = i, doc
+        if isinstance(doc, dict):
+            doc_id, text = doc.get('id', i), doc.get('text', u'')
+        if isinstance(text, basestring):
+            documents.append((doc_id, text.strip(), None))
+        else:
+            documents.append((doc_id, None, "expecting a string or an object with a 'text' string"))
 
+    def generate():
+        for c in xrange(0, len(documents), args.api_chunk):
+            chunk = documents[c: c + args.api_chunk]
+            for line in annotate_chunk(chunk, selected, by_sentence):
+                yield json.dumps(line, ensure_ascii=False) + u'\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+def annotate_chunk(chunk, selected, by_sentence):
+    """
+    Runs a chunk of documents through CoreNLP and the annotator as one batch
+    per language.
+    :param chunk: [(document id, text, error)], where error is None unless
+                  the document is malformed
+    :return: the NDJSON records of the chunk, in document order
+    :rtype: list
+    """
+    records = [None] * len(chunk)
+    by_language = {}
+    for k, (doc_id, text, error) in enumerate(chunk):
+        if error is not None:
+            records[k] = [{'id': doc_id, 'error': error}]
+            continue
+        language, notes = resolve_language(selected, text)
+        if language is None:
+            records[k] = [{'id': doc_id, 'error': notes}]
+        else:
+            by_language.setdefault(language, []).append(k)
+
+    for language, members in by_language.items():
+        # documents are joined by a blank line, which CoreNLP always treats
+        # as a sentence break; sentences are mapped back by their offsets,
+        # counted in UTF-16 code units like Java does
+        boundary, joined, length = [], [], 0
+        for k in members:
+            boundary.append(length)
+            joined.append(chunk[k][1])
+            length += len(chunk[k][1].encode('utf-16-le')) // 2 + 2
+        text_array, non_esc_array, begin = tokenize(u'\n\n'.join(joined), language)
+        owned = [[] for _ in members]
+        for i, b in enumerate(begin):
+            owned[bisect.bisect_right(boundary, b) - 1].append(i)
+
+        if len(text_array) > 0:
+            inference, score = annotator.annotate(text_array, isDevMode=True, language=language)
+            table = score[-1]
+        else:
+            inference, table = [], []
+
+        for n, k in enumerate(members):
+            doc_id = chunk[k][0]
+            sent_idx = owned[n]
+            if by_sentence:
+                records[k] = []
+                for j, i in enumerate(sent_idx):
+                    line = inference_to_json([inference[i]], [table[i]], [non_esc_array[i]])
+                    line.update({'id': doc_id, 'sentence': j, 'lang': language})
+                    del line['comments']
+                    records[k].append(line)
+            else:
+                line = inference_to_json([inference[i] for i in sent_idx],
+                                         [table[i] for i in sent_idx],
+                                         [non_esc_array[i] for i in sent_idx])
+                line.update({'id': doc_id, 'lang': language})
+                del line['comments']
+                records[k] = [line]
+
+    return [line for record in records for line in record]
+
+
+def serve_prefork(port, n_worker):
+    """
+    Binds the port in the master process and forks n_worker processes that
+    accept on the shared socket, so that the kernel spreads connections
+    across them. Everything the annotator loaded before the fork is shared
+    copy-on-write; each worker builds its own TensorFlow session because the
+    TensorFlow runtime does not survive fork. Dead workers are replaced.
+    :param port: the port to listen on
+    :param n_worker: number of worker processes
+    """
+    from werkzeug.serving import make_server
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', port))
+    listener.listen(128)
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                annotator.LoadNetwork()
+                server = make_server('0.0.0.0', port, app, threaded=True,
+                                     fd=listener.fileno())
+                logger.info('worker %d serving' % os.getpid())
+                server.serve_forever()
+            except Exception:
+                logger.exception('worker %d failed' % os.getpid())
+            finally:
+                os._exit(1)
+        return pid
+
+    workers = set(spawn() for _ in xrange(n_worker))
+
+    def shutdown(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while True:
+        pid, status = os.wait()
+        if pid in workers:
+            workers.remove(pid)
+            logger.warning('worker %d exited with status %d, restarting' % (pid, status))
+            time.sleep(1)
+            workers.add(spawn())
+
+
+def build_parser():
+    """
+    :return: the command line parser, shared by every front end
+    :rtype: argparse.ArgumentParser
+    """
     parser = argparse.ArgumentParser()
     parser.add_argument('model1st', type=str,
-                        help='basename of model trained for 1st pass')
-    parser.add_argument('vocab1', type=str,
+                        help='basename of model trained for 1st pass, or a bundle written by '
+                             '`BundleUtil.py pack`, which replaces the vocabularies, --model2nd, '
+                             '--cascade, --gazetteer and --wubi')
+    parser.add_argument('vocab1', type=str, nargs='?',
                         help='case-insensitive word-vector for {eng,spa} or word-vector for cmn')
-    parser.add_argument('vocab2', type=str,
+    parser.add_argument('vocab2', type=str, nargs='?',
                         help='case-sensitive word-vector for {eng,spa} or char-vector for cmn')
     parser.add_argument('coreNLP_path', type=str, help='Path to the Stanford CoreNLP folder.')
-    parser.add_argument('coreNLP_port', type=str, help='set the localhost port to coreNLP_port.')
+    parser.add_argument('coreNLP_port', type=str,
+                        help='set the localhost port to coreNLP_port; a comma-separated list of '
+                             'ports or URLs spreads the requests over several CoreNLP servers')
     parser.add_argument('--model2nd', type=str, default=None,
                         help='basename of model trained for 2nd pass')
     parser.add_argument('--KBP', action='store_true', default=False)
-    parser.add_argument('--gazetteer', type=str, default=None)
+    parser.add_argument('--gazetteer', type=str, default=None,
+                        help='pickled gazetteer, or the directory `ServingUtil.py gazetteer` converts it to')
     parser.add_argument('--port', type=int, default=20541)
     parser.add_argument('--wubi', type=str, default=None)
-
-    args = parser.parse_args()
+    parser.add_argument('--dump-prediction', type=str, default=None,
+                        help='basename of text dumps of the span probabilities, for debugging; each call '
+                             'writes BASENAME.PID.N.1st and .2nd')
+    parser.add_argument('--batch-wait', type=float, default=0,
+                        help='milliseconds to wait for concurrent requests to share one eval call; 0 disables it')
+    parser.add_argument('--api-chunk', type=int, default=64,
+                        help='number of documents /api/v1/annotate runs as one batch')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='maximum number of sentences in the LRU result cache, '
+                             'which is off unless --cache-size or --cache-mb is given')
+    parser.add_argument('--cache-mb', type=float, default=0,
+                        help='maximum estimated size of the LRU result cache in megabytes')
+    parser.add_argument('--uncertain-band', type=float, nargs=2, default=None, metavar=('LOW', 'HIGH'),
+                        help='selective 2nd pass: only sentences with a 1st-pass candidate, or a span whose '
+                             'top probability is in [LOW, HIGH], are rerun; the others keep their 1st-pass result')
+    parser.add_argument('--cascade', type=str, default=None,
+                        help='basename of a cascade model (CascadeUtil.py) that rejects spans before the 1st pass')
+    parser.add_argument('--cascade-threshold', type=float, default=None,
+                        help='overrides the threshold CascadeUtil.py calibrate saved with the cascade model')
+    parser.add_argument('--fofe-builder', action='store_true', default=False,
+                        help='build the 1st-pass word features with FeatureUtil.fofe_builder; char, '
+                             'gazetteer and conv features still come from batch_constructor, and the '
+                             'result is checked against batch_constructor at start-up')
+    parser.add_argument('--fofe-min-weight', type=float, default=0,
+                        help='with --fofe-builder, leave out context words weighing less than this')
+    parser.add_argument('--projected', action='store_true', default=False,
+                        help='with --fofe-builder, feed the 1st pass word features already multiplied by the '
+                             'embeddings instead of as sparse codes')
+    parser.add_argument('--fused', action='store_true', default=False,
+                        help='load all passes into one TensorFlow graph and session, sharing its thread pools; '
+                             'the 2nd pass blends in the 1st-pass probabilities inside the graph')
+    parser.add_argument('--numpy-engine', action='store_true', default=False,
+                        help='run every pass with NumpyUtil.numpy_mention_net on the <model>.numpy bundle '
+                             'written by `NumpyUtil.py convert` instead of with TensorFlow')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of pre-forked worker processes sharing the loaded model')
+    parser.add_argument('--reload-poll', type=float, default=0,
+                        help='seconds between checks of the model files; a change reloads the model '
+                             'without downtime, as POST /admin/reload does; 0 disables it')
+    parser.add_argument('--reload-max-mb', type=float, default=0,
+                        help='refuse a reload if the resident size may exceed this many megabytes '
+                             'while the old and new model are both loaded; 0 for no limit')
+    parser.add_argument('--language', type=str, action='append', default=[], metavar='LANG=BUNDLE',
+                        help='serve LANG (eng, spa or cmn) from the bundle too, loaded on its first request; '
+                             'model1st serves its own language and every language without a bundle')
+    parser.add_argument('--model-budget-mb', type=float, default=0,
+                        help='megabytes of loaded models; loading one beyond it first evicts the least '
+                             'recently used idle models; 0 for no limit')
+    parser.add_argument('--corenlp-timeout', type=float, default=15,
+                        help='seconds allowed per CoreNLP call before failing over to another server')
+    parser.add_argument('--corenlp-slow', type=float, default=5,
+                        help='CoreNLP servers slower than this many seconds on average per 4 KB of text are '
+                             'ejected for a while')
+    parser.add_argument('--native-tokenizer', type=str, nargs='*', default=[], choices=['eng', 'spa'],
+                        help='languages tokenized and split in-process instead of by CoreNLP; '
+                             'check them with `TokenizerUtil.py parity` first')
+
+    return parser
+
+
+def setup(parsed):
+    """
+    Sets the module-level state the handlers read from the parsed arguments.
+    The annotator is left to the caller.
+    """
+    global args, cls2ner, corenlp, native
+    args = parsed
 
     if args.KBP:
         cls2ner = ['PER-NAME', 'ORG-NAME', 'GPE-NAME', 'LOC-NAME', 'FAC-NAME',
                    'PER-NOMINAL', 'ORG-NOMINAL', 'GPE-NOMINAL', 'LOC-NOMINAL', 'FAC-NOMINAL']
 
-    annotator = fofe_ner_wrapper(args)
+    corenlp = corenlp_pool(args.coreNLP_port.split(','),
+                           timeout=args.corenlp_timeout, slow=args.corenlp_slow)
+    native = {language: native_tokenizer(language) for language in args.native_tokenizer}
 
-    app.run('0.0.0.0', args.port)
 
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s',
+                        level=logging.INFO)
+
+    setup(build_parser().parse_args())
 
-    
\ No newline at end of file
+    # each pre-forked worker reloads and loads further languages on its own
+    if args.workers > 1:
+        annotator = language_registry(args, load_network=False)
+        serve_prefork(args.port, args.workers)
+    else:
+        annotator = language_registry(args)
+        app.run('0.0.0.0', args.port, threaded=True)
@@ -19,9 +19,9 @@ pathtocorenlp="/eecs/research/asr/Shared/ner-toolkit/CoreNLP"
 # |& tee ${THIS_DIR}/logs/${timestamp}
 
 function NextPort {
-    netstat -atn | perl -0777 -ne \
+    netstat -atn | FIRST=${1:-32768} perl -0777 -ne \
         '@ports = /tcp.*?\:(\d+)\s+/imsg ;
-        for $port (32768..61000) {
+        for $port ($ENV{FIRST}..61000) {
             if (!grep(/^$port$/, @ports)) {
                 print $port;
                 last
@@ -30,50 +30,124 @@ function NextPort {
 }
 
 
-portused=$(NextPort)
+# the models of each language are packed into a bundle, see BundleUtil.py,
+# again whenever one of its sources is newer; the bundle is replaced by
+# rename, which servers started with --reload-poll pick up
+function Pack {
+    bundle="${THIS_DIR}/model/${1}.bundle"
+    stale=$([ -f ${bundle} ] || echo "missing")
+    for source in "${THIS_DIR}/model/${1}.index" "${THIS_DIR}/model/${1}.config" \
+                  "${THIS_DIR}/model/${1}.tables/tables.meta" \
+                  "${2}" "${3}" "${THIS_DIR}/model/gaz.pkl" "${@:4}"
+    do
+        # options such as --wubi are not files and are skipped
+        if [ -f "${source}" ] && [ "${source}" -nt ${bundle} ]
+        then
+            stale="${stale:-newer} ${source}"
+        fi
+    done
+    if [ -n "${stale}" ]
+    then
+        echo "packing ${bundle}: ${stale}" >&2
+        ${THIS_DIR}/BundleUtil.py pack "${THIS_DIR}/model/${1}" "${2}" "${3}" ${bundle} \
+            --gazetteer "${THIS_DIR}/model/gaz.pkl" "${@:4}" >&2
+    fi
+    echo ${bundle}
+}
+
+function Eng {
+    Pack eng2017v1-0 \
+        "${THIS_DIR}/model/eng2017v1-0-case-insensitive.wordlist" \
+        "${THIS_DIR}/model/eng2017v1-0-case-sensitive.wordlist"
+}
+
+function Spa {
+    Pack spa2017v1-0 \
+        "${THIS_DIR}/model/spa2017v1-0-case-insensitive.wordlist" \
+        "${THIS_DIR}/model/spa2017v1-0-case-sensitive.wordlist"
+}
+
+function Cmn {
+    Pack cmn2017v1-0 \
+        "${THIS_DIR}/model/cmn2017v1-0-char.wordlist" \
+        "${THIS_DIR}/model/cmn2017v1-0-word.wordlist" \
+        --wubi "${THIS_DIR}/model/cmn2017v1-0.wubi"
+}
+
+# `server.sh pack` only repacks what changed, e.g. after retraining, and
+# leaves the running servers to reload
+if [[ $1 == 'pack' ]]
+then
+    Eng > /dev/null
+    Spa > /dev/null
+    Cmn > /dev/null
+    exit 0
+fi
 
+# CORENLP_BACKENDS servers share the tokenization load
 cd ${pathtocorenlp}
-java -mx4g -cp "*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer -port ${portused} -timeout 15000 &
-corenlp_pid=$!
+portused=""
+corenlp_pid=""
+port=32767
+for i in $(seq ${CORENLP_BACKENDS:-1})
+do
+    port=$(NextPort $((port + 1)))
+    java -mx4g -cp "*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer -port ${port} -timeout 15000 &
+    corenlp_pid="${corenlp_pid} $!"
+    portused="${portused:+${portused},}${port}"
+done
 trap "kill -9 ${corenlp_pid} &> /dev/null" EXIT
 
 if [[ $1 == 'eng' ]]
 then
     echo English model being generated...
     ${THIS_DIR}/server.py \
-        "${THIS_DIR}/model/eng2017v1-0" \
-        "${THIS_DIR}/model/eng2017v1-0-case-insensitive.wordlist" \
-        "${THIS_DIR}/model/eng2017v1-0-case-sensitive.wordlist" \
+        $(Eng) \
         "/eecs/research/asr/Shared/ner-toolkit/CoreNLP" \
         ${portused} \
         --KBP \
+        --reload-poll ${RELOAD_POLL:-60} \
         --port 20541 \
-        --gazetteer "${THIS_DIR}/model/gaz.pkl" \
+        --workers ${ENG_WORKERS:-1} \
     |& tee ${THIS_DIR}/logs/eng-${timestamp}
 elif [[ $1 == 'spa' ]]
 then
     echo Spanish model being generated...
     ${THIS_DIR}/server.py \
-        "${THIS_DIR}/model/spa2017v1-0" \
-        "${THIS_DIR}/model/spa2017v1-0-case-insensitive.wordlist" \
-        "${THIS_DIR}/model/spa2017v1-0-case-sensitive.wordlist" \
+        $(Spa) \
         "/eecs/research/asr/Shared/ner-toolkit/CoreNLP" \
         ${portused} \
         --KBP \
+        --reload-poll ${RELOAD_POLL:-60} \
         --port 20542 \
-        --gazetteer "${THIS_DIR}/model/gaz.pkl" \
+        --workers ${SPA_WORKERS:-1} \
     |& tee ${THIS_DIR}/logs/spa-${timestamp}
-else
+elif [[ $1 == 'cmn' ]]
+then
     echo Chinese model being generated...
     ${THIS_DIR}/server.py \
-        "${THIS_DIR}/model/cmn2017v1-0" \
-        "${THIS_DIR}/model/cmn2017v1-0-char.wordlist" \
-        "${THIS_DIR}/model/cmn2017v1-0-word.wordlist" \
+        $(Cmn) \
         "/eecs/research/asr/Shared/ner-toolkit/CoreNLP" \
         ${portused} \
         --KBP \
+        --reload-poll ${RELOAD_POLL:-60} \
         --port 20543 \
-        --gazetteer "${THIS_DIR}/model/gaz.pkl" \
-        --wubi "${THIS_DIR}/model/cmn2017v1-0.wubi" \
+        --workers ${CMN_WORKERS:-1} \
     |& tee ${THIS_DIR}/logs/cmn-${timestamp}
+else
+    # one process serves all three languages; Spanish and Chinese are
+    # loaded on their first request and MODEL_BUDGET_MB bounds the models
+    echo Trilingual model being generated...
+    ${THIS_DIR}/server.py \
+        $(Eng) \
+        "/eecs/research/asr/Shared/ner-toolkit/CoreNLP" \
+        ${portused} \
+        --KBP \
+        --reload-poll ${RELOAD_POLL:-60} \
+        --port 20541 \
+        --workers ${WORKERS:-1} \
+        --language spa=$(Spa) \
+        --language cmn=$(Cmn) \
+        --model-budget-mb ${MODEL_BUDGET_MB:-0} \
+    |& tee ${THIS_DIR}/logs/all-${timestamp}
 fi